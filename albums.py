@@ -0,0 +1,54 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Collects messages that arrive in a burst (a Telegram album, or several
+# albums sent back to back) into one batch per key. The batch is handed to
+# on_batch(messages) once no new message for that key has arrived for
+# quiet_period seconds, or as soon as max_items is reached. Items are
+# delivered in message order; pass sort_key if they are not bare messages.
+class AlbumCollector:
+    def __init__(self, on_batch, quiet_period=2.0, max_items=50, sort_key=lambda m: m.message_id):
+        self.on_batch = on_batch
+        self.sort_key = sort_key
+        self.quiet_period = quiet_period
+        self.max_items = max_items
+        self._batches = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, message):
+        with self._lock:
+            batch = self._batches.setdefault(key, [])
+            batch.append(message)
+            timer = self._timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            if len(batch) >= self.max_items:
+                ready = self._batches.pop(key)
+            else:
+                ready = None
+                timer = threading.Timer(self.quiet_period, self._flush, args=(key,))
+                timer.daemon = True
+                self._timers[key] = timer
+                timer.start()
+        if ready:
+            self._deliver(ready)
+        return len(batch)
+
+    def _flush(self, key):
+        with self._lock:
+            self._timers.pop(key, None)
+            batch = self._batches.pop(key, None)
+        if batch:
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        # Telegram may deliver album items out of order
+        batch.sort(key=self.sort_key)
+        try:
+            self.on_batch(batch)
+        except Exception as e:
+            logger.error(f"Album batch handler failed: {e}")
@@ -0,0 +1,176 @@
+# Dispatch-overhead benchmark: predicate chain vs. table-driven FlowRouter.
+#
+# The "chain" side reproduces how telebot used to pick a handler for this bot:
+# walk the registered handlers in order, checking content type, commands and
+# a func predicate that looks the chat up in user_context, followed by the
+# long if/elif over call.data for callbacks. Handlers are no-ops so only the
+# dispatch cost is measured.
+#
+# Usage: python benchmarks/bench_dispatch.py [--number 200000]
+import argparse
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import FlowRouter
+
+STATES = [
+    None, 'handwritten', 'generate_qr', 'read_qr', 'split_range', 'split_range_input',
+    'split_every_x', 'split_every_x_input', 'organize_pdf_start', 'org_remove_input',
+    'org_reorder_input', 'org_extract_input', 'merge_pdfs_collecting', 'merge_pdfs_second',
+    'word_to_pdf', 'pdf_to_word', 'jpg_to_png', 'png_to_jpg', 'remove_bg',
+]
+CALLBACKS = [
+    'main_menu', 'qr_menu', 'generate_qr', 'read_qr', 'split_pdf_menu', 'split_range',
+    'split_every_x', 'organize_pdf_menu', 'remove_bg', 'org_remove', 'org_reorder',
+    'org_extract', 'handwritten', 'merge_pdfs', 'word_to_pdf', 'pdf_to_word',
+]
+
+
+def noop(*args):
+    return None
+
+
+def build_chain(user_context):
+    # (content_types, commands, func) in registration order, as in the old bot.py
+    return [
+        (['text'], ['admin'], None),
+        (['text'], ['stats'], None),
+        (['text'], ['export'], None),
+        (['text'], ['help'], None),
+        (['text'], ['start'], None),
+        (['text'], None, lambda m: m.text == "✍️ Handwritten PDF"),
+        (['text'], None, lambda m: m.text == "📋 Main Menu"),
+        (['text'], None, lambda m: user_context.get(m.chat.id) == 'generate_qr' and m.content_type == 'text'),
+        (['text'], None, lambda m: user_context.get(m.chat.id) in ['split_range_input', 'split_every_x_input']),
+        (['text'], None, lambda m: user_context.get(m.chat.id) in ['org_remove_input', 'org_reorder_input', 'org_extract_input']),
+        (['document'], None, None),
+    ]
+
+
+def chain_dispatch(chain, message):
+    for content_types, commands, func in chain:
+        if message.content_type not in content_types:
+            continue
+        if commands is not None:
+            if not (message.text and message.text.startswith('/') and message.text[1:].split()[0] in commands):
+                continue
+        if func is not None and not func(message):
+            continue
+        return noop(message)
+    return None
+
+
+def chain_callback(data):
+    # Shape of the old handle_menu_selection if/elif ladder
+    if data == 'main_menu':
+        return noop()
+    if data == 'qr_menu':
+        return noop()
+    elif data == 'generate_qr':
+        msg = 1
+    elif data == 'read_qr':
+        msg = 2
+    elif data == 'split_pdf_menu':
+        return noop()
+    elif data == 'split_range':
+        msg = 3
+    elif data == 'split_every_x':
+        msg = 4
+    elif data == 'organize_pdf_menu':
+        msg = 5
+    elif data == 'remove_bg':
+        msg = 6
+    elif data in ['org_remove', 'org_reorder', 'org_extract']:
+        if data == 'org_remove':
+            msg = 7
+        elif data == 'org_reorder':
+            msg = 8
+        elif data == 'org_extract':
+            msg = 9
+        return noop(msg)
+    if data in ['split_range', 'split_every_x']:
+        msg = 10
+    elif data == 'organize_pdf_menu':
+        msg = 11
+    elif data == 'remove_bg':
+        msg = 12
+    else:
+        msg = 13
+    if data == 'handwritten':
+        msg = 14
+    elif data == 'merge_pdfs':
+        msg = 15
+    return noop(msg)
+
+
+def build_router():
+    router = FlowRouter()
+    router.on_keyboard("✍️ Handwritten PDF", "📋 Main Menu")(noop)
+    router.on('generate_qr', 'text')(noop)
+    router.on(['split_range_input', 'split_every_x_input'], 'text')(noop)
+    router.on(['org_remove_input', 'org_reorder_input', 'org_extract_input'], 'text')(noop)
+    for state in STATES:
+        if state is not None:
+            router.on(state, 'document')(noop)
+    router.on_callback(*CALLBACKS)(noop)
+    return router
+
+
+def make_messages(user_context):
+    messages = []
+    for chat_id, state in enumerate(STATES):
+        if state is not None:
+            user_context[chat_id] = state
+        for content_type in ('text', 'document'):
+            messages.append(SimpleNamespace(
+                chat=SimpleNamespace(id=chat_id), content_type=content_type,
+                text="1-5" if content_type == 'text' else None))
+    return messages
+
+
+def report(name, seconds, count):
+    print(f"{name:<28} {seconds / count * 1e9:10.1f} ns/dispatch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dispatch-overhead benchmark")
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    user_context = {}
+    messages = make_messages(user_context)
+    chain = build_chain(user_context)
+    router = build_router()
+    calls = [SimpleNamespace(data=d) for d in CALLBACKS]
+    rounds = max(1, args.number // len(messages))
+    cb_rounds = max(1, args.number // len(calls))
+
+    def run_chain():
+        for m in messages:
+            chain_dispatch(chain, m)
+
+    def run_router():
+        for m in messages:
+            router.dispatch(user_context.get(m.chat.id), m.content_type, m, text=m.text)
+
+    def run_chain_cb():
+        for c in calls:
+            chain_callback(c.data)
+
+    def run_router_cb():
+        for c in calls:
+            router.dispatch_callback(c)
+
+    print(f"Messages: {len(messages)} kinds x {rounds} rounds, callbacks: {len(calls)} kinds x {cb_rounds} rounds")
+    report("messages: predicate chain", timeit.timeit(run_chain, number=rounds), rounds * len(messages))
+    report("messages: FlowRouter", timeit.timeit(run_router, number=rounds), rounds * len(messages))
+    report("callbacks: if/elif ladder", timeit.timeit(run_chain_cb, number=cb_rounds), cb_rounds * len(calls))
+    report("callbacks: FlowRouter", timeit.timeit(run_router_cb, number=cb_rounds), cb_rounds * len(calls))
+
+
+if __name__ == "__main__":
+    main()
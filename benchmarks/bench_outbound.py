@@ -0,0 +1,88 @@
+# Outbound sending against the local fake Bot API (benchmarks/fake_api.py).
+#
+# Simulates --chats chats each receiving a burst of --messages replies
+# followed by several "main menu" messages, sent from --threads handler
+# threads. Runs twice: with plain TeleBot (one synchronous HTTP call per
+# send, 429s surface as errors) and with OutboundTeleBot (pooled session,
+# paced queue, retry_after backoff, menu coalescing), and reports delivery,
+# flood responses and wall time.
+#
+# Usage: python benchmarks/bench_outbound.py [--chats 20] [--messages 5] [--latency 0.05] [--flood-rate 0.02]
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot
+from telebot import apihelper
+
+from benchmarks.fake_api import FakeBotAPI
+from outbound import OutboundSender, OutboundTeleBot, pooled_session
+
+TOKEN = "123456:FAKE"
+MENUS_PER_CHAT = 3
+
+
+def run(api, bot, args):
+    errors = []
+    futures = []
+
+    def chat_session(chat_id):
+        for i in range(args.messages):
+            try:
+                futures.append(bot.send_message(chat_id, f"reply {i}"))
+            except Exception as e:
+                errors.append(e)
+        for _ in range(MENUS_PER_CHAT):
+            try:
+                futures.append(bot.send_message(chat_id, "menu", coalesce='menu')
+                               if isinstance(bot, OutboundTeleBot) else bot.send_message(chat_id, "menu"))
+            except Exception as e:
+                errors.append(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        wait([pool.submit(chat_session, 1000 + c) for c in range(args.chats)])
+    for future in futures:
+        if hasattr(future, 'result'):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+    elapsed = time.perf_counter() - start
+    delivered = sum(len(v) for v in api.delivered.values())
+    return elapsed, delivered, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outbound sender vs. direct sends on a fake Bot API")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--flood-rate", type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'time s':>7} {'delivered':>9} {'errors':>6} {'429s':>5}")
+    for mode in ("direct", "outbound"):
+        api = FakeBotAPI(latency=args.latency, flood_rate=args.flood_rate, retry_after=1)
+        api.start()
+        apihelper.API_URL = api.api_url
+        if mode == "direct":
+            apihelper.session = None
+            bot = telebot.TeleBot(TOKEN, threaded=False)
+        else:
+            apihelper.session = pooled_session(args.threads * 2)
+            sender = OutboundSender(workers=args.threads)
+            sender.start()
+            bot = OutboundTeleBot(TOKEN, sender, threaded=False)
+        elapsed, delivered, errors = run(api, bot, args)
+        print(f"{mode:>10} {elapsed:7.2f} {delivered:9d} {errors:6d} {api.floods:5d}")
+        api.stop()
+
+
+if __name__ == "__main__":
+    main()
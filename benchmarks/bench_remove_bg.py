@@ -0,0 +1,81 @@
+# Quality/speed comparison of the fast background removal path against
+# full-resolution rembg.
+#
+# For each fixture size, runs remove_bg (mask only, full resolution) as the
+# reference and remove_bg_fast at several proxy sizes, then reports time per
+# image, speed-up and how far the fast alpha mask is from the reference
+# (mean absolute error in alpha levels, and IoU of the masks thresholded at
+# 50%).
+#
+# Usage: python benchmarks/bench_remove_bg.py [--sizes 2000x1500 4000x3000] [--proxies 512 1024]
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fixtures
+import processing
+
+
+def encode_jpeg(array):
+    out = io.BytesIO()
+    Image.fromarray(array).save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def decode_mask(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('L'), dtype=np.float32)
+
+
+def timed(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def compare(reference, mask):
+    mae = float(np.abs(reference - mask).mean())
+    ref_fg, fg = reference >= 128, mask >= 128
+    union = np.logical_or(ref_fg, fg).sum()
+    iou = float(np.logical_and(ref_fg, fg).sum() / union) if union else 1.0
+    return mae, iou
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", default=["2000x1500", "4000x3000"])
+    parser.add_argument("--proxies", nargs="+", type=int, default=[512, 1024])
+    parser.add_argument("--repeats", type=int, default=2)
+    args = parser.parse_args()
+
+    # Load the model before timing anything
+    processing.get_rembg_session()
+
+    print(f"{'size':>10} {'mode':>12} {'s/image':>8} {'speed-up':>8} {'alpha MAE':>9} {'IoU':>6}")
+    for i, size in enumerate(args.sizes):
+        width, height = map(int, size.split('x'))
+        data = encode_jpeg(fixtures.make_image_array(width, height, seed=20 + i))
+
+        full_time, full_mask = timed(lambda: processing.remove_bg(data, mask_only=True), args.repeats)
+        reference = decode_mask(full_mask)
+        print(f"{size:>10} {'full':>12} {full_time:8.2f} {1.0:8.1f}x {0.0:9.2f} {1.0:6.3f}")
+
+        for proxy in args.proxies:
+            fast_time, fast_mask = timed(
+                lambda: processing.remove_bg_fast(data, mask_only=True, proxy_side=proxy), args.repeats)
+            mae, iou = compare(reference, decode_mask(fast_mask))
+            print(f"{size:>10} {f'fast@{proxy}':>12} {fast_time:8.2f} {full_time / fast_time:8.1f}x {mae:9.2f} {iou:6.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Local load test for the sharded deployment mode.
+#
+# Routes synthetic updates for many chats through ShardPool to N worker
+# processes running a CPU-bound stand-in handler (pure Python, holds the
+# GIL), for N = 1..--max-workers. Each handled update sends an analytics row
+# back to the front process, so the single-writer path is exercised too
+# (rows are written to a throwaway SQLite database).
+#
+# Usage: python benchmarks/bench_sharding.py [--updates 400] [--work 20000] [--max-workers 4]
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sharding import ShardPool
+
+
+def cpu_work(iterations):
+    total = 0
+    for i in range(iterations):
+        total += (i * i) % 7
+    return total
+
+
+def worker_main(shard_id, inbox, analytics_queue):
+    while True:
+        update = inbox.get()
+        if update is None:
+            break
+        cpu_work(update["work"])
+        analytics_queue.put((update["message"]["chat"]["id"], shard_id, update["update_id"]))
+
+
+class CountingSink:
+    def __init__(self, db_path, expected):
+        self.db_path = db_path
+        self.expected = expected
+        self.count = 0
+        self.done = threading.Event()
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rows (chat_id INTEGER, shard INTEGER, update_id INTEGER)")
+        conn.commit()
+        conn.close()
+
+    def __call__(self, rows):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.executemany("INSERT INTO rows VALUES (?, ?, ?)", rows)
+        conn.commit()
+        conn.close()
+        self.count += len(rows)
+        if self.count >= self.expected:
+            self.done.set()
+
+
+def run(workers, updates, work, chats, db_path):
+    sink = CountingSink(db_path, updates)
+    pool = ShardPool(workers, worker_main, sink=sink, flush_interval=0.05)
+    pool.start()
+    # Let the children finish importing before the clock starts
+    time.sleep(0.5)
+    start = time.perf_counter()
+    for i in range(updates):
+        chat_id = 1000 + (i % chats)
+        pool.route({"update_id": i, "message": {"chat": {"id": chat_id}}, "work": work})
+    sink.done.wait()
+    elapsed = time.perf_counter() - start
+    balance = ", ".join(str(n) for n in pool.routed)
+    pool.stop()
+    return updates / elapsed, balance
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded worker throughput")
+    parser.add_argument("--updates", type=int, default=400)
+    parser.add_argument("--work", type=int, default=20000, help="Loop iterations per update")
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f"{'workers':>7} {'updates/s':>10} {'speedup':>8}  routed per shard")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in range(1, args.max_workers + 1):
+            rate, balance = run(workers, args.updates, args.work, args.chats,
+                                os.path.join(tmp, f"analytics_{workers}.db"))
+            baseline = baseline or rate
+            print(f"{workers:>7} {rate:>10.1f} {rate / baseline:>7.2f}x  [{balance}]")
+
+
+if __name__ == "__main__":
+    main()
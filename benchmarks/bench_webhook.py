@@ -0,0 +1,128 @@
+# Update-to-reply latency: long polling vs. webhook + worker pool.
+#
+# Both sides get the same synthetic arrival stream and the same handler
+# (sleep --work ms, standing in for a reply round-trip plus light work).
+#  - polling: one consumer calls a getUpdates stand-in (one --rtt round trip
+#    per call, returning everything queued) and handles updates serially,
+#    which is how a single infinity_polling process consumes updates.
+#  - webhook: each update is POSTed over real local HTTP to WebhookServer,
+#    acknowledged immediately and handled on a pool of --workers threads.
+# Latency is measured from arrival to handler completion.
+#
+# Usage: python benchmarks/bench_webhook.py [--updates 300] [--rate 50] [--work 20]
+import argparse
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.replay_updates import post
+from webhook import WebhookServer
+
+
+def arrivals(count, rate):
+    interval = 1.0 / rate
+    for i in range(count):
+        yield i, interval
+
+
+def summarize(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{name:<10} n={len(latencies)} p50={statistics.median(latencies) * 1000:8.1f}ms "
+          f"p95={p95 * 1000:8.1f}ms max={latencies[-1] * 1000:8.1f}ms "
+          f"throughput={len(latencies) / elapsed:6.1f}/s")
+
+
+def run_polling(count, rate, work, rtt):
+    pending = queue.Queue()
+    latencies = []
+    done = threading.Event()
+
+    def consumer():
+        handled = 0
+        while handled < count:
+            # getUpdates round trip; returns whatever is queued (or waits)
+            time.sleep(rtt)
+            batch = [pending.get()]
+            while True:
+                try:
+                    batch.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            for arrived in batch:
+                time.sleep(work)
+                latencies.append(time.perf_counter() - arrived)
+                handled += 1
+        done.set()
+
+    start = time.perf_counter()
+    threading.Thread(target=consumer, daemon=True).start()
+    for _, interval in arrivals(count, rate):
+        pending.put(time.perf_counter())
+        time.sleep(interval)
+    done.wait()
+    summarize("polling", latencies, time.perf_counter() - start)
+
+
+def run_webhook(count, rate, work, workers):
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def on_update(update):
+        time.sleep(work)
+        with lock:
+            latencies.append(time.perf_counter() - update["arrived"])
+            if len(latencies) == count:
+                done.set()
+
+    server = WebhookServer(on_update, port=0, secret_token="bench", workers=workers)
+    server.start()
+    url = f"http://127.0.0.1:{server.port}/webhook"
+
+    # Telegram delivers webhook updates concurrently; use a few senders
+    start = time.perf_counter()
+    send_queue = queue.Queue()
+
+    def sender():
+        while True:
+            update = send_queue.get()
+            if update is None:
+                return
+            post(url, update, "bench")
+
+    senders = [threading.Thread(target=sender, daemon=True) for _ in range(8)]
+    for t in senders:
+        t.start()
+    for i, interval in arrivals(count, rate):
+        send_queue.put({"update_id": i, "arrived": time.perf_counter()})
+        time.sleep(interval)
+    done.wait()
+    elapsed = time.perf_counter() - start
+    for _ in senders:
+        send_queue.put(None)
+    server.stop()
+    summarize("webhook", latencies, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Polling vs webhook latency")
+    parser.add_argument("--updates", type=int, default=300)
+    parser.add_argument("--rate", type=float, default=50.0, help="Arriving updates per second")
+    parser.add_argument("--work", type=float, default=20.0, help="Handler time in ms")
+    parser.add_argument("--rtt", type=float, default=50.0, help="getUpdates round trip in ms")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{args.updates} updates at {args.rate}/s, handler {args.work}ms, getUpdates RTT {args.rtt}ms")
+    run_polling(args.updates, args.rate, args.work / 1000, args.rtt / 1000)
+    run_webhook(args.updates, args.rate, args.work / 1000, args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Local stand-in for the Telegram Bot API, for exercising the outbound
+# sender without touching Telegram.
+#
+# Answers any /bot<token>/<method> call with a plausible result after
+# --latency seconds. It enforces a per-chat flood limit the way Telegram
+# does (more than `chat_burst` messages inside `chat_window` seconds -> 429
+# with retry_after) and can inject random 429s on top.
+#
+# Point telebot at it with:
+#   telebot.apihelper.API_URL = "http://127.0.0.1:<port>/bot{0}/{1}"
+#
+# Usage: python benchmarks/fake_api.py [--port 8081] [--latency 0.05] [--flood-rate 0.02]
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, flood_rate=0.0,
+                 retry_after=1, chat_burst=3, chat_window=1.0, seed=0):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_burst = chat_burst
+        self.chat_window = chat_window
+        self.calls = defaultdict(int)
+        self.delivered = defaultdict(list)
+        self.floods = 0
+        self._recent = defaultdict(deque)
+        self._blocked_until = {}
+        self._message_id = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self.api_url = f"http://{host}:{self.port}/bot{{0}}/{{1}}"
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length", "0"))
+                body = self.rfile.read(length) if length else b""
+                if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+                status, payload = api.respond(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, method, params):
+        time.sleep(self.latency)
+        chat_id = params.get("chat_id")
+        now = time.monotonic()
+        with self._lock:
+            self.calls[method] += 1
+            if chat_id is not None and method.startswith(("send", "edit")):
+                recent = self._recent[chat_id]
+                while recent and now - recent[0] > self.chat_window:
+                    recent.popleft()
+                flooded = (self._blocked_until.get(chat_id, 0) > now
+                           or len(recent) >= self.chat_burst
+                           or self._rng.random() < self.flood_rate)
+                if flooded:
+                    self.floods += 1
+                    self._blocked_until[chat_id] = now + self.retry_after
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {self.retry_after}",
+                                 "parameters": {"retry_after": self.retry_after}}
+                recent.append(now)
+                self.delivered[chat_id].append((now, params.get("text")))
+            self._message_id += 1
+            message_id = self._message_id
+        if method in ("getMe",):
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+        if method == "sendMediaGroup":
+            result = [self._message(message_id, chat_id, None)]
+        else:
+            result = self._message(message_id, chat_id, params.get("text"))
+        return 200, {"ok": True, "result": result}
+
+    @staticmethod
+    def _message(message_id, chat_id, text):
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": int(chat_id or 0), "type": "private"}}
+        if text is not None:
+            message["text"] = text
+        return message
+
+    def start(self):
+        thread = threading.Thread(target=self._httpd.serve_forever, name="fake-bot-api", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+    api = FakeBotAPI(port=args.port, latency=args.latency, flood_rate=args.flood_rate,
+                     retry_after=args.retry_after)
+    print(f"Fake Bot API on {api.api_url.format('<token>', '<method>')}")
+    api._httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import random
+
+import numpy as np
+from fpdf import FPDF
+from PIL import Image
+
+from processing import generate_qr
+
+# Deterministic synthetic inputs for the benchmarks. The same (size, seed)
+# always produces the same content, so runs are comparable across machines
+# and commits.
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog lorem ipsum dolor sit amet "
+    "consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+    "et dolore magna aliqua handwritten notes assignment chapter summary"
+).split()
+
+
+def make_lines(count, seed=0, min_words=4, max_words=14):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        # Roughly one blank line per paragraph, like real notes
+        if i % 12 == 11:
+            lines.append("")
+            continue
+        lines.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))))
+    return lines
+
+
+def make_text(path, lines, seed=0):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(make_lines(lines, seed)))
+    return path
+
+
+def make_pdf(path, pages, seed=0, lines_per_page=40):
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=False)
+    pdf.set_font("Arial", size=11)
+    lines = make_lines(pages * lines_per_page, seed)
+    for page in range(pages):
+        pdf.add_page()
+        pdf.cell(0, 8, f"Page {page + 1}", 0, 1)
+        for line in lines[page * lines_per_page:(page + 1) * lines_per_page]:
+            pdf.cell(0, 6, line, 0, 1)
+    pdf.output(path)
+    return path
+
+
+def make_image_array(width, height, seed=0):
+    # Smooth background with a textured foreground blob: compresses like a
+    # photo and gives background removal something to segment
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    background = np.stack([
+        120 + 60 * np.sin(x / width * 3.1),
+        140 + 50 * np.cos(y / height * 2.3),
+        160 + 40 * np.sin((x + y) / (width + height) * 4.7),
+    ], axis=-1)
+    cx, cy = width * 0.5, height * 0.55
+    radius = min(width, height) * 0.3
+    mask = ((x - cx) ** 2 + (y - cy) ** 2) < radius ** 2
+    foreground = np.stack([200 - 80 * (y / height), 60 + 40 * (x / width), 40 + 0 * x], axis=-1)
+    img = np.where(mask[..., None], foreground, background)
+    img += rng.normal(0, 6, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_image(path, width, height, seed=0):
+    Image.fromarray(make_image_array(width, height, seed)).save(path)
+    return path
+
+
+def make_qr_image(path, text="https://example.com/benchmark"):
+    generate_qr(text, path)
+    return path
+
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
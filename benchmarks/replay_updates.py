@@ -0,0 +1,100 @@
+# POST recorded Telegram updates to a locally running webhook server.
+#
+# Start the bot with BOT_MODE=webhook (plus WEBHOOK_URL / WEBHOOK_SECRET), then:
+#   python benchmarks/replay_updates.py http://127.0.0.1:8443/webhook \
+#       --secret $WEBHOOK_SECRET benchmarks/updates/sample_updates.jsonl
+#
+# Files may hold one update, a JSON list of updates, or one update per line.
+# --chats N rewrites chat/user ids to fan the same updates out over N chats.
+import argparse
+import copy
+import json
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def load_updates(paths):
+    updates = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read().strip()
+        if content.startswith('['):
+            updates.extend(json.loads(content))
+        elif '\n' in content:
+            updates.extend(json.loads(line) for line in content.splitlines() if line.strip())
+        else:
+            updates.append(json.loads(content))
+    return updates
+
+
+def retarget(update, chat_id, update_id):
+    # Point every chat/user reference at chat_id so the update is routed as
+    # if it came from a different user
+    update = copy.deepcopy(update)
+    update["update_id"] = update_id
+    stack = [update]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key in ("chat", "from"):
+                inner = node.get(key)
+                if isinstance(inner, dict) and not inner.get("is_bot"):
+                    inner["id"] = chat_id
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return update
+
+
+def post(url, update, secret=None):
+    body = json.dumps(update).encode('utf-8')
+    request = urllib.request.Request(url, data=body, method="POST",
+                                     headers={"Content-Type": "application/json"})
+    if secret:
+        request.add_header(SECRET_HEADER, secret)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a webhook")
+    parser.add_argument("url")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--chats", type=int, default=1, help="Fan updates out over this many chat ids")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait between POSTs")
+    args = parser.parse_args()
+
+    updates = load_updates(args.files)
+    acks = []
+    statuses = {}
+    update_id = int(time.time())
+    for chat in range(args.chats):
+        for update in updates:
+            update_id += 1
+            if args.chats > 1:
+                update = retarget(update, 10_000_000 + chat, update_id)
+            status, seconds = post(args.url, update, args.secret)
+            statuses[status] = statuses.get(status, 0) + 1
+            acks.append(seconds)
+            if args.delay:
+                time.sleep(args.delay)
+
+    print(f"Sent {len(acks)} updates: " + ", ".join(f"HTTP {k}: {v}" for k, v in sorted(statuses.items())))
+    if acks:
+        print(f"Ack latency: p50={statistics.median(acks) * 1000:.1f}ms max={max(acks) * 1000:.1f}ms")
+    return 0 if set(statuses) == {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
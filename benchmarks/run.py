@@ -0,0 +1,353 @@
+# Offline benchmark suite for the bot's processing functions.
+#
+# Imports processing.py only: no Telegram token, no polling. Inputs are
+# generated deterministically into a temporary directory.
+#
+# Usage:
+#   python -m benchmarks.run                     # run everything
+#   python -m benchmarks.run --quick             # smaller inputs, fewer repeats
+#   python -m benchmarks.run --only merge split  # substring filter
+#   python -m benchmarks.run --save              # store results as the baseline
+#   python -m benchmarks.run --compare           # fail on regressions vs. baseline
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fixtures
+from metrics import peak_rss_bytes
+import output_plan
+import processing
+import rasterize
+import templates
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# name -> setup(workdir, scale) returning (fn, units, unit_name)
+BENCHMARKS = {}
+
+
+def benchmark(name, repeats=5):
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, repeats)
+        return setup
+    return decorator
+
+
+def scaled(value, scale, minimum=1):
+    return max(minimum, int(value * scale))
+
+
+@benchmark("create_handwritten_pdf", repeats=3)
+def bench_handwritten(workdir, scale):
+    lines = scaled(2500, scale)
+    text = "\n".join(fixtures.make_lines(lines, seed=1))
+    out = os.path.join(workdir, "handwritten.pdf")
+    pages = -(-lines // processing.LINES_PER_PAGE)
+    return (lambda: processing.create_handwritten_pdf(text, out)), pages, "pages"
+
+
+@benchmark("create_handwritten_pdf_realistic", repeats=3)
+def bench_handwritten_realistic(workdir, scale):
+    lines = scaled(2500, scale)
+    text = "\n".join(fixtures.make_lines(lines, seed=1))
+    out = os.path.join(workdir, "handwritten.pdf")
+    pages = -(-lines // processing.LINES_PER_PAGE)
+    effects = processing.HANDWRITING_EFFECTS
+    return (lambda: processing.create_handwritten_pdf(text, out, effects)), pages, "pages"
+
+
+@benchmark("create_handwritten_pdf_template", repeats=3)
+def bench_handwritten_template(workdir, scale):
+    lines = scaled(2500, scale)
+    text = "\n".join(fixtures.make_lines(lines, seed=1))
+    out = os.path.join(workdir, "handwritten.pdf")
+    pages = -(-lines // processing.LINES_PER_PAGE)
+    photo = fixtures.make_image(os.path.join(workdir, "paper.jpg"), 2480, 3508, seed=12)
+    template = templates.prepare_template(photo, os.path.join(workdir, "paper.png"))
+    cache = templates.TemplateCache()
+    return (lambda: processing.create_handwritten_pdf(text, out, background=cache.get(template))), pages, "pages"
+
+
+@benchmark("merge_pdfs")
+def bench_merge(workdir, scale):
+    pages = scaled(50, scale)
+    a = fixtures.make_pdf(os.path.join(workdir, "a.pdf"), pages, seed=2)
+    b = fixtures.make_pdf(os.path.join(workdir, "b.pdf"), pages, seed=3)
+    out = os.path.join(workdir, "merged.pdf")
+    return (lambda: processing.merge_pdfs([a, b], out)), 2 * pages, "pages"
+
+
+@benchmark("split_pdf_range")
+def bench_split_range(workdir, scale):
+    pages = scaled(200, scale, 2)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=4)
+    out = os.path.join(workdir, "range.pdf")
+    end = pages // 2
+    return (lambda: processing.split_pdf_range(src, out, 1, end)), end, "pages"
+
+
+@benchmark("split_pdf_every_x")
+def bench_split_every_x(workdir, scale):
+    pages = scaled(200, scale, 2)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=5)
+    out_dir = os.path.join(workdir, "parts")
+    os.makedirs(out_dir, exist_ok=True)
+    return (lambda: processing.split_pdf_every_x(src, out_dir, 10)), pages, "pages"
+
+
+@benchmark("write_pdf_parts")
+def bench_write_pdf_parts(workdir, scale):
+    # Size estimation plus writing a PDF as parts of a quarter of its size
+    pages = scaled(200, scale, 2)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=5)
+    out_dir = os.path.join(workdir, "parts")
+    os.makedirs(out_dir, exist_ok=True)
+    limit = os.path.getsize(src) // 4
+
+    def run():
+        return list(output_plan.write_pdf_parts(output_plan.estimate_pages([src]), out_dir, "src", limit))
+    return run, pages, "pages"
+
+
+@benchmark("organize_pdf")
+def bench_organize(workdir, scale):
+    pages = scaled(200, scale, 2)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=6)
+    out = os.path.join(workdir, "organized.pdf")
+    order = list(range(pages, 0, -1))
+    return (lambda: processing.organize_pdf(src, out, order)), pages, "pages"
+
+
+@benchmark("generate_qr", repeats=20)
+def bench_generate_qr(workdir, scale):
+    out = os.path.join(workdir, "qr.png")
+    return (lambda: processing.generate_qr("https://example.com/benchmark?id=42", out)), 1, "codes"
+
+
+@benchmark("read_qr", repeats=20)
+def bench_read_qr(workdir, scale):
+    src = fixtures.make_qr_image(os.path.join(workdir, "qr.png"))
+    return (lambda: processing.read_qr(src)), 1, "codes"
+
+
+@benchmark("jpg_to_png")
+def bench_jpg_to_png(workdir, scale):
+    w, h = scaled(4000, scale ** 0.5, 64), scaled(3000, scale ** 0.5, 64)
+    src = fixtures.make_image(os.path.join(workdir, "photo.jpg"), w, h, seed=7)
+    out = os.path.join(workdir, "photo.png")
+    return (lambda: processing.jpg_to_png(src, out)), w * h / 1e6, "MP"
+
+
+@benchmark("png_to_jpg")
+def bench_png_to_jpg(workdir, scale):
+    w, h = scaled(4000, scale ** 0.5, 64), scaled(3000, scale ** 0.5, 64)
+    src = fixtures.make_image(os.path.join(workdir, "photo.png"), w, h, seed=8)
+    out = os.path.join(workdir, "photo.jpg")
+    return (lambda: processing.png_to_jpg(src, out)), w * h / 1e6, "MP"
+
+
+@benchmark("pdf_to_word", repeats=2)
+def bench_pdf_to_word(workdir, scale):
+    pages = scaled(10, scale)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=9)
+    out = os.path.join(workdir, "out.docx")
+    return (lambda: processing.pdf_to_word(src, out)), pages, "pages"
+
+
+@benchmark("remove_bg", repeats=2)
+def bench_remove_bg(workdir, scale):
+    w, h = scaled(2000, scale ** 0.5, 64), scaled(1500, scale ** 0.5, 64)
+    src = fixtures.make_image(os.path.join(workdir, "photo.jpg"), w, h, seed=10)
+    with open(src, 'rb') as f:
+        data = f.read()
+    return (lambda: processing.remove_bg(data)), w * h / 1e6, "MP"
+
+
+@benchmark("remove_bg_fast", repeats=2)
+def bench_remove_bg_fast(workdir, scale):
+    w, h = scaled(4000, scale ** 0.5, 64), scaled(3000, scale ** 0.5, 64)
+    src = fixtures.make_image(os.path.join(workdir, "photo.jpg"), w, h, seed=10)
+    with open(src, 'rb') as f:
+        data = f.read()
+    return (lambda: processing.remove_bg_fast(data)), w * h / 1e6, "MP"
+
+
+@benchmark("images_to_pdf_album", repeats=3)
+def bench_images_to_pdf(workdir, scale):
+    # A 20-photo album of 12 MP phone JPEGs, as received from Telegram
+    count = scaled(20, scale)
+    images = []
+    for i in range(count):
+        path = fixtures.make_image(os.path.join(workdir, f"photo{i}.jpg"), 4000, 3000, seed=100 + i)
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return (lambda: processing.images_to_pdf(images, 'a4')), count, "images"
+
+
+@benchmark("pdf_to_images", repeats=3)
+def bench_pdf_to_images(workdir, scale):
+    pages = scaled(40, scale, 2)
+    src = fixtures.make_pdf(os.path.join(workdir, "src.pdf"), pages, seed=11)
+    out_dir = os.path.join(workdir, "pages")
+    os.makedirs(out_dir, exist_ok=True)
+
+    def run():
+        for path in rasterize.pdf_to_images(src, out_dir, dpi=150):
+            os.remove(path)
+    return run, pages, "pages"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def run_one(name, setup, repeats, scale):
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        fn, units, unit_name = setup(workdir, scale)
+        # Warm-up run (imports, model loading, font caches)
+        fn()
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+
+        # Separate traced run: tracemalloc slows things down, so it is not timed
+        tracemalloc.start()
+        fn()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        p50 = statistics.median(timings)
+        return {
+            "repeats": repeats,
+            "mean_s": statistics.fmean(timings),
+            "p50_s": p50,
+            "p95_s": percentile(timings, 0.95),
+            "min_s": min(timings),
+            "units": units,
+            "unit": unit_name,
+            "throughput": units / p50 if p50 else 0.0,
+            "py_peak_mb": traced_peak / 1e6,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_isolated(name, repeats, scale):
+    # Runs in a fresh process per benchmark: ru_maxrss is a high-water mark
+    # for the whole process, so it only describes one benchmark if nothing
+    # else ran there before it
+    setup, _ = BENCHMARKS[name]
+    result = run_one(name, setup, repeats, scale)
+    result["rss_peak_mb"] = peak_rss_bytes() / 1e6
+    return result
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'benchmark':<24} {'p50 base':>10} {'p50 now':>10} {'delta':>8} {'mem delta':>10}")
+    for name, current in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base or "error" in base or "error" in current:
+            continue
+        delta = current["p50_s"] / base["p50_s"] - 1 if base["p50_s"] else 0.0
+        mem_delta = current["py_peak_mb"] / base["py_peak_mb"] - 1 if base["py_peak_mb"] else 0.0
+        flag = ""
+        if delta > tolerance or mem_delta > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<24} {base['p50_s']:>9.3f}s {current['p50_s']:>9.3f}s {delta:>+7.1%} {mem_delta:>+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for bot operations")
+    parser.add_argument("--only", nargs="*", help="Run benchmarks whose name contains any of these")
+    parser.add_argument("--quick", action="store_true", help="Smaller inputs and fewer repeats")
+    parser.add_argument("--scale", type=float, default=None, help="Input size multiplier (default 1, quick 0.1)")
+    parser.add_argument("--repeats", type=int, default=None, help="Override repeats for every benchmark")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON path")
+    parser.add_argument("--save", action="store_true", help="Save results as the new baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare against the baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown / memory growth (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    scale = args.scale if args.scale is not None else (0.1 if args.quick else 1.0)
+    selected = [
+        name for name in BENCHMARKS
+        if not args.only or any(part in name for part in args.only)
+    ]
+
+    results = {}
+    print(f"{'benchmark':<24} {'p50':>9} {'p95':>9} {'throughput':>18} {'py peak':>9} {'rss':>8}")
+    # spawn, and not a daemonic Pool worker, so benchmarks that start their
+    # own processes (pdf_to_images) still can
+    context = multiprocessing.get_context('spawn')
+    for name in selected:
+        setup, repeats = BENCHMARKS[name]
+        if args.repeats:
+            repeats = args.repeats
+        elif args.quick:
+            repeats = max(1, repeats // 2)
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                r = pool.submit(run_isolated, name, repeats, scale).result()
+        except Exception as e:
+            results[name] = {"error": str(e)}
+            print(f"{name:<24} ERROR: {e}")
+            continue
+        results[name] = r
+        print(f"{name:<24} {r['p50_s']:>8.3f}s {r['p95_s']:>8.3f}s "
+              f"{r['throughput']:>11.1f} {r['unit']:<4}/s {r['py_peak_mb']:>7.1f}MB {r['rss_peak_mb']:>6.0f}MB")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": scale,
+        "results": results,
+    }
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            print(f"\nNo baseline at {args.baseline}; run with --save first.")
+            exit_code = 2
+        else:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+            if baseline.get("scale") != scale:
+                print(f"\n⚠️ Baseline was recorded at scale {baseline.get('scale')}, this run uses {scale}.")
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print(f"\n❌ Regressions: {', '.join(regressions)}")
+                exit_code = 1
+            else:
+                print("\n✅ No regressions")
+
+    if args.save:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
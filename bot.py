@@ -4,21 +4,34 @@ import telebot
 import time
 import datetime
 import sqlite3
-from telebot import types
-from fpdf import FPDF
-from PIL import Image, ImageDraw, ImageFont
-from docx2pdf import convert
-from pdf2docx import Converter
-from PyPDF2 import PdfReader, PdfWriter, PdfMerger
+from telebot import types, apihelper
+from PyPDF2 import PdfReader
 import sys
-import cv2
-import numpy as np
 from dotenv import load_dotenv
 import logging
-import io
-import qrcode
-import zipfile
-from rembg import remove
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from processing import (
+    layout_handwritten_pages, render_handwritten_pdf, handwriting_seed, HANDWRITING_EFFECTS, merge_pdfs, generate_qr, read_qr, split_pdf_range,
+    organize_pdf, word_to_pdf, pdf_to_word, jpg_to_png,
+    png_to_jpg, remove_bg_batch, images_to_pdf
+)
+from state_store import StateStore, start_sweeper
+from scratch import job_scratch, Janitor
+from router import FlowRouter
+from scheduler import FairScheduler, RateLimited, estimate_cost
+from metrics import metrics, start_http_server
+from profiling import Profiler, MODES as PROFILE_MODES
+from webhook import WebhookServer
+from sharding import ShardPool
+from albums import AlbumCollector
+from templates import TemplateCache, prepare_template
+from outbound import OutboundSender, OutboundTeleBot, pooled_session
+from progress import JobRegistry, JobCancelled
+from rasterize import pdf_to_images, page_count as pdf_total_pages
+from jobqueue import JobStore
+from output_plan import OutputPlan, ZipVolumes, estimate_pages, write_pdf_parts, SEND, SPLIT, UPLOAD_LIMIT
 
 # Load environment variables
 load_dotenv()
@@ -39,38 +52,184 @@ if not TOKEN:
     logger.error("TELEGRAM_TOKEN not found in .env file")
     sys.exit("Error: TELEGRAM_TOKEN not found. Please create a .env file.")
 
-bot = telebot.TeleBot(TOKEN)
+# All Bot API calls share one keep-alive connection pool, and sends go
+# through a paced queue that retries on flood waits (see outbound.py).
+# The global rate is Telegram's limit for the whole bot, so shard workers
+# each get an equal share of it; a chat always lands on the same shard, so
+# the per-chat rate needs no split.
+apihelper.session = pooled_session(int(os.getenv("API_POOL_SIZE", "16")))
+sender = OutboundSender(
+    workers=int(os.getenv("OUTBOUND_WORKERS", "4")),
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")) / int(os.getenv("SHARD_COUNT", "1")),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+    chat_burst=int(os.getenv("OUTBOUND_CHAT_BURST", "3")),
+    max_retries=int(os.getenv("OUTBOUND_MAX_RETRIES", "5"))
+)
+bot = OutboundTeleBot(TOKEN, sender)
 
-FONT_PATH = os.path.join(os.path.dirname(__file__), "QECarolineMutiboko.ttf")
 OUTPUT_DIR = "output"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-LINES_PER_PAGE = 25
-FONT_SIZE = 20
-PAGE_WIDTH, PAGE_HEIGHT = 595, 842
-MARGIN = 50
-LINE_HEIGHT = 30
-MAX_LINE_WIDTH = PAGE_WIDTH - (2 * MARGIN)
+# Set by the front process when running as one of several shard workers
+# (see run_sharded); each shard owns its own uploads, scratch and state
+SHARD_ID = os.getenv("SHARD_ID")
+SHARD_SUFFIX = f"_shard{SHARD_ID}" if SHARD_ID is not None else ""
+
+# Where uploads are downloaded to
+UPLOAD_DIR = os.path.join(OUTPUT_DIR, f"shard{SHARD_ID}") if SHARD_ID is not None else OUTPUT_DIR
+
+# Every job gets its own scratch directory under SCRATCH_DIR, removed when the
+# job ends. Point this at a tmpfs mount (e.g. /dev/shm/telegram_bot) if desired.
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", os.path.join(OUTPUT_DIR, "jobs"))
+if SHARD_ID is not None:
+    SCRATCH_DIR = os.path.join(SCRATCH_DIR, f"shard{SHARD_ID}")
 
-user_context = {}
-user_temp_files = {}
-user_settings = {}
-user_states = {}  # To track user states for screenshot editing
-user_templates = {}  # To store custom templates uploaded by users
+# Users' page backgrounds for handwritten output, already decoded and resized
+# to the page size. Kept outside OUTPUT_DIR so the janitor never touches them.
+TEMPLATES_DIR = os.getenv("TEMPLATES_DIR", "templates")
 
 # Create a new directory for logs and database
 LOGS_DIR = "logs"
 DB_PATH = os.path.join(LOGS_DIR, "user_data.db")
-os.makedirs(LOGS_DIR, exist_ok=True)
+
+def shard_path(path):
+    # Each shard keeps its own copy of a per-chat database, whether the path
+    # is the default or configured: state.db -> state_shard0.db
+    if not path or SHARD_ID is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}{SHARD_SUFFIX}{ext}"
+
+# Conversation state is bounded (TTL + LRU) and written through to SQLite so
+# in-flight flows such as a half-finished merge survive a restart.
+# Set STATE_DB_PATH to an empty string to keep state in memory only.
+STATE_DB_PATH = shard_path(os.getenv("STATE_DB_PATH", os.path.join(LOGS_DIR, "state.db"))) or None
+STATE_TTL = int(os.getenv("STATE_TTL", "3600"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+
+def release_temp_files(chat_id, paths):
+    # Called when an abandoned flow expires or is evicted
+    for path in paths:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            logger.error(f"Error removing expired temp file {path}: {str(e)}")
+
+def new_state_store(name, ttl=STATE_TTL, on_expire=None):
+    return StateStore(name, ttl=ttl, max_entries=STATE_MAX_ENTRIES,
+                      db_path=STATE_DB_PATH, on_expire=on_expire)
+
+# The stores are opened by init_runtime(); user_states tracks user states
+# for screenshot editing
+user_context = user_temp_files = user_settings = user_states = None
+# Decoded templates, so a render copies a ready bitmap instead of decoding.
+# Created before user_templates, whose expiries already fire while it loads.
+template_cache = TemplateCache(max_bytes=int(os.getenv("TEMPLATE_CACHE_BYTES", str(64 * 1024 * 1024))))
+
+def release_template(chat_id, template):
+    release_temp_files(chat_id, [template["path"]])
+    template_cache.invalidate(template["path"])
+
+# chat_id -> {"path": ..., "name": ...} of the user's handwriting background
+user_templates = None
+
+# Background janitor enforcing age and size quotas on everything we write.
+# Files still referenced by an in-flight flow are never touched.
+def protected_temp_files():
+    return [path for paths in user_temp_files.values() for path in paths]
+
+janitor = Janitor(
+    [UPLOAD_DIR, SCRATCH_DIR],
+    max_age=int(os.getenv("JANITOR_MAX_AGE", str(2 * STATE_TTL))),
+    max_bytes=int(os.getenv("JANITOR_MAX_BYTES", str(1024 ** 3))),
+    interval=int(os.getenv("JANITOR_INTERVAL", "300")),
+    protect=protected_temp_files
+)
+
+# Jobs run on a two-lane fair scheduler: cheap work (menus, QR, small images)
+# never waits behind heavy renders, and users share capacity round robin.
+# Queues are keyed by chat_id so each chat's updates stay in order.
+scheduler = FairScheduler(
+    cheap_workers=int(os.getenv("SCHED_CHEAP_WORKERS", "2")),
+    heavy_workers=int(os.getenv("SCHED_HEAVY_WORKERS", "1")),
+    heavy_threshold=float(os.getenv("SCHED_HEAVY_THRESHOLD", "5")),
+    max_per_user=int(os.getenv("SCHED_MAX_PER_USER", "1")),
+    rate_per_minute=int(os.getenv("SCHED_RATE_PER_MINUTE", "30")),
+    burst=int(os.getenv("SCHED_BURST", "10"))
+)
+
+# Every accepted message is recorded before it is queued and marked done
+# when its job finishes, so a restart re-runs interrupted work and a message
+# Telegram delivers twice is only handled once
+JOBS_DB_PATH = shard_path(os.getenv("JOBS_DB_PATH", os.path.join(LOGS_DIR, "jobs.db")))
+job_store = None
+# Seconds a shutdown waits for queued and running jobs before exiting
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+# getUpdates long-poll timeout; also how long a shutdown may wait for the
+# last poll to return
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "20"))
+
+# Operation metrics are always collected; set METRICS_PORT to also serve them
+# in Prometheus format on localhost
+metrics.counter("disk_bytes_reclaimed", lambda: janitor.bytes_reclaimed)
+metrics.gauge("queue_pending_cheap", lambda: scheduler.stats()["pending_cheap"])
+metrics.gauge("queue_pending_heavy", lambda: scheduler.stats()["pending_heavy"])
+metrics.gauge("jobs_running", lambda: scheduler.stats()["running"])
+metrics.gauge("outbound_queued", lambda: sender.stats()["queued"])
+metrics.counter("outbound_throttled", lambda: sender.stats()["throttled"])
+metrics.counter("outbound_retried", lambda: sender.stats()["retried"])
+metrics.counter("outbound_coalesced", lambda: sender.stats()["coalesced"])
+metrics.gauge("template_cache_bytes", lambda: template_cache.stats()["bytes"])
+metrics.counter("template_cache_hits", lambda: template_cache.stats()["hits"])
+metrics.counter("template_cache_misses", lambda: template_cache.stats()["misses"])
+metrics.gauge("jobs_queued", lambda: job_store.stats()["counts"]["queued"])
+metrics.gauge("jobs_failed", lambda: job_store.stats()["counts"]["failed"])
+metrics.gauge("jobs_oldest_queued_seconds", lambda: job_store.stats()["oldest_queued"])
+
+# Directories, state stores and databases are set up by the runner too, not
+# on import: render workers (see rasterize.py) are spawned processes that
+# import this module as well, and must not load the stores, fire their
+# expiries or touch the databases
+def init_runtime():
+    global user_context, user_temp_files, user_settings, user_states, user_templates, job_store
+    for directory in (OUTPUT_DIR, UPLOAD_DIR, SCRATCH_DIR, TEMPLATES_DIR, LOGS_DIR):
+        os.makedirs(directory, exist_ok=True)
+    user_context = new_state_store("user_context")
+    user_temp_files = new_state_store("user_temp_files", on_expire=release_temp_files)
+    user_settings = new_state_store("user_settings", ttl=30 * 24 * 3600)
+    user_states = new_state_store("user_states")
+    user_templates = new_state_store("user_templates", ttl=30 * 24 * 3600, on_expire=release_template)
+    job_store = JobStore(
+        JOBS_DB_PATH,
+        retention=int(os.getenv("JOBS_RETENTION", str(7 * 24 * 3600))),
+        max_attempts=int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))
+    )
+    init_database()
+
+# Background threads are started by whichever runner owns this process, so a
+# sharding front process does not sweep or schedule anything itself
+def start_services():
+    init_runtime()
+    start_sweeper([user_context, user_temp_files, user_settings, user_states, user_templates, job_store])
+    janitor.start()
+    scheduler.start()
+    sender.start()
+    if os.getenv("METRICS_PORT"):
+        port = int(os.getenv("METRICS_PORT")) + (int(SHARD_ID) + 1 if SHARD_ID is not None else 0)
+        start_http_server(metrics, port, os.getenv("METRICS_HOST", "127.0.0.1"))
 
 # Set your Telegram ID here for admin access
 ADMIN_ID = int(os.getenv("ADMIN_ID", "5526206982"))
 
 # Initialize database
 def init_database():
+    os.makedirs(LOGS_DIR, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # WAL lets readers (e.g. /stats) run alongside the writer
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Create users table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -101,27 +260,62 @@ def init_database():
     conn.commit()
     conn.close()
 
+# In sharded mode workers do not write to the database themselves; rows are
+# queued to the front process, which writes them in batches (see ShardPool)
+analytics_queue = None
+
+def write_user(cursor, row):
+    user_id, username, first_name, last_name, chat_id, language_code, now = row
+    cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+    if cursor.fetchone():
+        cursor.execute(
+            "UPDATE users SET last_seen = ?, username = ? WHERE user_id = ?",
+            (now, username, user_id)
+        )
+    else:
+        cursor.execute(
+            "INSERT INTO users (user_id, username, first_name, last_name, chat_id, language_code, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, username, first_name, last_name, chat_id, language_code, now, now)
+        )
+
+def write_action(cursor, row):
+    cursor.execute(
+        "INSERT INTO actions (user_id, action_type, details, file_name, timestamp) VALUES (?, ?, ?, ?, ?)",
+        row
+    )
+
+ANALYTICS_WRITERS = {'user': write_user, 'action': write_action}
+
+# Write queued ("user" | "action", row) tuples in a single transaction
+def write_analytics_batch(rows):
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    cursor = conn.cursor()
+
+    try:
+        for kind, row in rows:
+            ANALYTICS_WRITERS[kind](cursor, row)
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"[ERROR] Writing {len(rows)} analytics rows failed: {e}")
+    finally:
+        conn.close()
+
 # Log user data
 def log_user(message):
     user = message.from_user
     chat_id = message.chat.id
     now = datetime.datetime.now().isoformat()
+    row = (user.id, user.username, user.first_name, user.last_name, chat_id, user.language_code, now)
+
+    if analytics_queue is not None:
+        analytics_queue.put(('user', row))
+        return user.id
 
     conn = sqlite3.connect(DB_PATH, timeout=10)
     cursor = conn.cursor()
 
     try:
-        cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user.id,))
-        if cursor.fetchone():
-            cursor.execute(
-                "UPDATE users SET last_seen = ?, username = ? WHERE user_id = ?",
-                (now, user.username, user.id)
-            )
-        else:
-            cursor.execute(
-                "INSERT INTO users (user_id, username, first_name, last_name, chat_id, language_code, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (user.id, user.username, user.first_name, user.last_name, chat_id, user.language_code, now, now)
-            )
+        write_user(cursor, row)
         conn.commit()
     except sqlite3.IntegrityError as e:
         logger.error(f"[ERROR] Integrity error while logging user: {e}")
@@ -133,14 +327,17 @@ def log_user(message):
 
 def log_action(user_id, action_type, details="", file_name=""):
     now = datetime.datetime.now().isoformat()
+    row = (user_id, action_type, details, file_name, now)
+
+    if analytics_queue is not None:
+        analytics_queue.put(('action', row))
+        return
+
     conn = sqlite3.connect(DB_PATH, timeout=10)
     cursor = conn.cursor()
 
     try:
-        cursor.execute(
-            "INSERT INTO actions (user_id, action_type, details, file_name, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (user_id, action_type, details, file_name, now)
-        )
+        write_action(cursor, row)
         conn.commit()
     except sqlite3.Error as e:
         logger.error(f"[ERROR] Logging action failed: {e}")
@@ -148,179 +345,16 @@ def log_action(user_id, action_type, details="", file_name=""):
         conn.close()
 
 
-# Initialize database on startup
-init_database()
-
-class HandwrittenPDF(FPDF):
-    def header(self):
-        self.set_font("Arial", size=12)
-        self.cell(0, 10, '', 0, 1, 'C')
-
-def get_text_width(text, font):
-    bbox = font.getbbox(text)
-    return bbox[2] - bbox[0]
-
-def split_text_to_fit_width(text, font, max_width):
-    words = text.split()
-    lines, current_line, current_width = [], [], 0
-    for word in words:
-        word_width = get_text_width(word + ' ', font)
-        if current_width + word_width <= max_width:
-            current_line.append(word)
-            current_width += word_width
-        else:
-            lines.append(' '.join(current_line))
-            current_line = [word]
-            current_width = word_width
-    if current_line:
-        lines.append(' '.join(current_line))
-    return lines
-
-def create_handwritten_pdf(text, output_path):
-    pdf = HandwrittenPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
-
-    original_lines = text.splitlines()
-    processed_lines = []
-    for line in original_lines:
-        if line.strip():
-            processed_lines.extend(split_text_to_fit_width(line, font, MAX_LINE_WIDTH))
-        else:
-            processed_lines.append('')
-
-    pages = [processed_lines[i:i + LINES_PER_PAGE] for i in range(0, len(processed_lines), LINES_PER_PAGE)]
-
-    for page_num, page_lines in enumerate(pages):
-        img = Image.new('RGB', (PAGE_WIDTH, PAGE_HEIGHT), color='white')
-        draw = ImageDraw.Draw(img)
-        y = MARGIN
-        for line in page_lines:
-            draw.text((MARGIN, y), line, font=font, fill='black')
-            y += LINE_HEIGHT
-        image_path = os.path.join(OUTPUT_DIR, f"temp_page_{page_num}.jpg")
-        img.save(image_path)
-        pdf.add_page()
-        pdf.image(image_path, x=0, y=0, w=210, h=297)
-        os.remove(image_path)
-
-    pdf.output(output_path)
-
-    pdf.output(output_path)
-
-def merge_pdfs(file_paths, output_path):
-    try:
-        # Verify all files exist
-        for path in file_paths:
-            if not os.path.exists(path):
-                raise FileNotFoundError(f"File not found: {path}")
-            if not path.lower().endswith('.pdf'):
-                raise ValueError(f"Only PDF files can be merged: {path}")
-        
-        # Create the merger object
-        merger = PdfMerger()
-        
-        # Add each PDF to the merger
-        for path in file_paths:
-            try:
-                # Try to open the file to verify it's a valid PDF
-                with open(path, 'rb') as f:
-                    reader = PdfReader(f)
-                    if len(reader.pages) > 0:
-                        merger.append(path)
-                    else:
-                        raise ValueError(f"PDF has no pages: {path}")
-            except Exception as e:
-                raise ValueError(f"Error processing PDF {path}: {str(e)}")
-        
-        # Write the merged PDF to the output path
-        with open(output_path, "wb") as f:
-            merger.write(f)
-        
-        # Close the merger to free resources
-        merger.close()
-        
-        return True
-    except Exception as e:
-        # Re-raise the exception with additional context
-        raise Exception(f"Failed to merge PDFs: {str(e)}")
-
-def generate_qr(text, output_path):
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(text)
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
-    img.save(output_path)
-
-def read_qr(image_path):
-    img = cv2.imread(image_path)
-    detect = cv2.QRCodeDetector()
-    value, points, straight_qrcode = detect.detectAndDecode(img)
-    return value
-
-def split_pdf_range(input_path, output_path, start_page, end_page):
-    reader = PdfReader(input_path)
-    writer = PdfWriter()
-    
-    # Validate range
-    total_pages = len(reader.pages)
-    if start_page < 1 or end_page > total_pages or start_page > end_page:
-        raise ValueError(f"Invalid page range. PDF has {total_pages} pages.")
-        
-    for i in range(start_page - 1, end_page):
-        writer.add_page(reader.pages[i])
-        
-    with open(output_path, "wb") as f:
-        writer.write(f)
-
-def split_pdf_every_x(input_path, output_dir, step):
-    reader = PdfReader(input_path)
-    total_pages = len(reader.pages)
-    generated_files = []
-    
-    for i in range(0, total_pages, step):
-        writer = PdfWriter()
-        end = min(i + step, total_pages)
-        for j in range(i, end):
-            writer.add_page(reader.pages[j])
-            
-        output_filename = f"split_{i+1}-{end}.pdf"
-        output_path = os.path.join(output_dir, output_filename)
-        with open(output_path, "wb") as f:
-            writer.write(f)
-        generated_files.append(output_path)
-        
-    return generated_files
-
-def organize_pdf(input_path, output_path, pages_list):
-    reader = PdfReader(input_path)
-    writer = PdfWriter()
-    total_pages = len(reader.pages)
-    
-    for page_num in pages_list:
-        # Adjust for 0-based index
-        idx = page_num - 1
-        if 0 <= idx < total_pages:
-            writer.add_page(reader.pages[idx])
-        else:
-            # Skip invalid pages or raise error? Let's skip and log
-            logger.warning(f"Skipping invalid page number: {page_num}")
-            
-    with open(output_path, "wb") as f:
-        writer.write(f)
-
 @bot.message_handler(commands=['admin'])
 def admin_commands(message):
     if message.from_user.id == ADMIN_ID:
         help_text = """
 🔐 Admin Commands:
 /stats - View bot usage statistics
+/perf - View per-operation latency and resource metrics
+/queue - View queued, running and failed jobs
+/profile <operation> [runs] [cprofile|sample|memory] - Profile the next runs of an operation
+/profile off [operation] - Cancel profiling
 /export - Export user data to CSV
 /admin - Show this help message
         """
@@ -367,6 +401,10 @@ def show_stats(message):
                 action_type, count = action
                 stats += f"- {action_type}: {count}\n"
             
+            janitor_stats = janitor.stats()
+            stats += "\n🧹 Disk Janitor:\n"
+            stats += f"- Reclaimed: {janitor_stats['bytes_reclaimed'] / (1024 * 1024):.1f} MB in {janitor_stats['files_reclaimed']} entries\n"
+            
             bot.reply_to(message, stats)
         except Exception as e:
             bot.reply_to(message, f"Error fetching stats: {str(e)}")
@@ -374,6 +412,82 @@ def show_stats(message):
         # Don't respond to unauthorized users
         pass
 
+@bot.message_handler(commands=['perf'])
+def show_perf(message):
+    if message.from_user.id == ADMIN_ID:
+        try:
+            bot.reply_to(message, metrics.render_text())
+        except Exception as e:
+            bot.reply_to(message, f"Error fetching metrics: {str(e)}")
+
+@bot.message_handler(commands=['queue'])
+def show_queue(message):
+    if message.from_user.id == ADMIN_ID:
+        try:
+            sched = scheduler.stats()
+            stored = job_store.stats()
+            outbound = sender.stats()
+            counts = stored["counts"]
+            text = "📥 Job Queue:\n\n"
+            text += f"- Scheduler: {sched['running']} running, {sched['pending_cheap']} cheap + {sched['pending_heavy']} heavy waiting"
+            text += f" ({sched['users_waiting']} chats, oldest {sched['oldest_wait']:.0f}s)\n"
+            text += f"- Stored: {counts['queued']} queued, {counts['running']} running, {counts['done']} done, {counts['failed']} failed\n"
+            text += f"- Oldest queued: {stored['oldest_queued']:.0f}s, oldest running: {stored['oldest_running']:.0f}s\n"
+            text += f"- Outbound: {outbound['queued']} queued, {outbound['in_flight']} sending, {outbound['throttled']} flood waits\n"
+            active = jobs.active()
+            if active:
+                text += "\n⏳ Long jobs:\n"
+                for job in active:
+                    text += f"- {job.job_id} (chat {job.chat_id}): {job.done} done, {time.monotonic() - job.started_at:.0f}s\n"
+            if stored["recent_failures"]:
+                text += "\n❌ Recent failures:\n"
+                for label, error in stored["recent_failures"]:
+                    text += f"- {label}: {error}\n"
+            bot.reply_to(message, text)
+        except Exception as e:
+            bot.reply_to(message, f"Error fetching queue: {str(e)}")
+
+def send_profile_report(session, report):
+    # Deliver a finished profiling session to the admin chat that armed it
+    with job_scratch(SCRATCH_DIR, "profile") as job_dir:
+        report_path = os.path.join(job_dir, f"profile_{session.op}_{session.mode}.txt")
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write(report)
+        with open(report_path, 'rb') as f:
+            bot.send_document(session.chat_id or ADMIN_ID, f, caption=f"🔬 Profile of {session.op} ({session.mode})")
+
+# Profiling hooks are only installed while a session is armed, so operations
+# pay nothing for this when it is off
+profiler = Profiler(metrics, on_report=send_profile_report)
+
+@bot.message_handler(commands=['profile'])
+def profile_command(message):
+    if message.from_user.id != ADMIN_ID:
+        return
+    args = message.text.split()[1:]
+    try:
+        if not args:
+            sessions = profiler.sessions()
+            text = "🔬 Armed profiling sessions:\n"
+            text += "\n".join(f"- {s.op}: {s.mode}, {s.remaining}/{s.count} runs left" for s in sessions) or "- none"
+            text += "\n\nKnown operations: " + (", ".join(metrics.operations()) or "none yet")
+            bot.reply_to(message, text)
+            return
+        
+        if args[0] == 'off':
+            sessions = profiler.disarm(args[1] if len(args) > 1 else None)
+            bot.reply_to(message, f"🔬 Cancelled {len(sessions)} profiling session(s).")
+            return
+        
+        op = args[0]
+        runs = int(args[1]) if len(args) > 1 else 1
+        mode = args[2] if len(args) > 2 else 'cprofile'
+        profiler.arm(op, runs, mode, chat_id=message.chat.id)
+        bot.reply_to(message, f"🔬 Profiling the next {runs} run(s) of '{op}' with {mode}. "
+                              f"Modes: {', '.join(PROFILE_MODES)}.")
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {str(e)}")
+
 @bot.message_handler(commands=['export'])
 def export_data(message):
     if message.from_user.id == ADMIN_ID:
@@ -457,7 +571,11 @@ def send_welcome(message):
     bot.send_message(message.chat.id, "Welcome! Choose an option:", reply_markup=markup)
     show_main_menu(message.chat.id, "Or use the inline menu below:")
 
-@bot.message_handler(func=lambda message: message.text == "✍️ Handwritten PDF")
+# Conversation flows are dispatched through a table on (state, event) instead
+# of a chain of predicates; see router.py
+router = FlowRouter()
+
+@router.on_keyboard("✍️ Handwritten PDF")
 def handle_handwritten_request(message):
     user_id = log_user(message)
     log_action(user_id, "handwritten_menu", "User selected handwritten PDF option")
@@ -465,8 +583,36 @@ def handle_handwritten_request(message):
     chat_id = message.chat.id
     user_context[chat_id] = 'handwritten'
     bot.send_message(chat_id, "📤 Send a `.txt` file to convert to handwritten PDF.")
+    send_handwriting_options(chat_id)
+
+def handwriting_realism(chat_id):
+    return user_settings.get(chat_id, {}).get("handwriting_realism", False)
+
+def handwriting_options_markup(chat_id):
+    state = "ON" if handwriting_realism(chat_id) else "OFF"
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(types.InlineKeyboardButton(f"✨ Realistic handwriting: {state}", callback_data='hw_realism'))
+    template = user_templates.get(chat_id)
+    if template:
+        markup.add(
+            types.InlineKeyboardButton(f"🖼 Replace background ({template['name']})", callback_data='hw_template'),
+            types.InlineKeyboardButton("🗑 Remove background", callback_data='hw_template_clear')
+        )
+    else:
+        markup.add(types.InlineKeyboardButton("🖼 Upload paper background", callback_data='hw_template'))
+    return markup
+
+def send_handwriting_options(chat_id):
+    bot.send_message(chat_id, "⚙️ Wobbly baselines, slant, ink variation and ruled paper, or your own paper:",
+                     reply_markup=handwriting_options_markup(chat_id))
 
-@bot.message_handler(func=lambda message: message.text == "📋 Main Menu")
+def handwriting_background(chat_id):
+    template = user_templates.get(chat_id)
+    if not template or not os.path.exists(template["path"]):
+        return None
+    return template_cache.get(template["path"])
+
+@router.on_keyboard("📋 Main Menu")
 def handle_main_menu(message):
     user_id = log_user(message)
     log_action(user_id, "main_menu", "User returned to main menu")
@@ -485,12 +631,115 @@ def show_main_menu(chat_id, text):
         types.InlineKeyboardButton("📚 Merge PDFs", callback_data='merge_pdfs'),
         types.InlineKeyboardButton("✂️ Split PDF", callback_data='split_pdf_menu'),
         types.InlineKeyboardButton("📑 Organize PDF", callback_data='organize_pdf_menu'),
-        types.InlineKeyboardButton("🖼️ Remove BG", callback_data='remove_bg'),
+        types.InlineKeyboardButton("🖼️ Remove BG", callback_data='remove_bg_menu'),
+        types.InlineKeyboardButton("🗂 Images to PDF", callback_data='images_to_pdf_menu'),
+        types.InlineKeyboardButton("🖼 PDF to Images", callback_data='pdf_to_images'),
         types.InlineKeyboardButton("📱 QR Tools", callback_data='qr_menu')
     )
-    bot.send_message(chat_id, text, reply_markup=markup)
-
-@bot.message_handler(func=lambda message: user_context.get(message.chat.id) == 'generate_qr' and message.content_type == 'text')
+    # Only the latest menu still waiting to be sent goes out
+    bot.send_message(chat_id, text, reply_markup=markup, coalesce='menu')
+
+# ---------------------------------------------------------------------------
+# Text input handlers
+# ---------------------------------------------------------------------------
+
+# Bot API upload cap (a self-hosted Bot API server allows up to 2000 MB)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(UPLOAD_LIMIT)))
+
+def megabytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+def send_file(send, chat_id, path, **kwargs):
+    # Upload a result file, timing the send phase. Oversized files are
+    # refused here rather than after a doomed upload
+    size = os.path.getsize(path)
+    if size > MAX_UPLOAD_BYTES:
+        raise ValueError(f"The result is {megabytes(size)}, over the {megabytes(MAX_UPLOAD_BYTES)} upload limit")
+    with metrics.track("send", bytes_in=size):
+        with open(path, 'rb') as f:
+            return send(chat_id, f, **kwargs)
+
+def send_bytes(send, chat_id, data, file_name, **kwargs):
+    # Upload an in-memory result without writing it to disk first
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise ValueError(f"The result is {megabytes(len(data))}, over the {megabytes(MAX_UPLOAD_BYTES)} upload limit")
+    with metrics.track("send", bytes_in=len(data)):
+        return send(chat_id, data, visible_file_name=file_name, **kwargs)
+
+# Telegram media groups hold at most 10 items; larger batches go out as a ZIP
+MEDIA_GROUP_MAX = 10
+
+def send_album(chat_id, paths):
+    # Send files as one album (all documents, so images keep full quality).
+    # An album is a single upload: if it would be over the limit, the files
+    # go one at a time instead
+    total = sum(file_size(p) for p in paths)
+    if total > MAX_UPLOAD_BYTES:
+        for path in paths:
+            send_file(bot.send_document, chat_id, path)
+        return
+    with metrics.track("send", bytes_in=total):
+        files = [open(p, 'rb') for p in paths]
+        try:
+            if len(files) == 1:
+                return bot.send_document(chat_id, files[0])
+            return bot.send_media_group(chat_id, [types.InputMediaDocument(f) for f in files])
+        finally:
+            for f in files:
+                f.close()
+
+def announce_parts(message, estimated_bytes, parts):
+    # Results over the upload limit are delivered in pieces; say so up front
+    bot.reply_to(message, f"📦 The result is about {megabytes(estimated_bytes)}, over Telegram's "
+                          f"{megabytes(MAX_UPLOAD_BYTES)} limit, so it will arrive in about {parts} parts, "
+                          f"each sent as soon as it is ready.")
+
+def volume_sender(chat_id, caption):
+    # ZipVolumes callback: upload each full volume right away and drop it
+    def send_volume(path, number, last):
+        suffix = "" if number == 1 and last else f" (part {number}{' of ' + str(number) if last else ''})"
+        send_file(bot.send_document, chat_id, path, caption=caption + suffix)
+        os.remove(path)
+    return send_volume
+
+# Long jobs report progress by editing one status message that carries a
+# Cancel button; the job stops cooperatively between pages
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))
+PROGRESS_MIN_UNITS = int(os.getenv("PROGRESS_MIN_UNITS", "10"))
+CANCEL_PREFIX = "cancel_job:"
+jobs = JobRegistry()
+
+def cancel_markup(job_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🛑 Cancel", callback_data=f"{CANCEL_PREFIX}{job_id}"))
+    return markup
+
+def start_job(chat_id, title, total, unit="pages"):
+    job = jobs.create(chat_id, min_interval=PROGRESS_INTERVAL)
+    job.status_message_id = None
+    # Small jobs finish before a status message would be useful
+    if total < PROGRESS_MIN_UNITS:
+        return job
+    markup = cancel_markup(job.job_id)
+    status = bot.send_message(chat_id, f"⏳ {title}: 0/{total} {unit}", reply_markup=markup).result()
+    job.status_message_id = status.message_id
+
+    def show(done, total):
+        # Coalesced: a slow queue only ever holds the latest progress edit
+        bot.edit_message_text(f"⏳ {title}: {done}/{total} {unit}", chat_id, status.message_id,
+                              reply_markup=markup, coalesce=f"status:{job.job_id}")
+    job.on_update = show
+    return job
+
+def end_job(job, text):
+    jobs.finish(job.job_id)
+    if job.status_message_id is not None:
+        bot.edit_message_text(text, job.chat_id, job.status_message_id, coalesce=f"status:{job.job_id}")
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+@router.on('generate_qr', 'text')
 def handle_qr_text(message):
     chat_id = message.chat.id
     text = message.text.strip()
@@ -500,11 +749,12 @@ def handle_qr_text(message):
         return
 
     try:
-        out_path = os.path.join(OUTPUT_DIR, f"qr_{uuid.uuid4()}.png")
-        generate_qr(text, out_path)
-        with open(out_path, 'rb') as f:
-            bot.send_photo(chat_id, f, caption=f"📱 QR Code for: {text[:20]}...")
-        os.remove(out_path)
+        with job_scratch(SCRATCH_DIR, "qr") as job_dir:
+            out_path = os.path.join(job_dir, "qr.png")
+            with metrics.track("generate_qr", bytes_in=len(text)) as span:
+                generate_qr(text, out_path)
+                span.bytes_out = file_size(out_path)
+            send_file(bot.send_photo, chat_id, out_path, caption=f"📱 QR Code for: {text[:20]}...")
         
         # Reset context
         if chat_id in user_context:
@@ -517,74 +767,107 @@ def handle_qr_text(message):
         bot.reply_to(message, f"❌ Error generating QR: {str(e)}")
         logger.error(f"QR Generation Error: {e}")
 
-@bot.message_handler(func=lambda message: user_context.get(message.chat.id) in ['split_range_input', 'split_every_x_input'])
-def handle_split_input(message):
+def get_flow_file(message):
+    # The PDF uploaded in the previous step of a split/organize flow
+    files = user_temp_files.get(message.chat.id, [])
+    if not files:
+        bot.reply_to(message, "❌ File not found. Please start over.")
+        return None
+    return files[0]
+
+def finish_flow(chat_id, file_path):
+    # Cleanup original file
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    user_temp_files[chat_id] = []
+    del user_context[chat_id]
+    
+    show_main_menu(chat_id, "Done! What's next?")
+
+@router.on('split_range_input', 'text')
+def handle_split_range_input(message):
     chat_id = message.chat.id
-    context = user_context.get(chat_id)
     text = message.text.strip()
     
-    # Get the uploaded file path
-    files = user_temp_files.get(chat_id, [])
-    if not files:
-        bot.reply_to(message, "❌ File not found. Please start over.")
+    file_path = get_flow_file(message)
+    if not file_path:
         return
-    file_path = files[0]
     
     try:
-        if context == 'split_range_input':
-            # Expect format like "1-5"
-            parts = text.split('-')
-            if len(parts) != 2:
-                bot.reply_to(message, "❌ Invalid format. Please use 'Start-End' (e.g., 1-5).")
-                return
-            
-            start = int(parts[0])
-            end = int(parts[1])
-            
-            out_path = os.path.join(OUTPUT_DIR, f"split_{start}-{end}_{uuid.uuid4()}.pdf")
-            split_pdf_range(file_path, out_path, start, end)
-            
-            with open(out_path, 'rb') as f:
-                bot.send_document(chat_id, f, caption=f"✅ Split PDF (Pages {start}-{end})")
+        # Expect format like "1-5"
+        parts = text.split('-')
+        if len(parts) != 2:
+            bot.reply_to(message, "❌ Invalid format. Please use 'Start-End' (e.g., 1-5).")
+            return
+        
+        start = int(parts[0])
+        end = int(parts[1])
+        
+        with job_scratch(SCRATCH_DIR, "split") as job_dir:
+            out_path = os.path.join(job_dir, f"split_{start}-{end}.pdf")
+            with metrics.track("split_pdf_range", bytes_in=file_size(file_path)) as span:
+                split_pdf_range(file_path, out_path, start, end)
+                span.bytes_out = file_size(out_path)
+                span.pages = end - start + 1
             
-            os.remove(out_path)
+            send_file(bot.send_document, chat_id, out_path, caption=f"✅ Split PDF (Pages {start}-{end})")
+        
+        finish_flow(chat_id, file_path)
+        
+    except ValueError as ve:
+        bot.reply_to(message, f"❌ Invalid input: {str(ve)}")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error: {str(e)}")
+        logger.error(f"Split error: {e}")
+
+# Up to this many split parts are sent as separate files, more are zipped
+SPLIT_LOOSE_FILES = 5
+
+@router.on('split_every_x_input', 'text')
+def handle_split_every_x_input(message):
+    chat_id = message.chat.id
+    text = message.text.strip()
+    
+    file_path = get_flow_file(message)
+    if not file_path:
+        return
+    
+    try:
+        # Expect a number
+        step = int(text)
+        if step < 1:
+            bot.reply_to(message, "❌ Please enter a number greater than 0.")
+            return
             
-        elif context == 'split_every_x_input':
-            # Expect a number
-            step = int(text)
-            if step < 1:
-                bot.reply_to(message, "❌ Please enter a number greater than 0.")
-                return
+        # Parts are cut and sent one at a time, so the first ones arrive
+        # while the rest are still being written. A part over the upload
+        # limit is split further; zipped output is cut into as many volumes
+        # as the limit requires.
+        with job_scratch(SCRATCH_DIR, "split") as job_dir:
+            with metrics.track("split_pdf_every_x", bytes_in=file_size(file_path)) as span:
+                pages = estimate_pages([file_path])
+                span.pages = len(pages)
+                chunks = [(start + 1, min(start + step, len(pages)), pages[start:start + step])
+                          for start in range(0, len(pages), step)]
                 
-            generated_files = split_pdf_every_x(file_path, OUTPUT_DIR, step)
-            
-            if len(generated_files) > 5:
-                # Zip them if too many
-                zip_path = os.path.join(OUTPUT_DIR, f"split_files_{uuid.uuid4()}.zip")
-                with zipfile.ZipFile(zip_path, 'w') as zipf:
-                    for f in generated_files:
-                        zipf.write(f, os.path.basename(f))
-                        
-                with open(zip_path, 'rb') as f:
-                    bot.send_document(chat_id, f, caption=f"✅ Split every {step} pages")
-                os.remove(zip_path)
-            else:
-                for f_path in generated_files:
-                    with open(f_path, 'rb') as f:
-                        bot.send_document(chat_id, f)
-            
-            # Cleanup generated files
-            for f in generated_files:
-                if os.path.exists(f):
-                    os.remove(f)
-                    
-        # Cleanup original file
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        user_temp_files[chat_id] = []
-        del user_context[chat_id]
+                if len(chunks) > SPLIT_LOOSE_FILES:
+                    # The parts add up to about the size of the original
+                    if span.bytes_in > MAX_UPLOAD_BYTES:
+                        announce_parts(message, span.bytes_in, span.bytes_in // MAX_UPLOAD_BYTES + 1)
+                    send_volume = volume_sender(chat_id, f"✅ Split every {step} pages")
+                    with ZipVolumes(job_dir, "split_files", send_volume, MAX_UPLOAD_BYTES) as volumes:
+                        for first, last, chunk in chunks:
+                            for part_path in write_pdf_parts(chunk, job_dir, f"split_{first}-{last}", MAX_UPLOAD_BYTES):
+                                volumes.add(part_path)
+                                os.remove(part_path)
+                    span.bytes_out = volumes.bytes_written
+                else:
+                    for first, last, chunk in chunks:
+                        for part_path in write_pdf_parts(chunk, job_dir, f"split_{first}-{last}", MAX_UPLOAD_BYTES):
+                            span.bytes_out += file_size(part_path)
+                            send_file(bot.send_document, chat_id, part_path)
         
-        show_main_menu(chat_id, "Done! What's next?")
+        finish_flow(chat_id, file_path)
         
     except ValueError as ve:
         bot.reply_to(message, f"❌ Invalid input: {str(ve)}")
@@ -592,161 +875,184 @@ def handle_split_input(message):
         bot.reply_to(message, f"❌ Error: {str(e)}")
         logger.error(f"Split error: {e}")
 
-@bot.message_handler(func=lambda message: user_context.get(message.chat.id) in ['org_remove_input', 'org_reorder_input', 'org_extract_input'])
+class PageRangeError(ValueError):
+    def __init__(self, total_pages):
+        super().__init__(f"Pages must be between 1 and {total_pages}.")
+
+def parse_page_numbers(text, total_pages):
+    # Parse input "1,2,3" or "1-3" or mixed "1, 3-5". Each page or range is
+    # checked against the document before it is expanded, so "1-2000000000"
+    # is rejected instead of building a two-billion-item list
+    page_nums = []
+    parts = text.replace(' ', '').split(',')
+    for part in parts:
+        if '-' in part:
+            start, end = map(int, part.split('-'))
+        else:
+            start = end = int(part)
+        if not 1 <= start <= end <= total_pages:
+            raise PageRangeError(total_pages)
+        page_nums.extend(range(start, end + 1))
+    return page_nums
+
+# state -> (how to build the final page list, caption)
+ORGANIZE_ACTIONS = {
+    # Remove specified pages
+    'org_remove_input': (lambda all_pages, page_nums: [p for p in all_pages if p not in page_nums], "Removed Pages"),
+    # Use specified order
+    'org_reorder_input': (lambda all_pages, page_nums: page_nums, "Reordered Pages"),
+    # Keep only specified pages
+    'org_extract_input': (lambda all_pages, page_nums: page_nums, "Extracted Pages"),
+}
+
+@router.on(list(ORGANIZE_ACTIONS), 'text')
 def handle_organize_input(message):
     chat_id = message.chat.id
     context = user_context.get(chat_id)
     text = message.text.strip()
     
-    files = user_temp_files.get(chat_id, [])
-    if not files:
-        bot.reply_to(message, "❌ File not found. Please start over.")
+    file_path = get_flow_file(message)
+    if not file_path:
         return
-    file_path = files[0]
     
     try:
-        # Parse input "1,2,3" or "1-3" or mixed "1, 3-5"
-        # For simplicity, let's support comma separated for now, maybe ranges too if easy
-        # Let's stick to comma separated integers as requested in plan for Remove/Reorder
-        # But Extract might want ranges. Let's try to be flexible.
-        
-        page_nums = []
-        parts = text.replace(' ', '').split(',')
-        for part in parts:
-            if '-' in part:
-                start, end = map(int, part.split('-'))
-                page_nums.extend(range(start, end + 1))
-            else:
-                page_nums.append(int(part))
-        
         reader = PdfReader(file_path)
         total_pages = len(reader.pages)
+        page_nums = parse_page_numbers(text, total_pages)
         all_pages = list(range(1, total_pages + 1))
         
-        final_pages = []
-        
-        if context == 'org_remove_input':
-            # Remove specified pages
-            final_pages = [p for p in all_pages if p not in page_nums]
-            action_name = "Removed Pages"
-            
-        elif context == 'org_reorder_input':
-            # Use specified order
-            final_pages = page_nums
-            action_name = "Reordered Pages"
-            
-        elif context == 'org_extract_input':
-            # Keep only specified pages
-            final_pages = page_nums
-            action_name = "Extracted Pages"
+        select_pages, action_name = ORGANIZE_ACTIONS[context]
+        final_pages = select_pages(all_pages, page_nums)
             
         if not final_pages:
             bot.reply_to(message, "❌ Resulting PDF would be empty.")
             return
 
-        out_path = os.path.join(OUTPUT_DIR, f"organized_{uuid.uuid4()}.pdf")
-        organize_pdf(file_path, out_path, final_pages)
-        
-        with open(out_path, 'rb') as f:
-            bot.send_document(chat_id, f, caption=f"✅ PDF Organized ({action_name})")
+        with job_scratch(SCRATCH_DIR, "organize") as job_dir:
+            out_path = os.path.join(job_dir, "organized.pdf")
+            with metrics.track("organize_pdf", bytes_in=file_size(file_path)) as span:
+                organize_pdf(file_path, out_path, final_pages)
+                span.bytes_out = file_size(out_path)
+                span.pages = len(final_pages)
             
-        os.remove(out_path)
-        
-        # Cleanup original
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        user_temp_files[chat_id] = []
-        del user_context[chat_id]
+            send_file(bot.send_document, chat_id, out_path, caption=f"✅ PDF Organized ({action_name})")
         
-        show_main_menu(chat_id, "Done! What's next?")
+        finish_flow(chat_id, file_path)
         
+    except PageRangeError as e:
+        bot.reply_to(message, f"❌ {e}")
     except ValueError:
         bot.reply_to(message, "❌ Invalid format. Please use numbers separated by commas (e.g., '1,3,5').")
     except Exception as e:
         bot.reply_to(message, f"❌ Error: {str(e)}")
         logger.error(f"Organize error: {e}")
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_menu_selection(call):
-    chat_id = call.message.chat.id
-    user_id = log_user(call.message)
-    log_action(user_id, "menu_selection", f"User selected menu option: {call.data}")
-    
-    if call.data == 'main_menu':
-        return show_main_menu(chat_id, "📋 Main menu:")
+PDF_IMAGE_DEFAULT_DPI = 150
+PDF_IMAGE_MAX_DPI = int(os.getenv("PDF_IMAGE_MAX_DPI", "300"))
+# Rendered pages after which the total output size is projected
+PDF_IMAGE_PROJECT_AFTER = 3
 
-    if call.data == 'qr_menu':
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("📤 Generate QR", callback_data='generate_qr'),
-            types.InlineKeyboardButton("📥 Read QR", callback_data='read_qr'),
-            types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
-        )
-        return bot.send_message(chat_id, "📱 QR Code Tools:", reply_markup=markup)
-    elif call.data == 'generate_qr':
-        user_context[chat_id] = 'generate_qr'
-        msg = "✍️ Send the text or link you want to convert to a QR code."
-    elif call.data == 'read_qr':
-        user_context[chat_id] = 'read_qr'
-        msg = "📸 Send an image containing a QR code."
+@router.on('pdf_to_images_input', 'text')
+def handle_pdf_to_images_input(message):
+    chat_id = message.chat.id
     
-    elif call.data == 'split_pdf_menu':
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(
-            types.InlineKeyboardButton("📄 Split by Range", callback_data='split_range'),
-            types.InlineKeyboardButton("📑 Split Every X Pages", callback_data='split_every_x'),
-            types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
-        )
-        return bot.send_message(chat_id, "✂️ How would you like to split the PDF?", reply_markup=markup)
+    file_path = get_flow_file(message)
+    if not file_path:
+        return
     
-    elif call.data == 'split_range':
-        user_context[chat_id] = 'split_range'
-        msg = "📤 Send the PDF file you want to split."
+    # "<pages> [dpi] [png|jpg]", e.g. "all", "1-3,5 200" or "2-8 jpg".
+    # Spaces separate the arguments, so the page list may not contain any
+    tokens = message.text.lower().split()
+    if not tokens:
+        bot.reply_to(message, "❌ Invalid format. Send pages, then optionally DPI and format (e.g., '1-3,5 200 jpg' or 'all').")
+        return
+    if tokens[0][-1] in ',-' or any(',' in token or '-' in token for token in tokens[1:]):
+        bot.reply_to(message, "❌ Write the page list without spaces (e.g., '1-3,5 200' rather than '1-3, 5 200').")
+        return
+    dpi, fmt = PDF_IMAGE_DEFAULT_DPI, 'png'
+    try:
+        total_pages = pdf_total_pages(file_path)
+        pages = list(range(1, total_pages + 1)) if tokens[0] == 'all' else parse_page_numbers(tokens[0], total_pages)
+        for token in tokens[1:]:
+            if token.isdigit():
+                dpi = int(token)
+            elif token in ('jpg', 'jpeg', 'png'):
+                fmt = 'jpg' if token == 'jpeg' else token
+            else:
+                raise ValueError(token)
+    except PageRangeError as e:
+        bot.reply_to(message, f"❌ {e}")
+        return
+    except ValueError:
+        bot.reply_to(message, "❌ Invalid format. Send pages, then optionally DPI and format (e.g., '1-3,5 200 jpg' or 'all').")
+        return
     
-    elif call.data == 'split_every_x':
-        user_context[chat_id] = 'split_every_x'
-        msg = "📤 Send the PDF file you want to split."
-
-    elif call.data == 'organize_pdf_menu':
-        user_context[chat_id] = 'organize_pdf_start'
-        msg = "📤 Send the PDF file you want to organize (remove/reorder/extract pages)."
-
-    elif call.data == 'remove_bg':
-        user_context[chat_id] = 'remove_bg'
-        msg = "📤 Send an image to remove its background."
+    if not 36 <= dpi <= PDF_IMAGE_MAX_DPI:
+        bot.reply_to(message, f"❌ DPI must be between 36 and {PDF_IMAGE_MAX_DPI}.")
+        return
+    
+    try:
+        bot.reply_to(message, f"⏳ Rendering {len(pages)} page(s) at {dpi} DPI...")
+        with job_scratch(SCRATCH_DIR, "pdf_images") as job_dir:
+            with metrics.track("pdf_to_images", bytes_in=file_size(file_path)) as span:
+                span.pages = len(pages)
+                if len(pages) <= MEDIA_GROUP_MAX:
+                    image_paths = list(pdf_to_images(file_path, job_dir, pages, dpi, fmt))
+                    span.bytes_out = sum(file_size(p) for p in image_paths)
+                else:
+                    # Pages are zipped as they finish rendering and deleted
+                    # right away; each ZIP volume is sent as soon as it is
+                    # full, while later pages are still rendering. The total
+                    # is projected from the first pages so the user knows
+                    # early if it will come in parts.
+                    send_volume = volume_sender(chat_id, f"✅ {len(pages)} pages as {fmt.upper()} ({dpi} DPI)")
+                    with ZipVolumes(job_dir, "pages", send_volume, MAX_UPLOAD_BYTES) as volumes:
+                        rendered = rendered_bytes = 0
+                        for image_path in pdf_to_images(file_path, job_dir, pages, dpi, fmt):
+                            rendered += 1
+                            rendered_bytes += file_size(image_path)
+                            volumes.add(image_path)
+                            os.remove(image_path)
+                            if rendered == PDF_IMAGE_PROJECT_AFTER:
+                                projected = rendered_bytes * len(pages) // rendered
+                                if projected > MAX_UPLOAD_BYTES:
+                                    announce_parts(message, projected, projected // MAX_UPLOAD_BYTES + 1)
+                    span.bytes_out = volumes.bytes_written
+            
+            if len(pages) <= MEDIA_GROUP_MAX:
+                send_album(chat_id, image_paths)
         
-    elif call.data in ['org_remove', 'org_reorder', 'org_extract']:
-        user_context[chat_id] = f"{call.data}_input"
-        if call.data == 'org_remove':
-            msg = "❌ Enter page numbers to REMOVE (e.g., '1,3,5')."
-        elif call.data == 'org_reorder':
-            msg = "🔄 Enter page numbers in the NEW ORDER (e.g., '3,1,2')."
-        elif call.data == 'org_extract':
-            msg = "📑 Enter page numbers to EXTRACT (e.g., '1,2,5')."
+        finish_flow(chat_id, file_path)
         
-        bot.send_message(chat_id, msg)
-        return
-
-    user_context[chat_id] = call.data
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error: {str(e)}")
+        logger.error(f"PDF to images error: {e}")
+
+# ---------------------------------------------------------------------------
+# Menu callbacks
+# ---------------------------------------------------------------------------
+
+# callback data -> (state to enter, prompt to send)
+OPERATIONS = {
+    'word_to_pdf': ('word_to_pdf', "📤 Send the required file(s). You can send multiple files."),
+    'pdf_to_word': ('pdf_to_word', "📤 Send the required file(s). You can send multiple files."),
+    'jpg_to_png': ('jpg_to_png', "📤 Send the required file(s). You can send multiple files."),
+    'png_to_jpg': ('png_to_jpg', "📤 Send the required file(s). You can send multiple files."),
+    # Merging collects PDFs step by step
+    'merge_pdfs': ('merge_pdfs_collecting', "📤 Send the FIRST PDF file you want to merge."),
+    'generate_qr': ('generate_qr', "✍️ Send the text or link you want to convert to a QR code."),
+    'read_qr': ('read_qr', "📸 Send an image containing a QR code."),
+    'split_range': ('split_range', "📤 Send the PDF file you want to split."),
+    'split_every_x': ('split_every_x', "📤 Send the PDF file you want to split."),
+    'organize_pdf_menu': ('organize_pdf_start', "📤 Send the PDF file you want to organize (remove/reorder/extract pages)."),
+    'pdf_to_images': ('pdf_to_images', "📤 Send the PDF you want to turn into images."),
+}
+
+def start_operation(chat_id, state, msg):
+    user_context[chat_id] = state
     user_temp_files[chat_id] = []
     user_settings[chat_id] = user_settings.get(chat_id, {"watermark": False, "compress": False})
-
-    if call.data in ['split_range', 'split_every_x']:
-        msg = "📤 Send the PDF file you want to split."
-    elif call.data == 'organize_pdf_menu':
-        # This is handled above, but just in case
-        msg = "📤 Send the PDF file you want to organize."
-    elif call.data == 'remove_bg':
-        msg = "📤 Send an image to remove its background."
-    else:
-        msg = "📤 Send the required file(s). You can send multiple files."
-
-    if call.data == 'handwritten':
-        msg = "📤 Send a `.txt` file."
-    elif call.data == 'merge_pdfs':
-        # Set a special context to indicate we're collecting PDFs
-        user_context[chat_id] = 'merge_pdfs_collecting'
-        msg = "📤 Send the FIRST PDF file you want to merge."
+    if state == 'merge_pdfs_collecting':
         logger.info(f"User {chat_id} started merge_pdfs operation")
     
     bot.send_message(chat_id, msg)
@@ -755,322 +1061,961 @@ def handle_menu_selection(call):
     markup.add(types.InlineKeyboardButton("📋 Menu", callback_data='main_menu'))
     bot.send_message(chat_id, "📋 Use the menu to switch tasks:", reply_markup=markup)
 
-@bot.message_handler(content_types=['document'])
-def handle_files(message):
+@router.on_callback('handwritten')
+def handle_handwritten_selection(call):
+    chat_id = call.message.chat.id
+    start_operation(chat_id, 'handwritten', "📤 Send a `.txt` file.")
+    send_handwriting_options(chat_id)
+
+@router.on_callback('hw_realism')
+def handle_handwriting_realism_toggle(call):
+    chat_id = call.message.chat.id
+    settings = user_settings.get(chat_id, {})
+    user_settings[chat_id] = dict(settings, handwriting_realism=not settings.get("handwriting_realism", False))
+    bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=handwriting_options_markup(chat_id))
+
+@router.on_callback('hw_template')
+def handle_template_request(call):
+    chat_id = call.message.chat.id
+    user_context[chat_id] = 'handwritten_template'
+    bot.send_message(chat_id, "📤 Send an image file (lined sheet, letterhead...) to use as the page background.")
+
+@router.on_callback('hw_template_clear')
+def handle_template_clear(call):
+    chat_id = call.message.chat.id
+    template = user_templates.pop(chat_id, None)
+    if template:
+        release_template(chat_id, template)
+    bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=handwriting_options_markup(chat_id))
+
+@router.on_callback(*OPERATIONS)
+def handle_operation_selection(call):
+    state, msg = OPERATIONS[call.data]
+    start_operation(call.message.chat.id, state, msg)
+
+@router.default_callback
+def handle_unknown_selection(call):
+    start_operation(call.message.chat.id, call.data, "📤 Send the required file(s). You can send multiple files.")
+
+@router.on_callback('main_menu')
+def handle_main_menu_callback(call):
+    show_main_menu(call.message.chat.id, "📋 Main menu:")
+
+@router.on_callback('qr_menu')
+def handle_qr_menu(call):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("📤 Generate QR", callback_data='generate_qr'),
+        types.InlineKeyboardButton("📥 Read QR", callback_data='read_qr'),
+        types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
+    )
+    bot.send_message(call.message.chat.id, "📱 QR Code Tools:", reply_markup=markup)
+
+@router.on_callback('split_pdf_menu')
+def handle_split_menu(call):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton("📄 Split by Range", callback_data='split_range'),
+        types.InlineKeyboardButton("📑 Split Every X Pages", callback_data='split_every_x'),
+        types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
+    )
+    bot.send_message(call.message.chat.id, "✂️ How would you like to split the PDF?", reply_markup=markup)
+
+ORGANIZE_PROMPTS = {
+    'org_remove': "❌ Enter page numbers to REMOVE (e.g., '1,3,5').",
+    'org_reorder': "🔄 Enter page numbers in the NEW ORDER (e.g., '3,1,2').",
+    'org_extract': "📑 Enter page numbers to EXTRACT (e.g., '1,2,5').",
+}
+
+# callback data -> remove_bg mode
+REMOVE_BG_MODES = {'rbg_fast': 'fast', 'rbg_full': 'full', 'rbg_mask': 'mask'}
+
+@router.on_callback('remove_bg_menu')
+def handle_remove_bg_menu(call):
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    markup.add(
+        types.InlineKeyboardButton("⚡ Fast", callback_data='rbg_fast'),
+        types.InlineKeyboardButton("🎯 Full quality (slow)", callback_data='rbg_full'),
+        types.InlineKeyboardButton("🎭 Mask only", callback_data='rbg_mask'),
+        types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
+    )
+    bot.send_message(call.message.chat.id, "🖼️ How should the background be removed?", reply_markup=markup)
+
+@router.on_callback(*REMOVE_BG_MODES)
+def handle_remove_bg_selection(call):
+    chat_id = call.message.chat.id
+    start_operation(chat_id, 'remove_bg', "📤 Send one or more images to remove their background.")
+    user_settings[chat_id] = dict(user_settings[chat_id], remove_bg_mode=REMOVE_BG_MODES[call.data])
+
+# callback data -> page size passed to images_to_pdf
+IMAGE_PDF_PAGE_SIZES = {'img_pdf_fit': 'fit', 'img_pdf_a4': 'a4', 'img_pdf_letter': 'letter'}
+
+@router.on_callback('images_to_pdf_menu')
+def handle_images_to_pdf_menu(call):
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(
+        types.InlineKeyboardButton("🖼 Fit to image", callback_data='img_pdf_fit'),
+        types.InlineKeyboardButton("📄 A4", callback_data='img_pdf_a4'),
+        types.InlineKeyboardButton("📄 Letter", callback_data='img_pdf_letter'),
+        types.InlineKeyboardButton("🔙 Back", callback_data='main_menu')
+    )
+    bot.send_message(call.message.chat.id, "🗂 Choose the page size:", reply_markup=markup)
+
+@router.on_callback(*IMAGE_PDF_PAGE_SIZES)
+def handle_images_to_pdf_selection(call):
+    chat_id = call.message.chat.id
+    start_operation(chat_id, 'images_to_pdf',
+                    "📤 Send your photos (one or more albums, as photos or files). They become one PDF in the order sent.")
+    user_settings[chat_id] = dict(user_settings[chat_id], page_size=IMAGE_PDF_PAGE_SIZES[call.data])
+
+@router.on_callback(*ORGANIZE_PROMPTS)
+def handle_organize_selection(call):
+    chat_id = call.message.chat.id
+    user_context[chat_id] = f"{call.data}_input"
+    bot.send_message(chat_id, ORGANIZE_PROMPTS[call.data])
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_menu_selection(call):
+    user_id = log_user(call.message)
+    log_action(user_id, "menu_selection", f"User selected menu option: {call.data}")
+    if call.data.startswith(CANCEL_PREFIX):
+        # Handled here, not queued: the chat's queue is busy with that job
+        job_id = call.data[len(CANCEL_PREFIX):]
+        if jobs.cancel(job_id, call.message.chat.id):
+            bot.edit_message_text("🛑 Cancelling...", call.message.chat.id, call.message.message_id,
+                                  coalesce=f"status:{job_id}")
+        return
+    schedule(call.message.chat.id, router.dispatch_callback, call, label=f"callback_{call.data}")
+
+# ---------------------------------------------------------------------------
+# File handlers: handler(message, file_path) for the just-downloaded upload
+# ---------------------------------------------------------------------------
+
+# Flows that collect several uploads before doing any work
+MULTI_FILE_STATES = ['merge_pdfs_collecting', 'merge_pdfs_second']
+# Flows whose upload is needed by a later text step
+KEEP_UPLOAD_STATES = ['split_range', 'split_every_x', 'organize_pdf_start', 'pdf_to_images']
+
+HANDWRITTEN_PART_PAGES = int(os.getenv("HANDWRITTEN_PART_PAGES", "50"))
+
+@router.on('handwritten', 'document')
+def handle_handwritten_file(message, file_path):
     chat_id = message.chat.id
-    user_id = log_user(message)
-    
-    # Initialize user context if not exists
-    if chat_id not in user_context:
-        bot.reply_to(message, "❌ Please select an option from the menu first.")
+    if not file_path.endswith(".txt"):
+        bot.reply_to(message, "❌ Please send a `.txt` file.")
         return
         
-    context = user_context.get(chat_id)
-    settings = user_settings.get(chat_id, {})
-    
-    # Initialize temp files list if not exists
-    if chat_id not in user_temp_files:
-        user_temp_files[chat_id] = []
-    
     try:
-        file_info = bot.get_file(message.document.file_id)
-        file_data = bot.download_file(file_info.file_path)
-        ext = os.path.splitext(message.document.file_name)[-1].lower()
-        file_path = os.path.join(OUTPUT_DIR, f"{uuid.uuid4()}{ext}")
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
         
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+        if not text.strip():
+            bot.reply_to(message, "❌ The text file is empty. Please send a file with content.")
+            return
 
-        user_temp_files[chat_id].append(file_path)
+        effects = HANDWRITING_EFFECTS if handwriting_realism(chat_id) else ()
+        background = handwriting_background(chat_id)
+        pages = layout_handwritten_pages(text)
+        seed = handwriting_seed(text)
+        # Long documents are rendered and sent in parts, so the first pages
+        # arrive while the rest are still being written
+        parts = [pages[i:i + HANDWRITTEN_PART_PAGES] for i in range(0, len(pages), HANDWRITTEN_PART_PAGES)]
+        job = start_job(chat_id, "✍️ Writing", len(pages))
+        try:
+            # Each render gets its own directory so concurrent users never clobber each other
+            with job_scratch(SCRATCH_DIR, "handwritten") as job_dir:
+                for n, part in enumerate(parts):
+                    first = n * HANDWRITTEN_PART_PAGES
+                    last = first + len(part)
+                    name = 'handwritten.pdf' if len(parts) == 1 else f'handwritten_part{n + 1}_p{first + 1}-{last}.pdf'
+                    out_path = os.path.join(job_dir, name)
+                    with metrics.track("create_handwritten_pdf", bytes_in=len(text) if n == 0 else 0) as span:
+                        span.pages = render_handwritten_pdf(
+                            part, out_path, effects, seed, background, first_page=first,
+                            on_page=lambda done, _, first=first: job.update(first + done, len(pages)))
+                        span.bytes_out = file_size(out_path)
+                    caption = f"📄 Part {n + 1}/{len(parts)} (pages {first + 1}-{last})" if len(parts) > 1 else None
+                    send_file(bot.send_document, chat_id, out_path, caption=caption)
+                    os.remove(out_path)
+        except JobCancelled:
+            end_job(job, f"🛑 Cancelled after {job.done} of {len(pages)} pages.")
+            return
+        except Exception:
+            end_job(job, "❌ Failed.")
+            raise
+        end_job(job, f"✅ Done: {len(pages)} pages.")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error creating handwritten PDF: {str(e)}")
 
-        # Log the file upload
-        if message.document and message.document.file_name:
-            log_action(user_id, f"file_upload_{context}", 
-                      f"User uploaded file for {context}", 
-                      message.document.file_name)
+@router.on('handwritten_template', 'document')
+def handle_template_file(message, file_path):
+    chat_id = message.chat.id
+    if not file_path.lower().endswith(IMAGE_EXTENSIONS):
+        bot.reply_to(message, "❌ Please send an image file.")
+        return
+    
+    try:
+        # Decode and resize once; every later render reuses the result
+        template_path = os.path.join(TEMPLATES_DIR, f"{chat_id}_{uuid.uuid4().hex[:8]}.png")
+        with metrics.track("prepare_template", bytes_in=file_size(file_path)) as span:
+            prepare_template(file_path, template_path)
+            span.bytes_out = file_size(template_path)
+        
+        old = user_templates.get(chat_id)
+        user_templates[chat_id] = {"path": template_path, "name": message.document.file_name}
+        if old:
+            release_template(chat_id, old)
+        
+        user_context[chat_id] = 'handwritten'
+        bot.reply_to(message, "✅ Background saved. Now send a `.txt` file.",
+                     reply_markup=handwriting_options_markup(chat_id))
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error saving background: {str(e)}")
+        logger.error(f"Template error: {e}")
 
-        if context == 'handwritten':
-            if not file_path.endswith(".txt"):
-                bot.reply_to(message, "❌ Please send a `.txt` file.")
-                return
-                
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                
-                if not text.strip():
-                    bot.reply_to(message, "❌ The text file is empty. Please send a file with content.")
-                    return
-
-                out_path = os.path.join(OUTPUT_DIR, 'handwritten.pdf')
-                create_handwritten_pdf(text, out_path)
-                with open(out_path, 'rb') as f:
-                    bot.send_document(chat_id, f)
-                # Cleanup
-                os.remove(out_path)
-            except Exception as e:
-                bot.reply_to(message, f"❌ Error creating handwritten PDF: {str(e)}")
-
-        elif context == 'merge_pdfs_collecting':
-            # First, check if this is a PDF file
-            if not file_path.lower().endswith('.pdf'):
-                bot.reply_to(message, "❌ Only PDF files can be merged. Please send a PDF file.")
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                if file_path in user_temp_files[chat_id]:
-                    user_temp_files[chat_id].remove(file_path)
-                return
-            
-            # Store the original file name for user display
-            original_name = message.document.file_name if message.document else "Unknown PDF"
-            
-            # Count how many PDFs we have now
-            num_files = len(user_temp_files[chat_id])
-            
-            # Log what we received
-            logger.info(f"PDF {num_files} received: {original_name} -> {file_path}")
-            
-            # Now set the context to wait for the second file
-            if num_files == 1:
-                user_context[chat_id] = 'merge_pdfs_second'
-                bot.reply_to(message, f"✅ First PDF received: {original_name}\n\nNow send the SECOND PDF file to merge with it.")
-            else:
-                # This shouldn't happen, but let's handle it just in case
-                bot.reply_to(message, f"⚠️ Unexpected file. Please follow the step-by-step process.")
-                
-        elif context == 'merge_pdfs_second':
-            # Check if this is a PDF file
-            if not file_path.lower().endswith('.pdf'):
-                bot.reply_to(message, "❌ Only PDF files can be merged. Please send a PDF file.")
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                if file_path in user_temp_files[chat_id]:
-                    user_temp_files[chat_id].remove(file_path)
-                return
-            
-            # Store the original file name for user display
-            original_name = message.document.file_name if message.document else "Unknown PDF"
-            
-            # We should now have exactly 2 PDF files
-            if len(user_temp_files[chat_id]) != 2:
-                bot.reply_to(message, "❌ Something went wrong with file tracking.")
-                return
-                
-            # Get file names for both PDFs
-            first_path = user_temp_files[chat_id][0]
-            second_path = user_temp_files[chat_id][1]
+def reject_non_pdf(message, file_path):
+    if file_path.lower().endswith('.pdf'):
+        return False
+    chat_id = message.chat.id
+    bot.reply_to(message, "❌ Only PDF files can be merged. Please send a PDF file.")
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    user_temp_files[chat_id] = [p for p in user_temp_files[chat_id] if p != file_path]
+    return True
+
+@router.on('merge_pdfs_collecting', 'document')
+def handle_merge_first(message, file_path):
+    chat_id = message.chat.id
+    # First, check if this is a PDF file
+    if reject_non_pdf(message, file_path):
+        return
+    
+    # Store the original file name for user display
+    original_name = message.document.file_name if message.document else "Unknown PDF"
+    
+    # Count how many PDFs we have now
+    num_files = len(user_temp_files[chat_id])
+    
+    # Log what we received
+    logger.info(f"PDF {num_files} received: {original_name} -> {file_path}")
+    
+    # Now set the context to wait for the second file
+    if num_files == 1:
+        user_context[chat_id] = 'merge_pdfs_second'
+        bot.reply_to(message, f"✅ First PDF received: {original_name}\n\nNow send the SECOND PDF file to merge with it.")
+    else:
+        # This shouldn't happen, but let's handle it just in case
+        bot.reply_to(message, f"⚠️ Unexpected file. Please follow the step-by-step process.")
+
+@router.on('merge_pdfs_second', 'document')
+def handle_merge_second(message, file_path):
+    chat_id = message.chat.id
+    # Check if this is a PDF file
+    if reject_non_pdf(message, file_path):
+        return
+    
+    # We should now have exactly 2 PDF files
+    if len(user_temp_files[chat_id]) != 2:
+        bot.reply_to(message, "❌ Something went wrong with file tracking.")
+        return
+        
+    # Get file names for both PDFs
+    first_path = user_temp_files[chat_id][0]
+    second_path = user_temp_files[chat_id][1]
+    
+    try:
+        # Check if files exist
+        if not os.path.exists(first_path) or not os.path.exists(second_path):
+            raise ValueError("One of the PDF files is missing.")
+        
+        # Sized up before merging: a result over the upload limit has its
+        # content streams compressed if that is enough, else it is written
+        # and sent as numbered parts
+        plan = OutputPlan(estimate_pages([first_path, second_path]), MAX_UPLOAD_BYTES)
+        bot.reply_to(message, "⏳ Merging PDFs... Please wait.")
+        if plan.strategy == SPLIT:
+            announce_parts(message, plan.estimated_bytes, plan.parts)
+        
+        with job_scratch(SCRATCH_DIR, "merge") as job_dir:
+            # Create output path
+            out_path = os.path.join(job_dir, "merged.pdf")
             
-            try:
-                # Check if files exist
-                if not os.path.exists(first_path) or not os.path.exists(second_path):
-                    raise ValueError("One of the PDF files is missing.")
-                
-                # Create output path
-                out_path = os.path.join(OUTPUT_DIR, f"merged_{uuid.uuid4()}.pdf")
-                
-                # Perform the merge
-                logger.info(f"Merging: {first_path} + {second_path} -> {out_path}")
-                merge_pdfs([first_path, second_path], out_path)
-                
-                # Send the result
-                bot.reply_to(message, "⏳ Merging PDFs... Please wait.")
-                
-                with open(out_path, 'rb') as f:
-                    bot.send_document(chat_id, f, caption="✅ PDFs merged successfully!")
-                
-                # Cleanup
-                for path in [first_path, second_path, out_path]:
-                    if os.path.exists(path):
-                        os.remove(path)
-            except Exception as e:
-                bot.reply_to(message, f"❌ Error merging PDFs: {str(e)}")
-                logger.error(f"Error during PDF merge: {str(e)}")
+            # Perform the merge
+            logger.info(f"Merging: {first_path} + {second_path} -> {out_path} ({plan.strategy})")
+            with metrics.track("merge_pdfs", bytes_in=file_size(first_path) + file_size(second_path)) as span:
+                span.pages = len(plan.pages)
+                if plan.strategy == SEND:
+                    merge_pdfs([first_path, second_path], out_path)
+                    outputs = [out_path]
+                    if file_size(out_path) > MAX_UPLOAD_BYTES:
+                        # The estimate was low: fall back to parts
+                        os.remove(out_path)
+                        outputs = write_pdf_parts(plan.pages, job_dir, "merged", MAX_UPLOAD_BYTES)
+                else:
+                    outputs = plan.write(job_dir, "merged")
                 
-                # Clean up
-                for path in user_temp_files[chat_id]:
-                    if os.path.exists(path):
-                        os.remove(path)
-                user_temp_files[chat_id] = []
-
-        elif context == 'merge_pdfs':
-            # This is for backward compatibility with the old implementation
-            bot.reply_to(message, "Please use the 'Merge PDFs' option from the main menu.")
+                # Each part is sent as soon as it is written
+                for number, path in enumerate(outputs, 1):
+                    span.bytes_out += file_size(path)
+                    caption = "✅ PDFs merged successfully!" if path == out_path else f"✅ Merged PDF, part {number}"
+                    send_file(bot.send_document, chat_id, path, caption=caption)
+        
+        # Cleanup
+        for path in [first_path, second_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error merging PDFs: {str(e)}")
+        logger.error(f"Error during PDF merge: {str(e)}")
+        
+        # Clean up
+        for path in user_temp_files[chat_id]:
+            if os.path.exists(path):
+                os.remove(path)
+        user_temp_files[chat_id] = []
+
+@router.on('merge_pdfs', 'document')
+def handle_merge_legacy(message, file_path):
+    chat_id = message.chat.id
+    # This is for backward compatibility with the old implementation
+    bot.reply_to(message, "Please use the 'Merge PDFs' option from the main menu.")
+    
+    # Clear the files
+    for temp_file in user_temp_files[chat_id]:
+        try:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        except Exception as e:
+            logger.error(f"Error removing temp file {temp_file}: {str(e)}")
+    
+    user_temp_files[chat_id] = []
+    
+    # Redirect to main menu
+    show_main_menu(chat_id, "Please select an option:")
+
+@router.on('generate_qr', 'document')
+def handle_qr_file(message, file_path):
+    chat_id = message.chat.id
+    # If they send a text file instead of a text message, we can read it
+    if file_path.endswith('.txt'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        if not text.strip():
+            bot.reply_to(message, "❌ File is empty.")
+            return
+        
+        with job_scratch(SCRATCH_DIR, "qr") as job_dir:
+            out_path = os.path.join(job_dir, "qr.png")
+            with metrics.track("generate_qr", bytes_in=len(text)) as span:
+                generate_qr(text, out_path)
+                span.bytes_out = file_size(out_path)
+            send_file(bot.send_photo, chat_id, out_path, caption=f"📱 QR Code for your text")
+    else:
+         bot.reply_to(message, "❌ Please send a text message or a .txt file for QR generation.")
+
+@router.on('read_qr', 'document')
+def handle_read_qr_file(message, file_path):
+    # Check if it's an image
+    if not (file_path.lower().endswith(('.png', '.jpg', '.jpeg'))):
+        bot.reply_to(message, "❌ Please send an image file.")
+        return
+    
+    try:
+        with metrics.track("read_qr", bytes_in=file_size(file_path)):
+            data = read_qr(file_path)
+        if data:
+            bot.reply_to(message, f"✅ QR Code Content:\n\n{data}")
+        else:
+            bot.reply_to(message, "❌ No QR code detected in the image.")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error reading QR: {str(e)}")
+
+# state -> (converter, output extension)
+CONVERSIONS = {
+    'word_to_pdf': (word_to_pdf, '.pdf'),
+    'pdf_to_word': (pdf_to_word, '.docx'),
+    'jpg_to_png': (jpg_to_png, '.png'),
+    'png_to_jpg': (png_to_jpg, '.jpg'),
+}
+
+@router.on(list(CONVERSIONS), 'document')
+def handle_conversion_file(message, file_path):
+    chat_id = message.chat.id
+    context = user_context.get(chat_id)
+    if context == 'pdf_to_word' and file_path.lower().endswith('.pdf'):
+        return convert_pdf_to_word(message, file_path)
+    convert, ext = CONVERSIONS[context]
+    base = os.path.splitext(message.document.file_name or "document")[0]
+    try:
+        # Output goes to the job's own directory, never next to the upload
+        # (a .jpeg converted to .jpg would otherwise overwrite its input)
+        with job_scratch(SCRATCH_DIR, context) as job_dir:
+            out_path = os.path.join(job_dir, f"{base}{ext}")
+            with metrics.track(context, bytes_in=file_size(file_path)) as span:
+                convert(file_path, out_path)
+                span.bytes_out = file_size(out_path)
+
+            send_file(bot.send_document, chat_id, out_path)
             
-            # Clear the files
-            for temp_file in user_temp_files[chat_id]:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except Exception as e:
-                    logger.error(f"Error removing temp file {temp_file}: {str(e)}")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error processing file: {str(e)}")
+    finally:
+        # Cleanup the upload; the job directory removes itself
+        try:
+            os.remove(file_path)
+        except:
+            pass
+
+def convert_pdf_to_word(message, file_path):
+    # The whole PDF goes through one conversion into one .docx; progress and
+    # cancellation happen after every parsed page
+    chat_id = message.chat.id
+    try:
+        total = len(PdfReader(file_path).pages)
+        base = os.path.splitext(message.document.file_name or "document")[0]
+        job = start_job(chat_id, "🔁 Converting to Word", total)
+        try:
+            with job_scratch(SCRATCH_DIR, "pdf_to_word") as job_dir:
+                out_path = os.path.join(job_dir, f"{base}.docx")
+                with metrics.track("pdf_to_word", bytes_in=file_size(file_path)) as span:
+                    pdf_to_word(file_path, out_path, on_page=job.update)
+                    span.pages = total
+                    span.bytes_out = file_size(out_path)
+                send_file(bot.send_document, chat_id, out_path)
+        except JobCancelled:
+            end_job(job, f"🛑 Cancelled after {job.done} of {total} pages.")
+            return
+        except Exception:
+            end_job(job, "❌ Failed.")
+            raise
+        end_job(job, f"✅ Done: {total} pages.")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Error processing file: {str(e)}")
+
+@router.on('split_range', 'document')
+def handle_split_range_file(message, file_path):
+    if file_path.lower().endswith('.pdf'):
+        user_context[message.chat.id] = 'split_range_input'
+        # Get page count
+        try:
+            reader = PdfReader(file_path)
+            num_pages = len(reader.pages)
+            bot.reply_to(message, f"📄 PDF has {num_pages} pages.\n\nType the range you want to extract (e.g., '1-5').")
+        except:
+            bot.reply_to(message, "📄 Received PDF. Type the range you want to extract (e.g., '1-5').")
+    else:
+        bot.reply_to(message, "❌ Please send a PDF file.")
+
+@router.on('split_every_x', 'document')
+def handle_split_every_x_file(message, file_path):
+    if file_path.lower().endswith('.pdf'):
+        user_context[message.chat.id] = 'split_every_x_input'
+        bot.reply_to(message, "📄 Received PDF. Enter the number of pages per split (e.g., '2' to split every 2 pages).")
+    else:
+        bot.reply_to(message, "❌ Please send a PDF file.")
+
+@router.on('organize_pdf_start', 'document')
+def handle_organize_file(message, file_path):
+    if file_path.lower().endswith('.pdf'):
+        # Show organize menu
+        try:
+            reader = PdfReader(file_path)
+            num_pages = len(reader.pages)
             
-            user_temp_files[chat_id] = []
+            markup = types.InlineKeyboardMarkup(row_width=1)
+            markup.add(
+                types.InlineKeyboardButton("🗑️ Remove Pages", callback_data='org_remove'),
+                types.InlineKeyboardButton("🔄 Reorder Pages", callback_data='org_reorder'),
+                types.InlineKeyboardButton("📑 Extract Pages", callback_data='org_extract')
+            )
+            bot.reply_to(message, f"📄 PDF has {num_pages} pages.\nChoose an action:", reply_markup=markup)
             
-            # Redirect to main menu
-            show_main_menu(chat_id, "Please select an option:")
+        except Exception as e:
+            bot.reply_to(message, f"❌ Error reading PDF: {str(e)}")
+    else:
+        bot.reply_to(message, "❌ Please send a PDF file.")
 
+@router.on('pdf_to_images', 'document')
+def handle_pdf_to_images_file(message, file_path):
+    if file_path.lower().endswith('.pdf'):
+        try:
+            num_pages = pdf_total_pages(file_path)
+        except Exception as e:
+            bot.reply_to(message, f"❌ Error reading PDF: {str(e)}")
+            return
+        user_context[message.chat.id] = 'pdf_to_images_input'
+        bot.reply_to(message, f"📄 PDF has {num_pages} pages. Which pages should be exported?\n"
+                              f"Send e.g. 'all', '1-3,5', or add DPI and format: '1-10 200 jpg' "
+                              f"(default {PDF_IMAGE_DEFAULT_DPI} DPI, PNG).")
+    else:
+        bot.reply_to(message, "❌ Please send a PDF file.")
 
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
 
-        elif context == 'generate_qr':
-            # This block handles text messages for QR generation, but if they send a file with text?
-            # Actually, text messages are handled in a different handler usually. 
-            # But if they send a text file, we can read it.
-            if file_path.endswith('.txt'):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                if not text.strip():
-                    bot.reply_to(message, "❌ File is empty.")
-                    return
-                
-                out_path = os.path.join(OUTPUT_DIR, f"qr_{uuid.uuid4()}.png")
-                generate_qr(text, out_path)
-                with open(out_path, 'rb') as f:
-                    bot.send_photo(chat_id, f, caption=f"📱 QR Code for your text")
-                os.remove(out_path)
-            else:
-                 bot.reply_to(message, "❌ Please send a text message or a .txt file for QR generation.")
+def is_image_message(message):
+    if message.content_type == 'photo':
+        return True
+    document = message.document
+    if document is None:
+        return False
+    return ((document.mime_type or '').startswith('image/')
+            or (document.file_name or '').lower().endswith(IMAGE_EXTENSIONS))
+
+def download_image(message):
+    # Photos come in several resolutions; the last one is the largest
+    if message.content_type == 'photo':
+        file_id = message.photo[-1].file_id
+    else:
+        file_id = message.document.file_id
+    with metrics.track("download") as span:
+        file_info = bot.get_file(file_id)
+        data = bot.download_file(file_info.file_path)
+        span.bytes_in = len(data)
+    return data
+
+ALBUM_DOWNLOAD_WORKERS = int(os.getenv("ALBUM_DOWNLOAD_WORKERS", "4"))
+
+@router.on('images_to_pdf', 'album')
+def handle_images_to_pdf(messages):
+    chat_id = messages[0].chat.id
+    user_id = log_user(messages[0])
+    images = [m for m in messages if is_image_message(m)]
+    if not images:
+        bot.send_message(chat_id, "❌ Please send images (photos or image files).")
+        return
+    skipped = len(messages) - len(images)
+    page_size = user_settings.get(chat_id, {}).get('page_size', 'fit')
 
-        elif context == 'read_qr':
-            # Check if it's an image
-            if not (file_path.lower().endswith(('.png', '.jpg', '.jpeg'))):
-                bot.reply_to(message, "❌ Please send an image file.")
-                return
-            
-            try:
-                data = read_qr(file_path)
-                if data:
-                    bot.reply_to(message, f"✅ QR Code Content:\n\n{data}")
+    try:
+        bot.send_message(chat_id, f"⏳ Converting {len(images)} image(s) to PDF...")
+        # Downloads are network bound; fetch the whole album concurrently
+        with ThreadPoolExecutor(max_workers=ALBUM_DOWNLOAD_WORKERS) as pool:
+            images_data = list(pool.map(download_image, images))
+
+        with metrics.track("images_to_pdf", bytes_in=sum(map(len, images_data))) as span:
+            pdf_data = images_to_pdf(images_data, page_size)
+            span.bytes_out = len(pdf_data)
+            span.pages = len(images_data)
+        del images_data
+
+        caption = f"✅ {len(images)} image(s) converted to PDF!"
+        if skipped:
+            caption += f" ({skipped} non-image file(s) skipped)"
+        send_bytes(bot.send_document, chat_id, pdf_data, "images.pdf", caption=caption)
+        log_action(user_id, "images_to_pdf", f"{len(images)} images, page size {page_size}")
+
+        del user_context[chat_id]
+        show_main_menu(chat_id, "What's next?")
+
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Error converting images: {str(e)}")
+        logger.error(f"Images to PDF Error: {e}")
+
+@router.on('remove_bg', 'album')
+def handle_remove_bg_album(messages):
+    chat_id = messages[0].chat.id
+    user_id = log_user(messages[0])
+    images = [m for m in messages if is_image_message(m)]
+    if not images:
+        bot.send_message(chat_id, "❌ Please send an image file.")
+        return
+    mode = user_settings.get(chat_id, {}).get('remove_bg_mode', 'fast')
+    suffix = "mask" if mode == 'mask' else "no_bg"
+
+    try:
+        bot.send_message(chat_id, f"⏳ Removing background from {len(images)} image(s)... This may take a moment.")
+        with ThreadPoolExecutor(max_workers=ALBUM_DOWNLOAD_WORKERS) as pool:
+            images_data = list(pool.map(download_image, images))
+
+        # Fast and full-resolution runs are tracked separately for /perf
+        op = "remove_bg" if mode == 'full' else "remove_bg_fast"
+        with metrics.track(op, bytes_in=sum(map(len, images_data))) as span:
+            results = remove_bg_batch(images_data, fast=mode != 'full', mask_only=mode == 'mask')
+            span.bytes_out = sum(map(len, results))
+        del images_data
+
+        if len(results) == 1:
+            send_bytes(bot.send_document, chat_id, results[0], f"{suffix}.png", caption="✅ Background removed!")
+        else:
+            with job_scratch(SCRATCH_DIR, "remove_bg") as job_dir:
+                paths = []
+                for i, data in enumerate(results, 1):
+                    paths.append(os.path.join(job_dir, f"{i:02d}_{suffix}.png"))
+                    with open(paths[-1], 'wb') as o:
+                        o.write(data)
+                del results
+                if len(paths) <= MEDIA_GROUP_MAX:
+                    send_album(chat_id, paths)
                 else:
-                    bot.reply_to(message, "❌ No QR code detected in the image.")
-            except Exception as e:
-                bot.reply_to(message, f"❌ Error reading QR: {str(e)}")
+                    send_volume = volume_sender(chat_id, f"✅ Background removed from {len(paths)} images!")
+                    with ZipVolumes(job_dir, "no_bg", send_volume, MAX_UPLOAD_BYTES) as volumes:
+                        for path in paths:
+                            volumes.add(path)
+        log_action(user_id, "remove_bg", f"{len(images)} images, mode {mode}")
 
-        elif context in ['word_to_pdf', 'pdf_to_word', 'jpg_to_png', 'png_to_jpg']:
-            try:
-                out_path = file_path
-                if context == 'word_to_pdf':
-                    out_path = file_path.replace(".docx", ".pdf")
-                    convert(file_path, out_path)
-                elif context == 'pdf_to_word':
-                    out_path = file_path.replace(".pdf", ".docx")
-                    cv = Converter(file_path)
-                    cv.convert(out_path, start=0, end=None)
-                    cv.close()
-                elif context == 'jpg_to_png':
-                    img = Image.open(file_path)
-                    out_path = file_path.replace(".jpg", ".png")
-                    img.save(out_path, 'PNG')
-                elif context == 'png_to_jpg':
-                    img = Image.open(file_path)
-                    out_path = file_path.replace(".png", ".jpg")
-                    img.convert("RGB").save(out_path, 'JPEG')
-
-                with open(out_path, 'rb') as f:
-                    bot.send_document(chat_id, f)
-                    
-            except Exception as e:
-                bot.reply_to(message, f"❌ Error processing file: {str(e)}")
-            finally:
-                # Cleanup temporary files
-                try:
-                    os.remove(file_path)
-                    if out_path != file_path:
-                        os.remove(out_path)
-                except:
-                    pass
-                
+        del user_context[chat_id]
+        show_main_menu(chat_id, "What's next?")
+
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Error removing background: {str(e)}")
+        logger.error(f"Remove BG Error: {e}")
+
+def release_stale_uploads(chat_id, context, file_path):
+    # Multi-file flows keep every upload until the final step
+    if context in MULTI_FILE_STATES or chat_id not in user_temp_files:
+        return
+    # For other operations, clean up earlier uploads immediately
+    for temp_file in user_temp_files[chat_id]:
+        try:
+            if os.path.exists(temp_file) and temp_file != file_path:  # Don't delete the file we just added
+                os.remove(temp_file)
+        except Exception as e:
+            logger.error(f"Error cleaning up file {temp_file}: {str(e)}")
+    # Split/organize need the new upload for the next step
+    user_temp_files[chat_id] = [file_path] if context in KEEP_UPLOAD_STATES else []
+
+# One path per message, so a job recovered after a restart finds the upload
+# it already downloaded instead of tracking a second copy
+def upload_path(message):
+    ext = os.path.splitext(message.document.file_name or "")[-1].lower()
+    return os.path.join(UPLOAD_DIR, f"{message.chat.id}_{message.message_id}{ext}")
+
+def download_document(message):
+    with metrics.track("download") as span:
+        file_info = bot.get_file(message.document.file_id)
+        file_data = bot.download_file(file_info.file_path)
+        span.bytes_in = len(file_data)
+    file_path = upload_path(message)
+    
+    with open(file_path, 'wb') as f:
+        f.write(file_data)
+    return file_path
+
+# Estimated cost per state: (base, unit, cost per unit) in rough CPU seconds.
+# Units are read from the upload (or the flow's PDF for text steps) up front.
+COST_MODELS = {
+    'handwritten': (0.1, 'lines', 0.004),
+    'pdf_to_word': (1.0, 'pages', 0.5),
+    'word_to_pdf': (2.0, None, 0),
+    'jpg_to_png': (0.05, 'megapixels', 0.05),
+    'png_to_jpg': (0.05, 'megapixels', 0.05),
+    'read_qr': (0.05, 'megapixels', 0.02),
+    'handwritten_template': (0.1, 'megapixels', 0.05),
+    'merge_pdfs_second': (0.1, 'pages', 0.02),
+    'split_range_input': (0.1, 'pages', 0.01),
+    'split_every_x_input': (0.1, 'pages', 0.02),
+    'org_remove_input': (0.1, 'pages', 0.01),
+    'org_reorder_input': (0.1, 'pages', 0.01),
+    'org_extract_input': (0.1, 'pages', 0.01),
+    'pdf_to_images_input': (0.2, 'pages', 0.3),
+}
+DEFAULT_COST = (0.0, None, 0)
+
+def schedule(chat_id, fn, *args, cost=0.0, label=None, front=False):
+    try:
+        return scheduler.submit(chat_id, fn, *args, cost=cost, label=label, front=front)
+    except RateLimited:
+        bot.send_message(chat_id, "⏳ You're sending requests too quickly. Please wait a moment and try again.")
+        return None
+
+# Runs fn as the job for the stored messages job_ids. A handler that hands
+# its work on to a follow-up job returns that job's Future, and the messages
+# are only done once it has finished too.
+def run_durable(job_ids, fn, *args):
+    for job_id in job_ids:
+        job_store.mark_running(job_id)
+    try:
+        result = fn(*args)
+    except BaseException as e:
+        finish_durable(job_ids, e)
+        raise
+    if isinstance(result, Future):
+        result.add_done_callback(lambda future: finish_durable(job_ids, future.exception()))
+    else:
+        finish_durable(job_ids, None)
+
+def finish_durable(job_ids, error):
+    for job_id in job_ids:
+        if error is None:
+            job_store.mark_done(job_id)
+        else:
+            job_store.mark_failed(job_id, error)
+
+def schedule_durable(chat_id, job_ids, fn, *args, cost=0.0, label=None, front=False):
+    if schedule(chat_id, run_durable, job_ids, fn, *args, cost=cost, label=label, front=front) is None:
+        finish_durable(job_ids, "rate limited")
+
+# Flows that take a whole burst of images (one or more albums) as one job:
+# state -> rough CPU seconds per image
+ALBUM_COSTS = {
+    'images_to_pdf': 0.3,
+    'remove_bg': 2.0,
+}
+ALBUM_STATES = list(ALBUM_COSTS)
+
+def process_album(messages):
+    chat_id = messages[0].chat.id
+    context = user_context.get(chat_id)
+    try:
+        if not router.dispatch(context, 'album', messages):
+            bot.send_message(chat_id, "❌ Please select an option from the menu first.")
+    except Exception as e:
+        bot.send_message(chat_id, f"❌ Error handling files: {str(e)}")
+        logger.error(f"Album handling error: {str(e)}")
+
+def schedule_album(items):
+    messages = [message for message, job_id in items]
+    chat_id = messages[0].chat.id
+    per_image = ALBUM_COSTS.get(user_context.get(chat_id), 0)
+    schedule_durable(chat_id, [job_id for message, job_id in items], process_album, messages,
+                     cost=per_image * len(messages), label="album")
+
+# Telegram delivers an album as separate messages (at most 10 per group), so
+# images are gathered per chat until the chat goes quiet and then processed
+# as one job. Items are (message, stored job id) pairs.
+album_collector = AlbumCollector(
+    schedule_album,
+    quiet_period=float(os.getenv("ALBUM_QUIET_SECONDS", "2")),
+    max_items=int(os.getenv("ALBUM_MAX_IMAGES", "50")),
+    sort_key=lambda item: item[0].message_id
+)
+
+def process_upload(message, context, file_path):
+    try:
+        router.dispatch(context, 'document', message, file_path)
     except Exception as e:
         bot.reply_to(message, f"❌ Error handling file: {str(e)}")
         logger.error(f"File handling error: {str(e)}")
     finally:
-        # We only want to clean up files in certain contexts
-        # For merge_pdfs_* contexts, we need to keep the files for the merging process
-        if context not in ['merge_pdfs_collecting', 'merge_pdfs_second'] and chat_id in user_temp_files:
-            # For other operations, clean up immediately
-            for temp_file in user_temp_files[chat_id]:
-                try:
-                    if os.path.exists(temp_file) and temp_file != file_path:  # Don't delete the file we just added
-                        os.remove(temp_file)
-                except Exception as e:
-                    logger.error(f"Error cleaning up file {temp_file}: {str(e)}")
-            
-            # Only clear the list for non-merge and non-split contexts (split needs file for next step)
-            if not context.startswith('merge_pdfs') and not context.startswith('split_') and not context.startswith('organize_'):
-                user_temp_files[chat_id] = []
-        
-        # Handle specific contexts after file upload
-        if context == 'split_range':
-            if file_path.lower().endswith('.pdf'):
-                user_context[chat_id] = 'split_range_input'
-                # Get page count
-                try:
-                    reader = PdfReader(file_path)
-                    num_pages = len(reader.pages)
-                    bot.reply_to(message, f"📄 PDF has {num_pages} pages.\n\nType the range you want to extract (e.g., '1-5').")
-                except:
-                    bot.reply_to(message, "📄 Received PDF. Type the range you want to extract (e.g., '1-5').")
-            else:
-                bot.reply_to(message, "❌ Please send a PDF file.")
-                
-        elif context == 'split_every_x':
-            if file_path.lower().endswith('.pdf'):
-                user_context[chat_id] = 'split_every_x_input'
-                bot.reply_to(message, "📄 Received PDF. Enter the number of pages per split (e.g., '2' to split every 2 pages).")
-            else:
-                bot.reply_to(message, "❌ Please send a PDF file.")
+        # Single-step operations no longer need the upload
+        if context not in MULTI_FILE_STATES and context not in KEEP_UPLOAD_STATES and os.path.exists(file_path):
+            try:
+                os.remove(file_path)
+            except Exception as e:
+                logger.error(f"Error cleaning up file {file_path}: {str(e)}")
 
-        elif context == 'organize_pdf_start':
-            if file_path.lower().endswith('.pdf'):
-                # Show organize menu
-                try:
-                    reader = PdfReader(file_path)
-                    num_pages = len(reader.pages)
-                    
-                    markup = types.InlineKeyboardMarkup(row_width=1)
-                    markup.add(
-                        types.InlineKeyboardButton("🗑️ Remove Pages", callback_data='org_remove'),
-                        types.InlineKeyboardButton("🔄 Reorder Pages", callback_data='org_reorder'),
-                        types.InlineKeyboardButton("📑 Extract Pages", callback_data='org_extract')
-                    )
-                    bot.reply_to(message, f"📄 PDF has {num_pages} pages.\nChoose an action:", reply_markup=markup)
-                    
-                except Exception as e:
-                    bot.reply_to(message, f"❌ Error reading PDF: {str(e)}")
-            else:
-                bot.reply_to(message, "❌ Please send a PDF file.")
+# Runs as a cheap job: download the upload, estimate what processing it will
+# cost, then queue the processing at the head of this chat's queue
+def handle_files(message):
+    chat_id = message.chat.id
+    user_id = log_user(message)
+    
+    # Initialize user context if not exists
+    context = user_context.get(chat_id)
+    if context is None:
+        bot.reply_to(message, "❌ Please select an option from the menu first.")
+        return
+    
+    # Initialize temp files list if not exists
+    if chat_id not in user_temp_files:
+        user_temp_files[chat_id] = []
+    
+    file_path = upload_path(message)
+    if file_path in user_temp_files[chat_id] and os.path.exists(file_path):
+        # Recovered job: the upload was downloaded and tracked before the restart
+        logger.info(f"Reusing {file_path} for recovered message {message.message_id}")
+    else:
+        try:
+            file_path = download_document(message)
+        except Exception as e:
+            bot.reply_to(message, f"❌ Error handling file: {str(e)}")
+            logger.error(f"File handling error: {str(e)}")
+            return
 
-        elif context == 'remove_bg':
-            if file_path.lower().endswith(('.png', '.jpg', '.jpeg')):
-                try:
-                    bot.reply_to(message, "⏳ Removing background... This may take a moment.")
-                    
-                    with open(file_path, 'rb') as i:
-                        input_data = i.read()
-                        output_data = remove(input_data)
-                    
-                    out_path = os.path.join(OUTPUT_DIR, f"no_bg_{uuid.uuid4()}.png")
-                    with open(out_path, 'wb') as o:
-                        o.write(output_data)
-                        
-                    with open(out_path, 'rb') as f:
-                        bot.send_document(chat_id, f, caption="✅ Background removed!")
-                        
-                    os.remove(out_path)
-                    os.remove(file_path)
-                    user_temp_files[chat_id] = []
-                    del user_context[chat_id]
-                    show_main_menu(chat_id, "What's next?")
-                    
-                except Exception as e:
-                    bot.reply_to(message, f"❌ Error removing background: {str(e)}")
-            else:
-                bot.reply_to(message, "❌ Please send an image file.")
+        # Reassign rather than mutate so the change is written through
+        user_temp_files[chat_id] = user_temp_files[chat_id] + [file_path]
+
+    # Log the file upload
+    if message.document and message.document.file_name:
+        log_action(user_id, f"file_upload_{context}", 
+                  f"User uploaded file for {context}", 
+                  message.document.file_name)
+
+    release_stale_uploads(chat_id, context, file_path)
+    cost = estimate_cost(COST_MODELS.get(context, DEFAULT_COST), file_path)
+    return scheduler.submit(chat_id, process_upload, message, context, file_path,
+                            cost=cost, front=True, label=context)
+
+def handle_text(message):
+    router.dispatch(user_context.get(message.chat.id), 'text', message, text=message.text)
+
+# Single entry point for every non-command message; the work itself runs on
+# the scheduler so polling threads are never blocked by a conversion
+@bot.message_handler(content_types=['text', 'document', 'photo'])
+def route_message(message):
+    chat_id = message.chat.id
+    label = user_context.get(chat_id) or message.content_type
+    job_id = job_store.enqueue(f"{chat_id}:{message.message_id}", chat_id, label, message.json)
+    if job_id is None:
+        # Already accepted once (Telegram redelivers updates after a restart)
+        return
+    dispatch_message(message, job_id)
 
-# Start bot with error handling
-while True:
+# front=True puts the job at the head of the chat's queue, past the rate
+# limit; used when re-queuing recovered jobs
+def dispatch_message(message, job_id, front=False):
+    chat_id = message.chat.id
+    if message.content_type in ('document', 'photo') and user_context.get(chat_id) in ALBUM_STATES:
+        album_collector.add(chat_id, (message, job_id))
+        return
+    if message.content_type == 'photo':
+        bot.reply_to(message, "❌ Please send the image as a file (📎 → File).")
+        job_store.mark_done(job_id)
+        return
+    if message.content_type == 'document':
+        return schedule_durable(chat_id, [job_id], handle_files, message, label="upload", front=front)
+    
+    context = user_context.get(chat_id)
+    files = user_temp_files.get(chat_id) or []
+    cost = estimate_cost(COST_MODELS.get(context, DEFAULT_COST), files[0] if files else None)
+    schedule_durable(chat_id, [job_id], handle_text, message, cost=cost, label=context or "text", front=front)
+
+# Messages the previous process accepted but never finished. Each is put at
+# the head of its chat's queue, newest first, so they run in their original
+# order ahead of anything new.
+def recover_jobs():
+    recovered = job_store.recover()
+    for job in reversed(recovered):
+        try:
+            dispatch_message(types.Message.de_json(job["payload"]), job["id"], front=True)
+        except Exception as e:
+            job_store.mark_failed(job["id"], e)
+            logger.error(f"Could not re-queue job {job['id']}: {e}")
+    if recovered:
+        logger.info(f"Re-queued {len(recovered)} interrupted job(s)")
+
+# SIGTERM/SIGINT stop the intake of updates; the runner then drains: jobs
+# already queued or running get DRAIN_TIMEOUT seconds to finish and send
+# their replies. Anything cut off stays in the job store and is re-queued by
+# recover_jobs() on the next start.
+shutdown_requested = threading.Event()
+
+def handle_shutdown_signals(stop_receiving):
+    def on_signal(signum, frame):
+        if shutdown_requested.is_set():
+            return
+        logger.info(f"Received signal {signum}; shutting down")
+        shutdown_requested.set()
+        # stop_receiving may wait for the loop this handler interrupted
+        threading.Thread(target=stop_receiving, name="shutdown", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+def drain():
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    finished = scheduler.drain(DRAIN_TIMEOUT)
+    sender.drain(max(1.0, deadline - time.monotonic()))
+    if finished:
+        logger.info("All jobs finished")
+    else:
+        logger.warning(f"Jobs still running after {DRAIN_TIMEOUT}s; they will be re-queued on restart")
+
+def run_polling():
+    start_services()
+    recover_jobs()
+    handle_shutdown_signals(bot.stop_polling)
+    # Start bot with error handling
+    while not shutdown_requested.is_set():
+        try:
+            bot.infinity_polling(timeout=60, long_polling_timeout=POLL_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Bot polling error: {e}")
+            time.sleep(2)
+            continue
+    drain()
+
+def handle_webhook_update(update_json):
+    bot.process_new_updates([types.Update.de_json(update_json)])
+
+def start_webhook(on_update, workers=None):
+    # Telegram POSTs updates to WEBHOOK_URL (usually a reverse proxy in front
+    # of the local server below); each POST is acknowledged immediately and
+    # processed on a worker pool
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if not webhook_url:
+        sys.exit("Error: WEBHOOK_URL is required when BOT_MODE=webhook.")
+    secret = os.getenv("WEBHOOK_SECRET") or uuid.uuid4().hex
+    server = WebhookServer(
+        on_update,
+        host=os.getenv("WEBHOOK_HOST", "127.0.0.1"),
+        port=int(os.getenv("WEBHOOK_PORT", "8443")),
+        path=os.getenv("WEBHOOK_PATH", "/webhook"),
+        secret_token=secret,
+        workers=workers or int(os.getenv("WEBHOOK_WORKERS", "8"))
+    )
+    bot.remove_webhook()
+    bot.set_webhook(url=webhook_url, secret_token=secret)
+    return server
+
+def run_webhook():
+    start_services()
+    recover_jobs()
+    server = start_webhook(handle_webhook_update)
+    handle_shutdown_signals(server.stop)
+    server.serve_forever()
+    drain()
+
+# Entry point of a shard worker process (spawned by run_sharded)
+def shard_worker_main(shard_id, inbox, queue):
+    global analytics_queue
+    analytics_queue = queue
+    # Dispatch updates inline so a chat's updates reach the scheduler in order
+    bot.threaded = False
+    # The front process decides when to stop (terminal and service manager
+    # signals reach the whole process group); we drain after the sentinel
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start_services()
+    recover_jobs()
+    logger.info(f"Shard {shard_id} worker started (pid {os.getpid()})")
+    while True:
+        update_json = inbox.get()
+        if update_json is None:
+            break
+        try:
+            handle_webhook_update(update_json)
+        except Exception as e:
+            logger.error(f"Shard {shard_id} failed on update {update_json.get('update_id')}: {e}")
+    drain()
+
+def run_sharded(num_shards):
+    # The front process only receives updates and routes them by chat_id;
+    # it also is the single writer for the analytics database
+    init_database()
+    pool = ShardPool(num_shards, shard_worker_main, sink=write_analytics_batch)
+    pool.start()
     try:
-        bot.infinity_polling(timeout=60, long_polling_timeout=60)
-    except Exception as e:
-        logger.error(f"Bot polling error: {e}")
-        time.sleep(2)
-        continue
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            # Routing is only a queue put; one thread keeps each chat's
+            # updates in arrival order on their way to the shard
+            server = start_webhook(pool.route, workers=1)
+            handle_shutdown_signals(server.stop)
+            server.serve_forever()
+        else:
+            handle_shutdown_signals(lambda: None)
+            bot.remove_webhook()
+            offset = None
+            while not shutdown_requested.is_set():
+                try:
+                    updates = telebot.apihelper.get_updates(TOKEN, offset=offset, timeout=60, long_polling_timeout=POLL_TIMEOUT)
+                except Exception as e:
+                    logger.error(f"Bot polling error: {e}")
+                    time.sleep(2)
+                    continue
+                for update_json in updates:
+                    offset = update_json["update_id"] + 1
+                    pool.route(update_json)
+    finally:
+        # Workers drain for up to DRAIN_TIMEOUT after the stop sentinel
+        pool.stop(DRAIN_TIMEOUT + 5)
+
+if __name__ == "__main__":
+    # BOT_MODE=polling (default) or webhook; SHARDS=N runs N worker processes
+    # behind a routing front process
+    if int(os.getenv("SHARDS", "0")) > 1:
+        run_sharded(int(os.getenv("SHARDS")))
+    elif os.getenv("BOT_MODE", "polling") == "webhook":
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,127 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+# Durable record of the work the bot has accepted. Every incoming message
+# becomes a row keyed by an idempotency key (chat_id:message_id) holding the
+# message JSON; the row moves queued -> running -> done/failed as it is
+# handled. After a crash or restart, recover() hands back whatever was
+# still queued or running so it can be dispatched again, and a message that
+# Telegram delivers twice is recognised by its key and ignored.
+#
+# purge_expired() drops finished rows after `retention` seconds, so the
+# store can be passed to state_store.start_sweeper with the state stores.
+class JobStore:
+    def __init__(self, db_path, retention=7 * 24 * 3600, max_attempts=3, name="jobs"):
+        self.name = name
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            chat_id INTEGER,
+            label TEXT,
+            state TEXT NOT NULL,
+            payload TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL
+        )
+        ''')
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, finished_at)")
+        self._conn.commit()
+
+    # Returns the new job id, or None if a job with this key already exists
+    def enqueue(self, key, chat_id, label, payload):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (key, chat_id, label, state, payload, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, chat_id, label, QUEUED, json.dumps(payload), time.time())
+            )
+            self._conn.commit()
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def mark_running(self, job_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (RUNNING, time.time(), job_id)
+            )
+            self._conn.commit()
+
+    def mark_done(self, job_id):
+        self._finish(job_id, DONE, None)
+
+    def mark_failed(self, job_id, error):
+        self._finish(job_id, FAILED, str(error)[:500])
+
+    def _finish(self, job_id, state, error):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ?",
+                (state, error, time.time(), job_id)
+            )
+            self._conn.commit()
+
+    # Jobs left queued or running by the previous process, oldest first.
+    # Jobs that have already been started max_attempts times are failed
+    # instead, so one poisonous message cannot crash the bot forever.
+    def recover(self):
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, error = 'interrupted too many times', finished_at = ? "
+                "WHERE state IN (?, ?) AND attempts >= ?",
+                (FAILED, now, QUEUED, RUNNING, self.max_attempts)
+            )
+            self._conn.execute("UPDATE jobs SET state = ? WHERE state = ?", (QUEUED, RUNNING))
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT id, chat_id, label, payload, attempts FROM jobs WHERE state = ? ORDER BY id",
+                (QUEUED,)
+            ).fetchall()
+        return [
+            {"id": row[0], "chat_id": row[1], "label": row[2], "payload": json.loads(row[3]), "attempts": row[4]}
+            for row in rows
+        ]
+
+    def purge_expired(self):
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, time.time() - self.retention)
+            )
+            self._conn.commit()
+            return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            oldest = dict(self._conn.execute(
+                "SELECT state, MIN(CASE state WHEN ? THEN started_at ELSE created_at END) "
+                "FROM jobs WHERE state IN (?, ?) GROUP BY state",
+                (RUNNING, QUEUED, RUNNING)
+            ).fetchall())
+            recent_failures = self._conn.execute(
+                "SELECT label, error FROM jobs WHERE state = ? ORDER BY finished_at DESC LIMIT 3", (FAILED,)
+            ).fetchall()
+        now = time.time()
+        return {
+            "counts": {state: counts.get(state, 0) for state in (QUEUED, RUNNING, DONE, FAILED)},
+            "oldest_queued": now - oldest[QUEUED] if oldest.get(QUEUED) else 0.0,
+            "oldest_running": now - oldest[RUNNING] if oldest.get(RUNNING) else 0.0,
+            "recent_failures": recent_failures,
+        }
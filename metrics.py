@@ -0,0 +1,250 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; the last bucket is +Inf
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def peak_rss_bytes():
+    # High-water mark of the process resident set size
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def current_rss_bytes():
+    # Resident set size right now (Linux only; 0 elsewhere)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket holding quantile q (coarse but allocation free)
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+
+class OperationStats:
+    def __init__(self):
+        self.duration = Histogram()
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pages = 0
+
+
+class Span:
+    def __init__(self, bytes_in=0):
+        self.bytes_in = bytes_in
+        self.bytes_out = 0
+        self.pages = 0
+
+
+# Per-operation latency histograms plus byte/page counters, and process
+# memory. Memory is not attributed to operations: jobs run concurrently in one
+# process, so use the profiler's memory mode (tracemalloc) for that.
+# Everything is kept in process memory and exposed through render_text()
+# (admin /perf) and render_prometheus() (HTTP endpoint).
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}
+        self._counters = {}
+        self._gauges = {}
+        # op -> factory returning a context manager wrapped around the op
+        # (used by the on-demand profiler); empty in normal operation
+        self._hooks = {}
+        self.started_at = time.time()
+
+    # with metrics.track("merge_pdfs", bytes_in=n) as span: ...; span.bytes_out = m
+    @contextmanager
+    def track(self, op, bytes_in=0):
+        hook = self._hooks.get(op) if self._hooks else None
+        if hook is not None:
+            with hook():
+                with self._track(op, bytes_in) as span:
+                    yield span
+        else:
+            with self._track(op, bytes_in) as span:
+                yield span
+
+    @contextmanager
+    def _track(self, op, bytes_in):
+        span = Span(bytes_in)
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield span
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.record(op, time.perf_counter() - start, span, failed)
+
+    def set_hook(self, op, factory):
+        hooks = dict(self._hooks)
+        hooks[op] = factory
+        self._hooks = hooks
+
+    def clear_hook(self, op):
+        hooks = dict(self._hooks)
+        hooks.pop(op, None)
+        self._hooks = hooks
+
+    def operations(self):
+        with self._lock:
+            return sorted(self._ops)
+
+    def record(self, op, seconds, span, failed=False):
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = self._ops[op] = OperationStats()
+            stats.duration.observe(seconds)
+            stats.errors += failed
+            stats.bytes_in += span.bytes_in
+            stats.bytes_out += span.bytes_out
+            stats.pages += span.pages
+
+    # Register a callable sampled at render time, e.g. queue depth
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    # Same for a running total kept by a component (e.g. retries so far);
+    # exported as a Prometheus counter
+    def counter(self, name, fn):
+        self._counters[name] = fn
+
+    def _sample(self, fns):
+        values = {}
+        for name, fn in list(fns.items()):
+            try:
+                values[name] = fn()
+            except Exception as e:
+                logger.error(f"Metric {name} failed: {e}")
+        return values
+
+    def render_text(self):
+        with self._lock:
+            ops = sorted(self._ops.items(), key=lambda item: -item[1].duration.sum)
+            lines = ["⏱ Performance (since start):", ""]
+            for op, s in ops:
+                h = s.duration
+                lines.append(
+                    f"• {op}: n={h.count} err={s.errors} avg={h.sum / h.count:.2f}s "
+                    f"p50≤{h.quantile(0.5):g}s p95≤{h.quantile(0.95):g}s max={h.max:.2f}s"
+                )
+                extra = []
+                if s.bytes_in or s.bytes_out:
+                    extra.append(f"in={s.bytes_in / 1e6:.1f}MB out={s.bytes_out / 1e6:.1f}MB")
+                if s.pages:
+                    extra.append(f"pages={s.pages}")
+                if extra:
+                    lines.append("   " + " ".join(extra))
+        if not ops:
+            lines.append("No operations recorded yet.")
+        lines.append("")
+        lines.append(f"💾 RSS: {current_rss_bytes() / 1e6:.0f} MB (peak {peak_rss_bytes() / 1e6:.0f} MB)")
+        for name, value in sorted(self._sample(self._counters).items()):
+            lines.append(f"{name}: {value}")
+        for name, value in sorted(self._sample(self._gauges).items()):
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        out = []
+        with self._lock:
+            out.append("# TYPE bot_operation_duration_seconds histogram")
+            for op, s in sorted(self._ops.items()):
+                h = s.duration
+                cumulative = 0
+                for bound, c in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    cumulative += c
+                    out.append(f'bot_operation_duration_seconds_bucket{{op="{op}",le="{bound}"}} {cumulative}')
+                out.append(f'bot_operation_duration_seconds_sum{{op="{op}"}} {h.sum}')
+                out.append(f'bot_operation_duration_seconds_count{{op="{op}"}} {h.count}')
+            for field, help_name in (("errors", "errors_total"), ("bytes_in", "input_bytes_total"),
+                                     ("bytes_out", "output_bytes_total"), ("pages", "pages_total")):
+                out.append(f"# TYPE bot_operation_{help_name} counter")
+                for op, s in sorted(self._ops.items()):
+                    out.append(f'bot_operation_{help_name}{{op="{op}"}} {getattr(s, field)}')
+        for name, value in sorted(self._sample(self._counters).items()):
+            out.append(f"# TYPE bot_{name}_total counter")
+            out.append(f"bot_{name}_total {value}")
+        for name, value in sorted(self._sample(self._gauges).items()):
+            out.append(f"# TYPE bot_{name} gauge")
+            out.append(f"bot_{name} {value}")
+        out.append("# TYPE bot_rss_bytes gauge")
+        out.append(f"bot_rss_bytes {current_rss_bytes()}")
+        out.append("# TYPE bot_peak_rss_bytes gauge")
+        out.append(f"bot_peak_rss_bytes {peak_rss_bytes()}")
+        return "\n".join(out) + "\n"
+
+
+# Serve GET /metrics in Prometheus text format on a daemon thread
+def start_http_server(registry, port, host="127.0.0.1"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+    return server
+
+
+metrics = MetricsRegistry()
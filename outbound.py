@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import requests
+import telebot
+from requests.adapters import HTTPAdapter
+from telebot.apihelper import ApiTelegramException
+
+from scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def pooled_session(pool_size=16):
+    # One keep-alive connection pool shared by every thread that talks to
+    # the Bot API (install as telebot.apihelper.session)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class OutboundRequest:
+    def __init__(self, fn, args, kwargs, coalesce):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.attempts = 0
+        self.future = Future()
+
+    # File arguments were consumed by the failed attempt, including files
+    # inside InputMedia items (send_media_group takes a list of them)
+    def rewind(self):
+        for value in list(self.args) + list(self.kwargs.values()):
+            items = value if isinstance(value, (list, tuple)) else [value]
+            for item in items:
+                for f in (item, getattr(item, 'media', None), getattr(item, 'thumbnail', None)):
+                    if hasattr(f, 'seek'):
+                        try:
+                            f.seek(0)
+                        except Exception:
+                            pass
+
+
+# Send queue in front of the Bot API. Requests are kept per chat and sent in
+# order, one at a time per chat, with chats served round robin. Sending is
+# paced by a global token bucket (Telegram allows about 30 messages/s) and
+# one per chat (about 1/s sustained, small bursts are fine). A 429 response
+# pauses that chat for the retry_after Telegram asks for and retries the
+# request; connection errors are retried with exponential backoff.
+#
+# Requests submitted with the same coalesce key replace the one still queued
+# for that chat, so e.g. only the last of several trailing menus is sent.
+class OutboundSender:
+    def __init__(self, workers=4, global_rate=30, chat_rate=1.0, chat_burst=3, max_retries=5):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._queues = {}
+        self._ready = deque()
+        self._busy = set()
+        self._blocked_until = {}
+        self._cond = threading.Condition()
+        self._threads = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.coalesced = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"outbound-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, chat_id, fn, *args, coalesce=None, **kwargs):
+        request = OutboundRequest(fn, args, kwargs, coalesce)
+        with self._cond:
+            queue = self._queues.setdefault(chat_id, deque())
+            idle = not queue and chat_id not in self._busy
+            if coalesce is not None:
+                for old in [r for r in queue if r.coalesce == coalesce]:
+                    queue.remove(old)
+                    old.future.set_result(None)
+                    self.coalesced += 1
+            queue.append(request)
+            if idle:
+                self._ready.append(chat_id)
+            self._cond.notify()
+        return request.future
+
+    # Blocking form, for callers that need the result (or hold open files)
+    def call(self, chat_id, fn, *args, **kwargs):
+        return self.submit(chat_id, fn, *args, **kwargs).result()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune_buckets()
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_buckets(self):
+        # A bucket idle long enough to be full again carries no information
+        refill = self.chat_burst / self.chat_rate
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items()
+                        if now - b.updated > refill and c not in self._queues]:
+            del self._buckets[chat_id]
+
+    # Called with the lock held. Returns (chat_id, request), or (None, wait)
+    # where wait is how long until something may become sendable (None:
+    # until the next submit)
+    def _take(self):
+        now = time.monotonic()
+        wait = float('inf')
+        for _ in range(len(self._ready)):
+            chat_id = self._ready.popleft()
+            blocked = self._blocked_until.get(chat_id, 0)
+            if blocked > now:
+                self._ready.append(chat_id)
+                wait = min(wait, blocked - now)
+                continue
+            bucket = self._bucket(chat_id)
+            if not bucket.take():
+                self._ready.append(chat_id)
+                wait = min(wait, (1 - bucket.tokens) / bucket.rate)
+                continue
+            if not self._global.take():
+                bucket.tokens += 1
+                self._ready.appendleft(chat_id)
+                return None, (1 - self._global.tokens) / self._global.rate
+            self._blocked_until.pop(chat_id, None)
+            queue = self._queues[chat_id]
+            request = queue.popleft()
+            if not queue:
+                del self._queues[chat_id]
+            self._busy.add(chat_id)
+            return chat_id, request
+        return None, None if wait == float('inf') else wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    chat_id, item = self._take()
+                    if chat_id is not None:
+                        break
+                    self._cond.wait(item)
+            self._execute(chat_id, item)
+
+    def _execute(self, chat_id, request):
+        request.attempts += 1
+        retry_in = None
+        try:
+            result = request.fn(*request.args, **request.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429 or request.attempts > self.max_retries:
+                return self._finish(chat_id, request, error=e)
+            parameters = (e.result_json or {}).get('parameters') or {}
+            retry_in = parameters.get('retry_after', 1)
+            self.throttled += 1
+            logger.warning(f"Flood wait for chat {chat_id}: retrying in {retry_in}s")
+        except requests.ConnectionError as e:
+            # Not retried on read timeouts: the message may have been sent
+            if request.attempts > self.max_retries:
+                return self._finish(chat_id, request, error=e)
+            retry_in = min(30, 0.5 * 2 ** request.attempts)
+            logger.warning(f"Send to chat {chat_id} failed ({e}); retrying in {retry_in:.1f}s")
+        except Exception as e:
+            return self._finish(chat_id, request, error=e)
+        else:
+            return self._finish(chat_id, request, result=result)
+
+        request.rewind()
+        with self._cond:
+            self.retried += 1
+            self._blocked_until[chat_id] = time.monotonic() + retry_in
+            self._queues.setdefault(chat_id, deque()).appendleft(request)
+            self._busy.discard(chat_id)
+            self._ready.append(chat_id)
+            self._cond.notify()
+
+    def _finish(self, chat_id, request, result=None, error=None):
+        with self._cond:
+            self._busy.discard(chat_id)
+            if chat_id in self._queues:
+                self._ready.append(chat_id)
+                self._cond.notify()
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        if error is None:
+            request.future.set_result(result)
+        else:
+            logger.error(f"Send to chat {chat_id} failed: {error}")
+            request.future.set_exception(error)
+
+    # Wait until every queued request has been sent or has failed
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def pending(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values()) + len(self._busy)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": sum(len(q) for q in self._queues.values()),
+                "in_flight": len(self._busy),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+                "throttled": self.throttled,
+                "coalesced": self.coalesced,
+            }
+
+
+# TeleBot whose sends go through an OutboundSender. Text sends and edits are
+# queued and return a Future (result() gives the Message); file sends wait
+# for the upload since the caller closes the file afterwards. reply_to goes
+# through send_message. send_message/edit_message_text(..., coalesce=key)
+# replace a queued, not yet sent request with the same key for that chat.
+class OutboundTeleBot(telebot.TeleBot):
+    def __init__(self, token, sender, **kwargs):
+        super().__init__(token, **kwargs)
+        self.sender = sender
+
+    def send_message(self, chat_id, text, *args, coalesce=None, **kwargs):
+        return self.sender.submit(chat_id, super().send_message, chat_id, text, *args,
+                                  coalesce=coalesce, **kwargs)
+
+    def edit_message_text(self, text=None, chat_id=None, *args, coalesce=None, **kwargs):
+        return self.sender.submit(chat_id, super().edit_message_text, text, chat_id, *args,
+                                  coalesce=coalesce, **kwargs)
+
+    def edit_message_reply_markup(self, chat_id=None, *args, **kwargs):
+        return self.sender.submit(chat_id, super().edit_message_reply_markup, chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self.sender.call(chat_id, super().send_document, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.sender.call(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_media_group(self, chat_id, *args, **kwargs):
+        return self.sender.call(chat_id, super().send_media_group, chat_id, *args, **kwargs)
@@ -0,0 +1,224 @@
+import logging
+import math
+import os
+import zipfile
+
+from PyPDF2 import PdfReader, PdfWriter
+
+logger = logging.getLogger(__name__)
+
+# Largest file a bot may upload through the Bot API (multipart/form-data)
+UPLOAD_LIMIT = 50 * 1024 * 1024
+# Parts are packed to this share of the limit: page estimates are rough and
+# every part repeats resources the pages share, such as fonts
+PACK_FILL = 0.9
+# What an uncompressed content stream typically shrinks to under Flate
+DEFLATE_RATIO = 0.3
+
+SEND, COMPRESS, SPLIT = 'send', 'compress', 'split'
+
+# ZIP record sizes without the file name: local header, central directory
+# entry and end of central directory
+_ZIP_LOCAL = 30
+_ZIP_CENTRAL = 46
+_ZIP_END = 22
+
+
+def _stream_size(obj):
+    # (stored bytes, stored without a filter) of a stream. PyPDF2 keeps the
+    # still-encoded data in _data (and drops /Length), so nothing is decoded
+    obj = obj.get_object()
+    return len(getattr(obj, '_data', b'') or b''), '/Filter' not in obj
+
+
+def _content_streams(page):
+    contents = page.get('/Contents')
+    if contents is None:
+        return []
+    contents = contents.get_object()
+    return contents if isinstance(contents, list) else [contents]
+
+
+def _xobject_streams(page):
+    resources = (page.get('/Resources') or {})
+    xobjects = resources.get_object().get('/XObject') if resources else None
+    return xobjects.get_object().values() if xobjects else []
+
+
+def _page_weight(page):
+    # (stored bytes, bytes compress_content_streams() can shrink). Images and
+    # form XObjects count towards the size but are left as they are, even
+    # when stored unfiltered, so only /Contents is compressible.
+    weight = raw = 0
+    try:
+        for stream in _content_streams(page):
+            length, unfiltered = _stream_size(stream)
+            weight += length
+            if unfiltered:
+                raw += length
+        for stream in _xobject_streams(page):
+            weight += _stream_size(stream)[0]
+    except Exception as e:
+        logger.debug(f"Could not inspect page streams: {e}")
+    return weight, raw
+
+
+def estimate_pages(paths):
+    # [(page, estimated bytes, uncompressed content bytes)] for every page of
+    # every file, in order. Each file's size is shared out over its pages in
+    # proportion to the stream bytes they draw, so shared fonts and overhead
+    # are spread evenly.
+    pages = []
+    for path in paths:
+        reader = PdfReader(path)
+        file_bytes = os.path.getsize(path)
+        weights = [_page_weight(page) for page in reader.pages]
+        total = sum(weight for weight, raw in weights)
+        for page, (weight, raw) in zip(reader.pages, weights):
+            share = weight / total if total else 1 / len(weights)
+            pages.append((page, file_bytes * share, min(raw, file_bytes * share)))
+    return pages
+
+
+def _compressed_size(page_estimate):
+    page, size, raw = page_estimate
+    return size - raw * (1 - DEFLATE_RATIO)
+
+
+# How a PDF result of the given pages will be delivered: as is, with its
+# content streams compressed (lossless), or as numbered parts
+class OutputPlan:
+    def __init__(self, pages, limit=UPLOAD_LIMIT):
+        self.pages = pages
+        self.limit = limit
+        self.estimated_bytes = sum(size for page, size, raw in pages)
+        self.compressed_bytes = sum(_compressed_size(p) for p in pages)
+        if self.estimated_bytes <= limit:
+            self.strategy = SEND
+        elif self.compressed_bytes <= limit * PACK_FILL:
+            self.strategy = COMPRESS
+        else:
+            self.strategy = SPLIT
+        self.parts = math.ceil(self.estimated_bytes / (limit * PACK_FILL)) if self.strategy == SPLIT else 1
+
+    def write(self, output_dir, stem):
+        return write_pdf_parts(self.pages, output_dir, stem, self.limit,
+                               compress=self.strategy == COMPRESS)
+
+
+def write_pdf(pages, output_path, compress=False):
+    writer = PdfWriter()
+    for page, size, raw in pages:
+        # Compressed on the source page: the writer would otherwise still
+        # carry the uncompressed stream it copied
+        if compress and raw:
+            page.compress_content_streams()
+        writer.add_page(page)
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+
+
+def _pack(pages, budget, size_of):
+    groups, group, group_bytes = [], [], 0
+    for page in pages:
+        size = size_of(page)
+        if group and group_bytes + size > budget:
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(page)
+        group_bytes += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+# Writes the pages as PDFs of at most `limit` bytes and yields each path as
+# soon as it is written: `<stem>.pdf` if everything fits in one file, else
+# `<stem>_part1.pdf`, `<stem>_part2.pdf`, ... A part that comes out larger
+# than estimated is halved and written again.
+def write_pdf_parts(pages, output_dir, stem, limit=UPLOAD_LIMIT, compress=False):
+    size_of = _compressed_size if compress else (lambda p: p[1])
+    pending = _pack(pages, limit * PACK_FILL, size_of)
+    single = len(pending) == 1
+    pending.reverse()
+    temp_path = os.path.join(output_dir, f"{stem}.partial.pdf")
+    number = 0
+    while pending:
+        group = pending.pop()
+        write_pdf(group, temp_path, compress)
+        size = os.path.getsize(temp_path)
+        if size > limit:
+            os.remove(temp_path)
+            if len(group) == 1:
+                raise ValueError(f"A single page is {size / (1024 * 1024):.1f} MB, over the upload limit")
+            logger.info(f"{stem}: {len(group)} pages came to {size} bytes; splitting further")
+            middle = len(group) // 2
+            pending.extend([group[middle:], group[:middle]])
+            single = False
+            continue
+        number += 1
+        name = f"{stem}.pdf" if single else f"{stem}_part{number}.pdf"
+        path = os.path.join(output_dir, name)
+        os.replace(temp_path, path)
+        yield path
+
+
+# Packs files into ZIP archives of at most `limit` bytes each. A volume is
+# handed to on_volume(path, number, last) as soon as the next file would not
+# fit, so it can be uploaded while later files are still being produced;
+# the final volume follows on close(). Every volume is a complete archive
+# (named <stem>.zip if there is only one, else <stem>_part<N>.zip), so each
+# can be opened on its own. Entries are stored: the files are PDFs and
+# images, which are compressed already.
+class ZipVolumes:
+    def __init__(self, output_dir, stem, on_volume, limit=UPLOAD_LIMIT):
+        self.output_dir = output_dir
+        self.stem = stem
+        self.on_volume = on_volume
+        self.limit = limit
+        self.volumes = 0
+        self.bytes_written = 0
+        self._zip = None
+        self._path = None
+        self._bytes = 0
+
+    def add(self, path, arcname=None):
+        arcname = arcname or os.path.basename(path)
+        name_bytes = len(arcname.encode('utf-8'))
+        size = os.path.getsize(path) + _ZIP_LOCAL + _ZIP_CENTRAL + 2 * name_bytes
+        if size + _ZIP_END > self.limit:
+            raise ValueError(f"{arcname} is {size / (1024 * 1024):.1f} MB, over the upload limit")
+        if self._zip is not None and self._bytes + size > self.limit:
+            self._finish(last=False)
+        if self._zip is None:
+            self.volumes += 1
+            self._path = os.path.join(self.output_dir, f"{self.stem}_part{self.volumes}.zip")
+            self._zip = zipfile.ZipFile(self._path, 'w', zipfile.ZIP_STORED)
+            self._bytes = _ZIP_END
+        self._zip.write(path, arcname)
+        self._bytes += size
+
+    def _finish(self, last):
+        self._zip.close()
+        path = self._path
+        if last and self.volumes == 1:
+            path = os.path.join(self.output_dir, f"{self.stem}.zip")
+            os.replace(self._path, path)
+        self.bytes_written += os.path.getsize(path)
+        self._zip = self._path = None
+        self.on_volume(path, self.volumes, last)
+
+    def close(self):
+        if self._zip is not None:
+            self._finish(last=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._zip is not None:
+            self._zip.close()
+            os.remove(self._path)
+            self._zip = self._path = None
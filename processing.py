@@ -0,0 +1,482 @@
+import os
+import io
+import logging
+import threading
+import zlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from fpdf import FPDF
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from docx2pdf import convert
+from pdf2docx import Converter
+from PyPDF2 import PdfReader, PdfWriter, PdfMerger
+import cv2
+import numpy as np
+import qrcode
+from rembg import remove, new_session
+
+# Document and image processing used by the bot. Nothing in here touches
+# Telegram or the environment, so it can be imported by the benchmarks
+# (and anything else) without a TELEGRAM_TOKEN.
+
+logger = logging.getLogger(__name__)
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "QECarolineMutiboko.ttf")
+
+LINES_PER_PAGE = 25
+FONT_SIZE = 20
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 50
+LINE_HEIGHT = 30
+MAX_LINE_WIDTH = PAGE_WIDTH - (2 * MARGIN)
+
+# Optional realism effects for create_handwritten_pdf. They are applied to
+# the whole page at once (one remap plus a few array ops), not per glyph.
+HANDWRITING_EFFECTS = ('wobble', 'slant', 'ink', 'ruled')
+BASELINE_OFFSET = FONT_SIZE + 4   # ruled line below each text line
+WOBBLE_PX = 1.6                   # std-dev of a word's baseline shift
+SLANT = 0.12                      # mean horizontal shear (dx per px of height)
+INK_COLOR = np.array([25, 35, 80], np.float32)
+RULE_COLOR = np.array([170, 200, 230], np.float32)
+MARGIN_RULE_COLOR = np.array([230, 150, 150], np.float32)
+
+class HandwrittenPDF(FPDF):
+    def header(self):
+        self.set_font("Arial", size=12)
+        self.cell(0, 10, '', 0, 1, 'C')
+
+def get_text_width(text, font):
+    bbox = font.getbbox(text)
+    return bbox[2] - bbox[0]
+
+def split_text_to_fit_width(text, font, max_width):
+    words = text.split()
+    lines, current_line, current_width = [], [], 0
+    for word in words:
+        word_width = get_text_width(word + ' ', font)
+        if current_width + word_width <= max_width:
+            current_line.append(word)
+            current_width += word_width
+        else:
+            lines.append(' '.join(current_line))
+            current_line = [word]
+            current_width = word_width
+    if current_line:
+        lines.append(' '.join(current_line))
+    return lines
+
+@lru_cache(maxsize=2)
+def _paper(ruled):
+    paper = np.full((PAGE_HEIGHT, PAGE_WIDTH, 3), 255, np.float32)
+    if ruled:
+        for i in range(LINES_PER_PAGE):
+            paper[MARGIN + i * LINE_HEIGHT + BASELINE_OFFSET, :] = RULE_COLOR
+        paper[:, MARGIN - 12] = MARGIN_RULE_COLOR
+    paper.setflags(write=False)
+    return paper
+
+def _baseline_offsets(line, font, rng):
+    # Vertical shift for every x of one line: each word at its own height,
+    # plus a slow drift across the line
+    offsets = np.zeros(PAGE_WIDTH, np.float32)
+    x = MARGIN
+    for word in line.split():
+        width = get_text_width(word + ' ', font)
+        offsets[x:x + width] = rng.normal(0, WOBBLE_PX)
+        x += width
+    phase = rng.uniform(0, np.pi)
+    cycles = rng.uniform(0.5, 1.5)
+    drift = rng.normal(0, WOBBLE_PX) * np.sin(np.linspace(phase, phase + cycles * np.pi, PAGE_WIDTH))
+    return offsets + drift.astype(np.float32)
+
+def apply_handwriting_effects(ink, lines, font, effects, rng, paper=None):
+    # ink: float32 ink coverage (0..1) of a rendered page; returns RGB image.
+    # paper: optional float32 RGB background replacing plain/ruled paper.
+    height, width = ink.shape
+    wobble, slant = 'wobble' in effects, 'slant' in effects
+    if wobble or slant:
+        # One displacement map for the whole page, resampled in a single remap
+        map_x, map_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+        page_slant = rng.normal(SLANT, 0.03) if slant else 0.0
+        for i, line in enumerate(lines):
+            if not line:
+                continue
+            top = MARGIN + i * LINE_HEIGHT
+            band = slice(top, min(top + LINE_HEIGHT, height))
+            if wobble:
+                map_y[band] -= _baseline_offsets(line, font, rng)
+            if slant:
+                # Shear about the baseline: glyph tops lean right
+                rows = np.arange(band.start, band.stop, dtype=np.float32)
+                line_slant = page_slant + rng.normal(0, 0.02)
+                map_x[band] -= (line_slant * (top + BASELINE_OFFSET - rows))[:, None]
+        ink = cv2.remap(ink, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    if 'ink' in effects:
+        # Smooth pressure field: coarse random grid upsampled over the page
+        field = rng.uniform(0.55, 1.0, (height // 24 + 2, width // 24 + 2)).astype(np.float32)
+        ink = ink * cv2.resize(field, (width, height), interpolation=cv2.INTER_CUBIC)
+    ink = np.clip(ink, 0, 1)[..., None]
+    if paper is None:
+        paper = _paper('ruled' in effects)
+    page = paper * (1 - ink) + INK_COLOR * ink
+    return Image.fromarray(page.astype(np.uint8))
+
+def handwriting_seed(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+def layout_handwritten_pages(text):
+    # Wrap the text to the page width and cut it into pages of lines
+    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+    original_lines = text.splitlines()
+    processed_lines = []
+    for line in original_lines:
+        if line.strip():
+            processed_lines.extend(split_text_to_fit_width(line, font, MAX_LINE_WIDTH))
+        else:
+            processed_lines.append('')
+
+    return [processed_lines[i:i + LINES_PER_PAGE] for i in range(0, len(processed_lines), LINES_PER_PAGE)]
+
+def render_handwritten_pdf(pages, output_path, effects=(), seed=0, background=None,
+                           first_page=0, on_page=None):
+    # Render laid-out pages (or a slice of them starting at first_page, so
+    # page seeds match a full render). on_page(done, total) is called after
+    # each page; an exception raised from it aborts the render.
+    pdf = HandwrittenPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+    paper = np.asarray(background, np.float32) if effects and background is not None else None
+
+    for page_num, page_lines in enumerate(pages, first_page):
+        if effects:
+            # Render ink coverage only; paper and colour are composited after
+            img = Image.new('L', (PAGE_WIDTH, PAGE_HEIGHT), color=0)
+            fill = 255
+        elif background is not None:
+            img = background.copy()
+            fill = 'black'
+        else:
+            img = Image.new('RGB', (PAGE_WIDTH, PAGE_HEIGHT), color='white')
+            fill = 'black'
+        draw = ImageDraw.Draw(img)
+        y = MARGIN
+        for line in page_lines:
+            draw.text((MARGIN, y), line, font=font, fill=fill)
+            y += LINE_HEIGHT
+        if effects:
+            ink = np.asarray(img, np.float32) / 255
+            img = apply_handwriting_effects(ink, page_lines, font, effects,
+                                            np.random.default_rng([seed, page_num]), paper)
+        image_path = os.path.join(os.path.dirname(output_path), f"temp_page_{page_num}.jpg")
+        img.save(image_path)
+        pdf.add_page()
+        pdf.image(image_path, x=0, y=0, w=210, h=297)
+        os.remove(image_path)
+        if on_page:
+            on_page(page_num - first_page + 1, len(pages))
+
+    pdf.output(output_path)
+    return len(pages)
+
+def create_handwritten_pdf(text, output_path, effects=(), seed=None, background=None, on_page=None):
+    # effects: any of HANDWRITING_EFFECTS. Randomness comes from seed (by
+    # default derived from the text), so the same input renders identically.
+    # background: optional decoded page-sized RGB image (not modified).
+    if seed is None:
+        seed = handwriting_seed(text)
+    pages = layout_handwritten_pages(text)
+    return render_handwritten_pdf(pages, output_path, effects, seed, background, on_page=on_page)
+
+def merge_pdfs(file_paths, output_path):
+    try:
+        # Verify all files exist
+        for path in file_paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"File not found: {path}")
+            if not path.lower().endswith('.pdf'):
+                raise ValueError(f"Only PDF files can be merged: {path}")
+        
+        # Create the merger object
+        merger = PdfMerger()
+        
+        # Add each PDF to the merger
+        for path in file_paths:
+            try:
+                # Try to open the file to verify it's a valid PDF
+                with open(path, 'rb') as f:
+                    reader = PdfReader(f)
+                    if len(reader.pages) > 0:
+                        merger.append(path)
+                    else:
+                        raise ValueError(f"PDF has no pages: {path}")
+            except Exception as e:
+                raise ValueError(f"Error processing PDF {path}: {str(e)}")
+        
+        # Write the merged PDF to the output path
+        with open(output_path, "wb") as f:
+            merger.write(f)
+        
+        # Close the merger to free resources
+        merger.close()
+        
+        return True
+    except Exception as e:
+        # Re-raise the exception with additional context
+        raise Exception(f"Failed to merge PDFs: {str(e)}")
+
+def generate_qr(text, output_path):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(text)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    img.save(output_path)
+
+def read_qr(image_path):
+    img = cv2.imread(image_path)
+    detect = cv2.QRCodeDetector()
+    value, points, straight_qrcode = detect.detectAndDecode(img)
+    return value
+
+def split_pdf_range(input_path, output_path, start_page, end_page):
+    reader = PdfReader(input_path)
+    writer = PdfWriter()
+    
+    # Validate range
+    total_pages = len(reader.pages)
+    if start_page < 1 or end_page > total_pages or start_page > end_page:
+        raise ValueError(f"Invalid page range. PDF has {total_pages} pages.")
+        
+    for i in range(start_page - 1, end_page):
+        writer.add_page(reader.pages[i])
+        
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+def split_pdf_every_x(input_path, output_dir, step):
+    reader = PdfReader(input_path)
+    total_pages = len(reader.pages)
+    generated_files = []
+    
+    for i in range(0, total_pages, step):
+        writer = PdfWriter()
+        end = min(i + step, total_pages)
+        for j in range(i, end):
+            writer.add_page(reader.pages[j])
+            
+        output_filename = f"split_{i+1}-{end}.pdf"
+        output_path = os.path.join(output_dir, output_filename)
+        with open(output_path, "wb") as f:
+            writer.write(f)
+        generated_files.append(output_path)
+        
+    return generated_files
+
+def organize_pdf(input_path, output_path, pages_list):
+    reader = PdfReader(input_path)
+    writer = PdfWriter()
+    total_pages = len(reader.pages)
+    
+    for page_num in pages_list:
+        # Adjust for 0-based index
+        idx = page_num - 1
+        if 0 <= idx < total_pages:
+            writer.add_page(reader.pages[idx])
+        else:
+            # Skip invalid pages or raise error? Let's skip and log
+            logger.warning(f"Skipping invalid page number: {page_num}")
+            
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+def word_to_pdf(input_path, output_path):
+    convert(input_path, output_path)
+
+def pdf_to_word(input_path, output_path, on_page=None):
+    # One Converter run over the whole document, so layout spanning pages
+    # (sections, headers, margins) is analysed together. Runs pdf2docx's
+    # steps by hand to parse page by page: on_page(done, total) is called
+    # after each page; an exception raised from it aborts the conversion.
+    cv = Converter(input_path)
+    try:
+        settings = cv.default_settings
+        cv.load_pages().parse_document(**settings)
+        pages = [page for page in cv.pages if not page.skip_parsing]
+        for done, page in enumerate(pages, 1):
+            try:
+                page.parse(**settings)
+            except Exception as e:
+                # pdf2docx's default (ignore_page_error): drop the page, keep going
+                logger.error(f"pdf_to_word: skipping page {page.id + 1}: {e}")
+            if on_page:
+                on_page(done, len(pages))
+        cv.make_docx(output_path, **settings)
+    finally:
+        cv.close()
+
+def jpg_to_png(input_path, output_path):
+    img = Image.open(input_path)
+    img.save(output_path, 'PNG')
+
+def png_to_jpg(input_path, output_path):
+    img = Image.open(input_path)
+    img.convert("RGB").save(output_path, 'JPEG')
+
+_rembg_session = None
+_rembg_lock = threading.Lock()
+
+def get_rembg_session():
+    # rembg builds a new ONNX session on every call unless given one; load
+    # the model once per process instead
+    global _rembg_session
+    with _rembg_lock:
+        if _rembg_session is None:
+            _rembg_session = new_session()
+        return _rembg_session
+
+def remove_bg(input_data, mask_only=False):
+    # rembg takes and returns encoded image bytes
+    return remove(input_data, session=get_rembg_session(), only_mask=mask_only)
+
+def _box_mean(x, radius):
+    return cv2.boxFilter(x, -1, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REFLECT)
+
+def guided_upsample(guide, guide_small, mask_small, radius=4, eps=1e-4):
+    # Fast guided filter (He & Sun 2015): fit the local linear model
+    # mask ~ a * guide + b at proxy resolution, upsample a and b, and apply
+    # them to the full-resolution guide. Mask edges snap to image edges at
+    # the cost of a few box filters on the small image.
+    I = guide_small.astype(np.float32) / 255
+    p = mask_small.astype(np.float32) / 255
+    mean_I = _box_mean(I, radius)
+    mean_p = _box_mean(p, radius)
+    var_I = _box_mean(I * I, radius) - mean_I * mean_I
+    cov_Ip = _box_mean(I * p, radius) - mean_I * mean_p
+    a = cov_Ip / (var_I + eps)
+    b = mean_p - a * mean_I
+    size = (guide.shape[1], guide.shape[0])
+    a = cv2.resize(_box_mean(a, radius), size, interpolation=cv2.INTER_LINEAR)
+    b = cv2.resize(_box_mean(b, radius), size, interpolation=cv2.INTER_LINEAR)
+    q = a * (guide.astype(np.float32) / 255) + b
+    return np.clip(q * 255, 0, 255).astype(np.uint8)
+
+def remove_bg_fast(input_data, mask_only=False, proxy_side=1024):
+    # Segment a downscaled proxy, then upsample the mask guided by the
+    # original. Inference cost no longer grows with the photo's megapixels.
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(input_data))).convert('RGB')
+    full = np.asarray(img)
+    height, width = full.shape[:2]
+    scale = proxy_side / max(height, width)
+    if scale < 1:
+        proxy = cv2.resize(full, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    else:
+        proxy = full
+    mask_small = np.asarray(remove(Image.fromarray(proxy), session=get_rembg_session(), only_mask=True))
+
+    if proxy is full:
+        alpha = mask_small
+    else:
+        alpha = guided_upsample(cv2.cvtColor(full, cv2.COLOR_RGB2GRAY),
+                                cv2.cvtColor(proxy, cv2.COLOR_RGB2GRAY), mask_small)
+
+    out = io.BytesIO()
+    if mask_only:
+        Image.fromarray(alpha, 'L').save(out, 'PNG', compress_level=1)
+    else:
+        Image.fromarray(np.dstack((full, alpha)), 'RGBA').save(out, 'PNG', compress_level=1)
+    return out.getvalue()
+
+def remove_bg_batch(images_data, fast=True, mask_only=False, workers=2):
+    # The model is shared; a second worker overlaps one image's decode and
+    # PNG encode with the next image's inference
+    process = remove_bg_fast if fast else remove_bg
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda data: process(data, mask_only=mask_only), images_data))
+
+# Page sizes in PDF points; 'fit' makes each page the size of its image
+PAGE_SIZES = {'a4': (595, 842), 'letter': (612, 792)}
+FIT_POINTS_PER_PIXEL = 0.5  # 144 dpi
+PAGE_MARGIN = 18
+
+def prepare_jpeg(data, max_side=2000, quality=85):
+    img = Image.open(io.BytesIO(data))
+    # For JPEGs, let the decoder downscale by 1/2, 1/4 or 1/8 while decoding
+    img.draft('RGB', (max_side, max_side))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=quality)
+    return img.size, out.getvalue()
+
+def _place_image(size, page_size):
+    # Returns page (width, height) and image placement (x, y, w, h) in points
+    width, height = size
+    if page_size not in PAGE_SIZES:
+        page_w, page_h = width * FIT_POINTS_PER_PIXEL, height * FIT_POINTS_PER_PIXEL
+        return (page_w, page_h), (0, 0, page_w, page_h)
+    page_w, page_h = PAGE_SIZES[page_size]
+    # Landscape photos go on landscape pages
+    if width > height:
+        page_w, page_h = page_h, page_w
+    scale = min((page_w - 2 * PAGE_MARGIN) / width, (page_h - 2 * PAGE_MARGIN) / height)
+    w, h = width * scale, height * scale
+    return (page_w, page_h), ((page_w - w) / 2, (page_h - h) / 2, w, h)
+
+def build_jpeg_pdf(images, page_size='fit'):
+    # Writes a PDF that embeds the given JPEG streams as-is (DCTDecode), so
+    # nothing is decoded or re-encoded here. images: [((w, h), jpeg_bytes)]
+    buf = io.BytesIO()
+    offsets = {}
+
+    def write_obj(num, body, stream=None):
+        offsets[num] = buf.tell()
+        buf.write(f"{num} 0 obj\n".encode())
+        buf.write(body)
+        if stream is not None:
+            buf.write(b"\nstream\n")
+            buf.write(stream)
+            buf.write(b"\nendstream")
+        buf.write(b"\nendobj\n")
+
+    buf.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    page_ids = [3 + 3 * i for i in range(len(images))]
+    write_obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids)
+    write_obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(images)} >>".encode())
+
+    for page_id, ((width, height), jpeg) in zip(page_ids, images):
+        image_id, content_id = page_id + 1, page_id + 2
+        (page_w, page_h), (x, y, w, h) = _place_image((width, height), page_size)
+        write_obj(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.2f} {page_h:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode())
+        write_obj(image_id, (
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>"
+        ).encode(), jpeg)
+        content = f"q {w:.2f} 0 0 {h:.2f} {x:.2f} {y:.2f} cm /Im0 Do Q".encode()
+        write_obj(content_id, f"<< /Length {len(content)} >>".encode(), content)
+
+    xref_pos = buf.tell()
+    count = len(offsets) + 1
+    buf.write(f"xref\n0 {count}\n0000000000 65535 f \n".encode())
+    for num in range(1, count):
+        buf.write(f"{offsets[num]:010d} 00000 n \n".encode())
+    buf.write(f"trailer\n<< /Size {count} /Root 1 0 R >>\nstartxref\n{xref_pos}\n%%EOF\n".encode())
+    return buf.getvalue()
+
+def images_to_pdf(images_data, page_size='fit', max_side=2000, quality=85, workers=None):
+    # Downscale and JPEG-encode every image in parallel (Pillow releases the
+    # GIL while decoding, resizing and encoding), then assemble in memory
+    workers = workers or min(8, (os.cpu_count() or 1) + 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        prepared = list(pool.map(lambda data: prepare_jpeg(data, max_side, quality), images_data))
+    return build_jpeg_pdf(prepared, page_size)
@@ -0,0 +1,256 @@
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cprofile', 'sample', 'memory')
+
+# tracemalloc is process wide: overlapping memory-mode runs share one trace,
+# started by the first and stopped by the last (unless something else, e.g.
+# PYTHONTRACEMALLOC, was already tracing)
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_owned = False
+
+# Only one cProfile profiler can be enabled at a time (from Python 3.12 it
+# sits on sys.monitoring), so overlapping cprofile runs go unprofiled
+_cprofile_lock = threading.Lock()
+
+
+def _acquire_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        if _tracing_users == 0:
+            _tracing_owned = not tracemalloc.is_tracing()
+            if _tracing_owned:
+                tracemalloc.start(25)
+        _tracing_users += 1
+
+
+def _release_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_owned:
+            tracemalloc.stop()
+
+
+# Statistical profiler: samples one thread's stack from a helper thread, so
+# the profiled code runs unmodified
+class StackSampler:
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            leaf = True
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if leaf:
+                    self.self_counts[key] += 1
+                    leaf = False
+                if key not in seen:
+                    self.total_counts[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class ProfileSession:
+    def __init__(self, op, count, mode, top_n, chat_id):
+        self.op = op
+        self.remaining = count
+        self.count = count
+        self.mode = mode
+        self.top_n = top_n
+        self.chat_id = chat_id
+        self.durations = []
+        self.stats = None
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.samples = 0
+        self.memory_diffs = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def run(self):
+        start = time.perf_counter()
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            enabled = _cprofile_lock.acquire(blocking=False)
+            if enabled:
+                try:
+                    profile.enable()
+                except Exception as e:
+                    # A profiler failure must never fail the operation itself
+                    logger.error(f"Profiling {self.op} failed: {e}")
+                    _cprofile_lock.release()
+                    enabled = False
+            if not enabled:
+                # Another run is being profiled; this one does not count
+                with self.lock:
+                    self.remaining += 1
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+                _cprofile_lock.release()
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+        elif self.mode == 'sample':
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                with self.lock:
+                    self.self_counts.update(sampler.self_counts)
+                    self.total_counts.update(sampler.total_counts)
+                    self.samples += sampler.samples
+        else:
+            _acquire_tracing()
+            try:
+                before = tracemalloc.take_snapshot()
+            except Exception as e:
+                before = None
+                logger.error(f"Memory profile of {self.op} failed: {e}")
+            try:
+                yield
+            finally:
+                # A profiler failure must never fail the operation itself
+                try:
+                    if before is not None:
+                        after = tracemalloc.take_snapshot()
+                        peak = tracemalloc.get_traced_memory()[1]
+                        diff = after.compare_to(before, 'lineno')
+                        with self.lock:
+                            self.memory_diffs.append((peak, diff[:self.top_n]))
+                except Exception as e:
+                    logger.error(f"Memory profile of {self.op} failed: {e}")
+                finally:
+                    _release_tracing()
+        with self.lock:
+            self.durations.append(time.perf_counter() - start)
+
+    def report(self):
+        out = io.StringIO()
+        runs = len(self.durations)
+        out.write(f"Profile of '{self.op}' ({self.mode}), {runs} run(s)\n")
+        out.write("Durations: " + ", ".join(f"{d:.3f}s" for d in self.durations) + "\n\n")
+        if self.mode == 'cprofile' and self.stats is not None:
+            self.stats.stream = out
+            self.stats.sort_stats('cumulative').print_stats(self.top_n)
+            out.write("\n")
+            self.stats.sort_stats('tottime').print_stats(self.top_n)
+        elif self.mode == 'sample':
+            out.write(f"{self.samples} samples\n\nTop functions by self samples:\n")
+            for (filename, line, name), n in self.self_counts.most_common(self.top_n):
+                out.write(f"{n:8d} {100.0 * n / max(1, self.samples):6.1f}%  {name} ({filename}:{line})\n")
+            out.write("\nTop functions by inclusive samples:\n")
+            for (filename, line, name), n in self.total_counts.most_common(self.top_n):
+                out.write(f"{n:8d} {100.0 * n / max(1, self.samples):6.1f}%  {name} ({filename}:{line})\n")
+        else:
+            for i, (peak, diff) in enumerate(self.memory_diffs, 1):
+                out.write(f"Run {i}: traced peak {peak / 1e6:.1f} MB\nTop allocation sites (net):\n")
+                for stat in diff:
+                    out.write(f"  {stat}\n")
+                out.write("\n")
+        return out.getvalue()
+
+
+# Arms profiling for the next N runs of an operation. Sessions are installed
+# as metrics.track() hooks, so nothing at all is added to an operation's
+# path while no session is armed. on_report(session, text) is called once
+# the requested number of runs has completed.
+class Profiler:
+    def __init__(self, registry, on_report=None):
+        self.registry = registry
+        self.on_report = on_report
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def arm(self, op, count=1, mode='cprofile', top_n=30, chat_id=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode '{mode}'. Use one of: {', '.join(MODES)}")
+        if count < 1:
+            raise ValueError("Count must be at least 1")
+        session = ProfileSession(op, count, mode, top_n, chat_id)
+        with self._lock:
+            self._sessions[op] = session
+        self.registry.set_hook(op, lambda: self._run(session))
+        return session
+
+    def disarm(self, op=None):
+        with self._lock:
+            ops = [op] if op else list(self._sessions)
+            sessions = [self._sessions.pop(o) for o in ops if o in self._sessions]
+        for session in sessions:
+            self.registry.clear_hook(session.op)
+        return sessions
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    @contextmanager
+    def _run(self, session):
+        with session.lock:
+            if session.remaining <= 0:
+                claimed = False
+            else:
+                session.remaining -= 1
+                claimed = True
+        if not claimed:
+            yield
+            return
+        try:
+            with session.run():
+                yield
+        finally:
+            if len(session.durations) >= session.count:
+                self._finish(session)
+
+    def _finish(self, session):
+        with self._lock:
+            if self._sessions.get(session.op) is not session:
+                return
+            del self._sessions[session.op]
+        self.registry.clear_hook(session.op)
+        if self.on_report:
+            try:
+                self.on_report(session, session.report())
+            except Exception as e:
+                logger.error(f"Failed to deliver profile for {session.op}: {e}")
@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# Progress and cancellation handle for one long job. The job calls
+# update(done, total) between units of work (pages); that raises
+# JobCancelled once the user has cancelled, and otherwise passes progress to
+# on_update(done, total) at most every min_interval seconds.
+class JobProgress:
+    def __init__(self, job_id, chat_id, on_update=None, min_interval=3.0):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.on_update = on_update
+        self.min_interval = min_interval
+        self.done = 0
+        self.started_at = time.monotonic()
+        self._last_update = 0.0
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(self.job_id)
+
+    def update(self, done, total):
+        self.check()
+        self.done = done
+        now = time.monotonic()
+        if self.on_update and (now - self._last_update >= self.min_interval or done >= total):
+            self._last_update = now
+            try:
+                self.on_update(done, total)
+            except Exception as e:
+                logger.error(f"Progress update for job {self.job_id} failed: {e}")
+
+
+# Running jobs by id, so a Cancel button can reach the job it belongs to
+class JobRegistry:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, chat_id, on_update=None, min_interval=3.0):
+        job = JobProgress(uuid.uuid4().hex[:12], chat_id, on_update, min_interval)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        return job
+
+    # Only the chat that started a job may cancel it
+    def cancel(self, job_id, chat_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.chat_id != chat_id:
+            return False
+        job.cancel()
+        return True
+
+    def finish(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def active(self, chat_id=None):
+        with self._lock:
+            return [j for j in self._jobs.values() if chat_id is None or j.chat_id == chat_id]
@@ -0,0 +1,105 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+
+import fitz  # PyMuPDF
+
+# PDF page rasterization, on a process pool shared by all requests.
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMATS = ('png', 'jpg')
+
+
+def page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    # Spawned workers re-import the main module (bot.py) before they can run
+    # anything, so the pool is created once per process and kept: workers
+    # start on first use and are reused by every later request
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the bot process is multi-threaded, which fork does not mix with
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _discard_pool(pool):
+    # A worker died (e.g. killed for memory); the next request gets a new pool
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def render_pages(pdf_path, page_numbers, out_dir, dpi=150, fmt='png', quality=85):
+    # Each call opens its own document handle and writes every page to disk
+    # as soon as it is rendered, so only one bitmap per process is alive
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    paths = []
+    with fitz.open(pdf_path) as doc:
+        for number in page_numbers:
+            pix = doc.load_page(number - 1).get_pixmap(matrix=matrix, alpha=False)
+            path = os.path.join(out_dir, f"page_{number:04d}.{fmt}")
+            if fmt == 'png':
+                pix.save(path)
+            else:
+                pix.save(path, jpg_quality=quality)
+            paths.append(path)
+            pix = None
+    return paths
+
+
+def pdf_to_images(pdf_path, out_dir, pages=None, dpi=150, fmt='png', quality=85,
+                  workers=None, chunk_size=4):
+    # Yields image paths in page order as they become available. Pages are
+    # rendered in chunks on the shared pool with at most 2 * workers chunks of
+    # this document in flight, so the caller can zip/send/delete finished
+    # pages while the rest render and disk use stays bounded too.
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format '{fmt}'")
+    if pages is None:
+        pages = list(range(1, page_count(pdf_path) + 1))
+    chunks = [pages[i:i + chunk_size] for i in range(0, len(pages), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    # Daemonic processes (e.g. shard workers) may not start children
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        for chunk in chunks:
+            yield from render_pages(pdf_path, chunk, out_dir, dpi, fmt, quality)
+        return
+
+    pool = get_render_pool()
+    remaining = iter(chunks)
+    pending = deque()
+    try:
+        for chunk in islice(remaining, 2 * workers):
+            pending.append(pool.submit(render_pages, pdf_path, chunk, out_dir, dpi, fmt, quality))
+        while pending:
+            paths = pending.popleft().result()
+            chunk = next(remaining, None)
+            if chunk:
+                pending.append(pool.submit(render_pages, pdf_path, chunk, out_dir, dpi, fmt, quality))
+            yield from paths
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+    finally:
+        # The caller stopped early (cancelled or failed): don't keep
+        # rendering pages nobody will read
+        for future in pending:
+            future.cancel()
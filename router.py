@@ -0,0 +1,88 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Wildcard state: matches any state that has no route of its own for an event
+ANY_STATE = '*'
+
+
+# Table-driven router for the conversation state machine.
+# Message handlers are keyed by (state, event) where state is the chat's
+# current user_context value (None when idle) and event is the message
+# content type ('text', 'document', ...). Callback handlers are keyed by the
+# callback data. Dispatch is a constant number of dict lookups regardless of
+# how many flows are registered.
+class FlowRouter:
+    def __init__(self):
+        self._routes = {}
+        self._keyboard = {}
+        self._callbacks = {}
+        self._default_callback = None
+
+    # Register handler(message, ...) for one or more states on an event
+    def on(self, states, event='text'):
+        if isinstance(states, str) or states is None:
+            states = [states]
+
+        def decorator(handler):
+            for state in states:
+                key = (state, event)
+                if key in self._routes:
+                    raise ValueError(f"Route already registered for state={state!r} event={event!r}")
+                self._routes[key] = handler
+            return handler
+        return decorator
+
+    # Register handler(message) for an exact reply-keyboard button text.
+    # Keyboard buttons take precedence over state routes.
+    def on_keyboard(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                self._keyboard[text] = handler
+            return handler
+        return decorator
+
+    # Register handler(call) for one or more callback data values
+    def on_callback(self, *data):
+        def decorator(handler):
+            for value in data:
+                if value in self._callbacks:
+                    raise ValueError(f"Callback already registered for {value!r}")
+                self._callbacks[value] = handler
+            return handler
+        return decorator
+
+    # Register handler(call) for callback data without a route of its own
+    def default_callback(self, handler):
+        self._default_callback = handler
+        return handler
+
+    def resolve(self, state, event, text=None):
+        if event == 'text' and text is not None:
+            handler = self._keyboard.get(text)
+            if handler:
+                return handler
+        handler = self._routes.get((state, event))
+        if handler is None and state is not None:
+            handler = self._routes.get((ANY_STATE, event))
+        return handler
+
+    def resolve_callback(self, data):
+        return self._callbacks.get(data, self._default_callback)
+
+    # Returns True when a handler was found and invoked with *args
+    def dispatch(self, state, event, *args, text=None):
+        handler = self.resolve(state, event, text)
+        if handler is None:
+            logger.debug(f"No route for state={state!r} event={event!r}")
+            return False
+        handler(*args)
+        return True
+
+    def dispatch_callback(self, call):
+        handler = self.resolve_callback(call.data)
+        if handler is None:
+            logger.debug(f"No callback route for {call.data!r}")
+            return False
+        handler(call)
+        return True
@@ -0,0 +1,236 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+CHEAP = 'cheap'
+HEAVY = 'heavy'
+
+_PAGE_RE = re.compile(rb"/Type\s*/Page(?!s)")
+_COUNT_RE = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)", re.S)
+
+
+class RateLimited(Exception):
+    pass
+
+
+# ---------------------------------------------------------------------------
+# Up-front cost estimation. These only look at headers / raw bytes so they
+# are much cheaper than the operations they are estimating.
+# ---------------------------------------------------------------------------
+
+def pdf_page_count(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return 0
+    # Prefer the page tree's /Count; fall back to counting page objects
+    counts = [int(c) for c in _COUNT_RE.findall(data)]
+    if counts:
+        return max(counts)
+    pages = len(_PAGE_RE.findall(data))
+    # Pages hidden in compressed object streams: assume ~50KB per page
+    return pages or max(1, len(data) // (50 * 1024))
+
+
+def image_megapixels(path):
+    try:
+        from PIL import Image
+        # Image.open only parses the header; pixel data is not decoded
+        with Image.open(path) as img:
+            width, height = img.size
+        return width * height / 1e6
+    except Exception:
+        # Unknown format: assume a typical compressed photo at ~0.3 MB/MP
+        try:
+            return os.path.getsize(path) / (0.3 * 1024 * 1024)
+        except OSError:
+            return 0.0
+
+
+def text_line_count(path):
+    try:
+        with open(path, 'rb') as f:
+            return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b'')) + 1
+    except OSError:
+        return 0
+
+
+def estimate_cost(model, path=None):
+    # model is (base, unit, per_unit) where unit is 'pages', 'megapixels',
+    # 'lines' or None; cost is in rough "seconds of CPU" units
+    base, unit, per_unit = model
+    if not path or unit is None:
+        return base
+    if unit == 'pages':
+        amount = pdf_page_count(path)
+    elif unit == 'megapixels':
+        amount = image_megapixels(path)
+    elif unit == 'lines':
+        amount = text_line_count(path)
+    else:
+        amount = 0
+    return base + amount * per_unit
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Job:
+    def __init__(self, user_id, fn, args, cost, lane, label):
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.cost = cost
+        self.lane = lane
+        self.label = label
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+# Two-lane fair scheduler. Each user has a FIFO queue; a user's head job is
+# run by the lane matching its estimated cost, and users are served round
+# robin so one user's heavy backlog cannot starve anyone else. With
+# max_per_user=1 a user's jobs run strictly in submission order.
+# Heavy workers pick up cheap work when no heavy job is eligible, cheap
+# workers never run heavy jobs, so cheap requests keep low latency.
+class FairScheduler:
+    def __init__(self, cheap_workers=2, heavy_workers=1, heavy_threshold=5.0,
+                 max_per_user=1, rate_per_minute=30, burst=10):
+        self.cheap_workers = cheap_workers
+        self.heavy_workers = heavy_workers
+        self.heavy_threshold = heavy_threshold
+        self.max_per_user = max_per_user
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._order = deque()
+        self._running = {}
+        self._buckets = {}
+        self._threads = []
+
+    def lane_for(self, cost):
+        return HEAVY if cost >= self.heavy_threshold else CHEAP
+
+    # Queue fn(*args) for user_id. front=True puts the job at the head of the
+    # user's queue (used for follow-up work of the job currently running) and
+    # bypasses the rate limit. Raises RateLimited when the user is over quota.
+    def submit(self, user_id, fn, *args, cost=0.0, front=False, label=None):
+        with self._cond:
+            if not front:
+                bucket = self._buckets.get(user_id)
+                if bucket is None:
+                    bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+                if not bucket.take():
+                    raise RateLimited(f"User {user_id} is over the request rate limit")
+
+            job = Job(user_id, fn, args, cost, self.lane_for(cost), label or getattr(fn, '__name__', 'job'))
+            queue = self._queues.get(user_id)
+            if queue is None:
+                queue = self._queues[user_id] = deque()
+                self._order.append(user_id)
+            if front:
+                queue.appendleft(job)
+            else:
+                queue.append(job)
+            self._cond.notify_all()
+        return job.future
+
+    def _pick(self, lanes):
+        for lane in lanes:
+            for _ in range(len(self._order)):
+                user_id = self._order[0]
+                self._order.rotate(-1)
+                if self._running.get(user_id, 0) >= self.max_per_user:
+                    continue
+                queue = self._queues[user_id]
+                if queue[0].lane != lane:
+                    continue
+                job = queue.popleft()
+                if not queue:
+                    del self._queues[user_id]
+                    self._order.remove(user_id)
+                return job
+        return None
+
+    def _worker(self, lanes):
+        while True:
+            with self._cond:
+                job = self._pick(lanes)
+                while job is None:
+                    self._cond.wait()
+                    job = self._pick(lanes)
+                self._running[job.user_id] = self._running.get(job.user_id, 0) + 1
+
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.fn(*job.args))
+                except BaseException as e:
+                    logger.error(f"Job {job.label} for user {job.user_id} failed: {e}")
+                    job.future.set_exception(e)
+
+            with self._cond:
+                self._running[job.user_id] -= 1
+                if not self._running[job.user_id]:
+                    del self._running[job.user_id]
+                self._cond.notify_all()
+
+    def start(self):
+        for i in range(self.cheap_workers):
+            self._spawn(f"sched-cheap-{i}", [CHEAP])
+        for i in range(self.heavy_workers):
+            self._spawn(f"sched-heavy-{i}", [HEAVY, CHEAP])
+
+    def _spawn(self, name, lanes):
+        thread = threading.Thread(target=self._worker, args=(lanes,), name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    # Wait until nothing is queued or running; False if timeout ran out first
+    def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queues or self._running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            pending = {CHEAP: 0, HEAVY: 0}
+            oldest = None
+            for queue in self._queues.values():
+                for job in queue:
+                    pending[job.lane] += 1
+                    if oldest is None or job.enqueued_at < oldest:
+                        oldest = job.enqueued_at
+            return {
+                "pending_cheap": pending[CHEAP],
+                "pending_heavy": pending[HEAVY],
+                "running": sum(self._running.values()),
+                "users_waiting": len(self._queues),
+                "oldest_wait": 0.0 if oldest is None else time.monotonic() - oldest,
+            }
@@ -0,0 +1,162 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Job directories currently in use; the janitor never touches these
+_active_dirs = set()
+_active_lock = threading.Lock()
+
+
+def _remove_tree(path):
+    # Rename first so the directory disappears atomically from the job's
+    # point of view, then delete the renamed tree at leisure
+    trash_path = f"{path}.trash-{uuid.uuid4().hex[:8]}"
+    try:
+        os.rename(path, trash_path)
+    except OSError:
+        trash_path = path
+    shutil.rmtree(trash_path, ignore_errors=True)
+
+
+# Isolated per-job working directory under root, removed when the job ends.
+# Point root at a tmpfs mount (e.g. /dev/shm/...) to keep scratch I/O in RAM.
+@contextmanager
+def job_scratch(root, prefix="job"):
+    os.makedirs(root, exist_ok=True)
+    job_dir = os.path.join(root, f"{prefix}_{uuid.uuid4().hex}")
+    os.makedirs(job_dir)
+    with _active_lock:
+        _active_dirs.add(os.path.abspath(job_dir))
+    try:
+        yield job_dir
+    finally:
+        with _active_lock:
+            _active_dirs.discard(os.path.abspath(job_dir))
+        _remove_tree(job_dir)
+
+
+def _entry_size(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Background cleaner that enforces age and total-size quotas on a set of
+# directories. Top-level entries (files or whole job directories) are the
+# unit of deletion; protect() returns paths that must be kept regardless.
+class Janitor:
+    def __init__(self, directories, max_age=7200, max_bytes=1024 ** 3, interval=300, protect=None):
+        self.directories = directories
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.protect = protect
+        self.bytes_reclaimed = 0
+        self.files_reclaimed = 0
+        self.last_run = None
+        self._thread = None
+
+    def _protected(self):
+        with _active_lock:
+            keep = set(_active_dirs)
+        if self.protect:
+            try:
+                keep.update(os.path.abspath(p) for p in self.protect())
+            except Exception as e:
+                logger.error(f"Janitor protect callback failed: {e}")
+        return keep
+
+    def _scan(self):
+        keep = self._protected()
+        # Nested scanned directories (e.g. the scratch root inside OUTPUT_DIR)
+        # are scanned on their own rather than deleted as a unit
+        keep.update(os.path.abspath(d) for d in self.directories)
+        entries = []
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.abspath(os.path.join(directory, name))
+                if path in keep:
+                    continue
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    continue
+                entries.append((mtime, path, _entry_size(path)))
+        entries.sort()
+        return entries
+
+    def _delete(self, path, size):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                _remove_tree(path)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logger.error(f"Janitor could not remove {path}: {e}")
+            return
+        self.bytes_reclaimed += size
+        self.files_reclaimed += 1
+
+    def run_once(self):
+        now = time.time()
+        entries = self._scan()
+        before = self.bytes_reclaimed
+
+        # Age quota first, then delete oldest entries until under the size quota
+        remaining = []
+        for mtime, path, size in entries:
+            if now - mtime > self.max_age:
+                self._delete(path, size)
+            else:
+                remaining.append((mtime, path, size))
+
+        total = sum(size for _, _, size in remaining)
+        for mtime, path, size in remaining:
+            if total <= self.max_bytes:
+                break
+            self._delete(path, size)
+            total -= size
+
+        self.last_run = now
+        reclaimed = self.bytes_reclaimed - before
+        if reclaimed:
+            logger.info(f"Janitor reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    def start(self):
+        def loop():
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"Janitor error: {e}")
+                time.sleep(self.interval)
+
+        self._thread = threading.Thread(target=loop, name="janitor", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stats(self):
+        return {
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "files_reclaimed": self.files_reclaimed,
+            "last_run": self.last_run,
+        }
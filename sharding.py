@@ -0,0 +1,123 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Keys under which an update can carry the chat it belongs to
+_UPDATE_KINDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'callback_query', 'my_chat_member', 'chat_member', 'chat_join_request',
+)
+
+
+def chat_id_of(update):
+    for kind in _UPDATE_KINDS:
+        payload = update.get(kind)
+        if not payload:
+            continue
+        chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        sender = payload.get('from')
+        if sender:
+            return sender['id']
+    return 0
+
+
+def shard_for(chat_id, num_shards):
+    # Stable across processes and restarts (unlike hash() on str)
+    return zlib.crc32(str(chat_id).encode()) % num_shards
+
+
+# Front-process side of a multi-process deployment. Updates are routed to
+# worker processes by chat_id hash, so one chat is always handled by the same
+# process (which owns its conversation state and temp files) and in order.
+# Workers push analytics rows onto a shared queue; a single writer thread in
+# the front process hands them to sink(rows) in batches, so only one process
+# ever writes to the shared SQLite database.
+#
+# worker_target(shard_id, inbox, analytics_queue) must be importable by the
+# child; it should consume dict updates from inbox until it receives None.
+class ShardPool:
+    def __init__(self, num_workers, worker_target, sink=None, max_pending=1000,
+                 batch_size=200, flush_interval=0.5, start_method='spawn'):
+        self.num_workers = num_workers
+        self.worker_target = worker_target
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._ctx = multiprocessing.get_context(start_method)
+        self.inboxes = [self._ctx.Queue(max_pending) for _ in range(num_workers)]
+        self.analytics_queue = self._ctx.Queue()
+        self.processes = []
+        self.routed = [0] * num_workers
+        self._writer = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        for shard_id in range(self.num_workers):
+            # Children read SHARD_ID at import time to pick their own state
+            # database and scratch directories, and SHARD_COUNT to take their
+            # share of limits that apply to the bot as a whole
+            os.environ["SHARD_ID"] = str(shard_id)
+            os.environ["SHARD_COUNT"] = str(self.num_workers)
+            process = self._ctx.Process(
+                target=self.worker_target,
+                args=(shard_id, self.inboxes[shard_id], self.analytics_queue),
+                name=f"shard-{shard_id}",
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+        os.environ.pop("SHARD_ID", None)
+        os.environ.pop("SHARD_COUNT", None)
+        if self.sink:
+            self._writer = threading.Thread(target=self._write_analytics, name="analytics-writer", daemon=True)
+            self._writer.start()
+        logger.info(f"Started {self.num_workers} shard workers")
+
+    def route(self, update):
+        shard_id = shard_for(chat_id_of(update), self.num_workers)
+        self.inboxes[shard_id].put(update)
+        self.routed[shard_id] += 1
+        return shard_id
+
+    def _write_analytics(self):
+        while not self._stopping.is_set() or not self.analytics_queue.empty():
+            rows = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self.analytics_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if rows:
+                try:
+                    self.sink(rows)
+                except Exception as e:
+                    logger.error(f"Analytics writer failed for {len(rows)} rows: {e}")
+
+    def alive(self):
+        return [p.is_alive() for p in self.processes]
+
+    # Ask workers to finish what they have queued, then stop the writer
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not exit in time; terminating")
+                process.terminate()
+        self._stopping.set()
+        if self._writer:
+            self._writer.join(timeout)
@@ -0,0 +1,215 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+# Dict-like conversation state with per-entry TTL, LRU eviction and optional
+# write-through persistence to SQLite. Values must be JSON serializable.
+# Entries are stored as (value, expires_at) where expires_at is wall-clock
+# time so that it stays meaningful across restarts.
+class StateStore:
+    def __init__(self, name, ttl=3600, max_entries=10000, db_path=None, on_expire=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.on_expire = on_expire
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn = None
+
+        if db_path:
+            self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+            self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                namespace TEXT,
+                key TEXT,
+                value TEXT,
+                expires_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+            ''')
+            self._conn.commit()
+            self._load()
+
+    # Restore non-expired entries from disk, most recently used last
+    def _load(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value, expires_at FROM state WHERE namespace = ? ORDER BY expires_at",
+                (self.name,)
+            ).fetchall()
+            for key_json, value_json, expires_at in rows:
+                key = json.loads(key_json)
+                value = json.loads(value_json)
+                if expires_at <= now:
+                    expired.append((key, value))
+                else:
+                    self._data[key] = (value, expires_at)
+            for key, _ in expired:
+                self._db_delete(key)
+            overflow = self._evict_overflow()
+            self._db_commit()
+        logger.info(f"State store '{self.name}' restored {len(self._data)} entries")
+        self._notify(expired + overflow)
+
+    def _db_write(self, key, value, expires_at):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (self.name, json.dumps(key), json.dumps(value), expires_at)
+            )
+        except sqlite3.Error as e:
+            logger.error(f"[ERROR] State store '{self.name}' write failed: {e}")
+
+    def _db_delete(self, key):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND key = ?",
+                (self.name, json.dumps(key))
+            )
+        except sqlite3.Error as e:
+            logger.error(f"[ERROR] State store '{self.name}' delete failed: {e}")
+
+    def _db_commit(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"[ERROR] State store '{self.name}' commit failed: {e}")
+
+    # Drop least recently used entries until we are back under max_entries
+    def _evict_overflow(self):
+        evicted = []
+        while len(self._data) > self.max_entries:
+            key, (value, _) = self._data.popitem(last=False)
+            self._db_delete(key)
+            evicted.append((key, value))
+        return evicted
+
+    # Callbacks run outside the lock so they may touch other stores
+    def _notify(self, entries):
+        if not self.on_expire:
+            return
+        for key, value in entries:
+            try:
+                self.on_expire(key, value)
+            except Exception as e:
+                logger.error(f"Error in expiry callback for '{self.name}' key {key}: {e}")
+
+    # Return the live entry for key (refreshing its TTL) or None
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None, []
+        value, expires_at = entry
+        now = time.time()
+        if expires_at <= now:
+            del self._data[key]
+            self._db_delete(key)
+            self._db_commit()
+            return None, [(key, value)]
+        self._data.move_to_end(key)
+        new_expiry = now + self.ttl
+        self._data[key] = (value, new_expiry)
+        # Only persist the sliding expiry when it moved noticeably
+        if new_expiry - expires_at > self.ttl / 10:
+            self._db_write(key, value, new_expiry)
+            self._db_commit()
+        return entry, []
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry, expired = self._lookup(key)
+        self._notify(expired)
+        return default if entry is None else entry[0]
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry, expired = self._lookup(key)
+        self._notify(expired)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            self._db_write(key, value, expires_at)
+            evicted = self._evict_overflow()
+            self._db_commit()
+        self._notify(evicted)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+            self._db_delete(key)
+            self._db_commit()
+
+    def __contains__(self, key):
+        with self._lock:
+            entry, expired = self._lookup(key)
+        self._notify(expired)
+        return entry is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def values(self):
+        now = time.time()
+        with self._lock:
+            return [v for v, exp in self._data.values() if exp > now]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._db_delete(key)
+                self._db_commit()
+        return default if entry is None else entry[0]
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [(k, v) for k, (v, exp) in self._data.items() if exp <= now]
+            for key, _ in expired:
+                del self._data[key]
+                self._db_delete(key)
+            if expired:
+                self._db_commit()
+        self._notify(expired)
+        return len(expired)
+
+
+# Periodically purge expired entries so abandoned flows release their
+# resources even if the chat never comes back
+def start_sweeper(stores, interval=60):
+    def sweep():
+        while True:
+            time.sleep(interval)
+            for store in stores:
+                try:
+                    removed = store.purge_expired()
+                    if removed:
+                        logger.info(f"Expired {removed} entries from state store '{store.name}'")
+                except Exception as e:
+                    logger.error(f"State sweeper error for '{store.name}': {e}")
+
+    thread = threading.Thread(target=sweep, name="state-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,70 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from processing import PAGE_WIDTH, PAGE_HEIGHT
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_template(input_path, output_path):
+    # Decode, orient, crop and resize an uploaded background to the page
+    # size once; stored as PNG so later loads are lossless and quick
+    with Image.open(input_path) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img = ImageOps.fit(img, (PAGE_WIDTH, PAGE_HEIGHT), Image.LANCZOS)
+    img.save(output_path, 'PNG')
+    return output_path
+
+
+def load_template(path):
+    img = Image.open(path)
+    img = img.convert('RGB') if img.mode != 'RGB' else img
+    img.load()
+    return img
+
+
+# Decoded page backgrounds keyed by file path, evicted least recently used
+# once their pixel data exceeds max_bytes. Returned images are shared between
+# renders: callers copy() before drawing on them.
+class TemplateCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        img = load_template(path)
+        size = img.width * img.height * len(img.getbands())
+        with self._lock:
+            if path not in self._entries:
+                self._entries[path] = (img, size)
+                self.bytes += size
+            # Always keep the entry just loaded, even if it alone is too big
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+        return img
+
+    def invalidate(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses}
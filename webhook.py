@@ -0,0 +1,111 @@
+import hmac
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Minimal webhook receiver: validates the secret token, acknowledges the POST
+# immediately and hands the decoded update to a worker pool.
+# on_update(update_dict) runs on a pool thread. When more than max_pending
+# updates are waiting we answer 503 so Telegram retries later instead of us
+# buffering without bound.
+class WebhookServer:
+    def __init__(self, on_update, host="127.0.0.1", port=8443, path="/webhook",
+                 secret_token=None, workers=8, max_pending=1000):
+        self.on_update = on_update
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+        self.received = 0
+        self.rejected = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        # Port 0 picks a free port; expose the real one
+        self.port = self._httpd.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, code):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path.split('?')[0] != server.path:
+                    self._reply(404)
+                    return
+                if server.secret_token is not None:
+                    supplied = self.headers.get(SECRET_HEADER, "")
+                    if not hmac.compare_digest(supplied.encode(), server.secret_token.encode()):
+                        server.rejected += 1
+                        self._reply(403)
+                        return
+                try:
+                    length = int(self.headers.get("Content-Length", "0"))
+                    update = json.loads(self.rfile.read(length).decode("utf-8"))
+                except (ValueError, UnicodeDecodeError):
+                    self._reply(400)
+                    return
+                if not server.accept(update):
+                    self._reply(503)
+                    return
+                self._reply(200)
+
+            def do_GET(self):
+                self._reply(405)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def accept(self, update):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            self.received += 1
+        self.executor.submit(self._process, update)
+        return True
+
+    def _process(self, update):
+        try:
+            self.on_update(update)
+        except Exception as e:
+            logger.error(f"Webhook update {update.get('update_id')} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def serve_forever(self):
+        logger.info(f"Webhook server listening on http://{self.host}:{self.port}{self.path}")
+        self._httpd.serve_forever()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="webhook-http", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self, wait=True):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self.executor.shutdown(wait=wait)